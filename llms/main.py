@@ -11,16 +11,21 @@ import time
 import json
 import argparse
 import asyncio
-import subprocess
 import base64
 import mimetypes
 import traceback
 import sys
 import site
 import secrets
+import random
 import re
+import hashlib
+import sqlite3
+import queue
+import threading
+from collections import OrderedDict, deque
 from io import BytesIO
-from urllib.parse import parse_qs, urlencode
+from urllib.parse import parse_qs, urlencode, urlparse
 
 import aiohttp
 from aiohttp import web
@@ -40,6 +45,18 @@ try:
 except ImportError:
     HAS_PIL = False
 
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+try:
+    import msgspec
+    HAS_MSGSPEC = True
+except ImportError:
+    HAS_MSGSPEC = False
+
 VERSION = "2.0.33"
 _ROOT = None
 g_config_path = None
@@ -48,55 +65,154 @@ g_config = None
 g_handlers = {}
 g_verbose = False
 g_logprefix=""
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+g_log_level = LOG_LEVELS["warning"]
+g_log_sink = None
 g_default_model=""
 g_sessions = {}  # OAuth session storage: {session_token: {userId, userName, displayName, profileUrl, email, created}}
 g_oauth_states = {}  # CSRF protection: {state: {created, redirect_uri}}
 
-def _log(message):
-    """Helper method for logging from the global polling task."""
-    if g_verbose:
-        print(f"{g_logprefix}{message}", flush=True)
+class JsonCodec:
+    """JSON encoder/decoder for the request/response hot path, working on bytes end to end.
+
+    codec is "orjson", "msgspec" or "stdlib", "auto" uses the fastest one installed.
+    Decode errors are always raised as json.JSONDecodeError.
+    """
+    def __init__(self, codec="auto"):
+        self.config = codec
+        if codec == "auto":
+            codec = "orjson" if HAS_ORJSON else "msgspec" if HAS_MSGSPEC else "stdlib"
+        if (codec == "orjson" and not HAS_ORJSON) or (codec == "msgspec" and not HAS_MSGSPEC):
+            print(f"JSON codec {codec} is not installed, using stdlib json")
+            codec = "stdlib"
+        self.name = codec
+        if codec == "orjson":
+            # orjson.JSONDecodeError is a json.JSONDecodeError
+            self.loads = orjson.loads
+        elif codec == "msgspec":
+            self.encoder = msgspec.json.Encoder()
+            self.decoder = msgspec.json.Decoder()
+        else:
+            self.loads = json.loads
+
+    def dumps(self, obj, default=None):
+        if self.name == "orjson":
+            return orjson.dumps(obj, default=default)
+        if self.name == "msgspec":
+            return self.encoder.encode(obj) if default is None else msgspec.json.encode(obj, enc_hook=default)
+        return json.dumps(obj, default=default).encode('utf-8')
+
+    def loads(self, data):
+        try:
+            return self.decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise json.JSONDecodeError(str(e), data if isinstance(data, str) else '', 0) from e
+
+g_json = JsonCodec()
+
+def json_response(obj, status=200, headers=None):
+    """web.json_response() encoded with g_json"""
+    return web.Response(body=g_json.dumps(obj), status=status, headers=headers, content_type='application/json', charset='utf-8')
+
+def _log(message, *args, level=10):
+    """Log a debug message, or a message at level, if it's enabled.
+
+    Messages are built lazily, `message % args` or `message(*args)` if message is callable,
+    so disabled logging doesn't format strings or summarize requests.
+    """
+    if level < g_log_level:
+        return
+    if callable(message):
+        message = message(*args)
+    elif args:
+        message = message % args
+    line = f"{g_logprefix}{message}"
+    if g_log_sink is not None:
+        g_log_sink.write(line)
+    else:
+        print(line, flush=True)
+
+class LogSink:
+    """Writes log lines to stdout from a background thread, so logging never blocks the server's event loop"""
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name='llms-log', daemon=True)
+        self.thread.start()
+
+    def write(self, line):
+        self.queue.put(line)
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            # write everything queued in one batch
+            lines = [self.queue.get()]
+            while not self.queue.empty():
+                lines.append(self.queue.get_nowait())
+            if None in lines:
+                stopped = True
+                lines = lines[:lines.index(None)]
+            if lines:
+                try:
+                    self.stream.write('\n'.join(lines) + '\n')
+                    self.stream.flush()
+                except (OSError, ValueError):
+                    pass
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+
+def format_json(obj):
+    return json.dumps(obj, indent=2, default=str)
 
 def printdump(obj):
     args = obj.__dict__ if hasattr(obj, '__dict__') else obj
     print(json.dumps(args, indent=2))
 
 def print_chat(chat):
-    _log(f"Chat: {chat_summary(chat)}")
+    _log(lambda: f"Chat: {chat_summary(chat)}")
 
 def chat_summary(chat):
     """Summarize chat completion request for logging."""
-    # replace image_url.url with <image>
-    clone = json.loads(json.dumps(chat))
-    for message in clone['messages']:
-        if 'content' in message:
-            if isinstance(message['content'], list):
-                for item in message['content']:
-                    if 'image_url' in item:
-                        if 'url' in item['image_url']:
-                            url = item['image_url']['url']
-                            prefix = url.split(',', 1)[0]
-                            item['image_url']['url'] = prefix + f",({len(url) - len(prefix)})"
-                    elif 'input_audio' in item:
-                        if 'data' in item['input_audio']:
-                            data = item['input_audio']['data']
-                            item['input_audio']['data'] = f"({len(data)})"
-                    elif 'file' in item:
-                        if 'file_data' in item['file']:
-                            data = item['file']['file_data']
-                            prefix = data.split(',', 1)[0]
-                            item['file']['file_data'] = prefix + f",({len(data) - len(prefix)})"
-    return json.dumps(clone, indent=2)
+    # replace inline media with its size, copying only the messages that contain it
+    clone = {**chat, 'messages': [summarize_message(message) for message in chat.get('messages', [])]}
+    return json.dumps(clone, indent=2, default=str)
+
+def summarize_message(message):
+    if not isinstance(message.get('content'), list):
+        return message
+    content = []
+    for item in message['content']:
+        if 'image_url' in item and 'url' in item['image_url']:
+            item = {**item, 'image_url': {**item['image_url'], 'url': media_summary(item['image_url']['url'])}}
+        elif 'input_audio' in item and 'data' in item['input_audio']:
+            data = item['input_audio']['data']
+            size = data.base64_length() if isinstance(data, MediaPayload) else len(data)
+            item = {**item, 'input_audio': {**item['input_audio'], 'data': f"({size})"}}
+        elif 'file' in item and 'file_data' in item['file']:
+            item = {**item, 'file': {**item['file'], 'file_data': media_summary(item['file']['file_data'])}}
+        content.append(item)
+    return {**message, 'content': content}
+
+def media_summary(url):
+    if isinstance(url, MediaPayload):
+        return f"data:{url.mimetype};base64,({url.base64_length()})"
+    prefix = url.split(',', 1)[0]
+    return prefix + f",({len(url) - len(prefix)})"
 
 def gemini_chat_summary(gemini_chat):
     """Summarize Gemini chat completion request for logging. Replace inline_data with size of content only"""
-    clone = json.loads(json.dumps(gemini_chat))
-    for content in clone['contents']:
-        for part in content['parts']:
-            if 'inline_data' in part:
-                data = part['inline_data']['data']
-                part['inline_data']['data'] = f"({len(data)})"
-    return json.dumps(clone, indent=2)
+    def summarize_part(part):
+        if 'inline_data' not in part:
+            return part
+        data = part['inline_data']['data']
+        size = data.base64_length() if isinstance(data, MediaPayload) else len(data)
+        return {**part, 'inline_data': {**part['inline_data'], 'data': f"({size})"}}
+    clone = {**gemini_chat, 'contents': [{**content, 'parts': [summarize_part(part) for part in content['parts']]}
+        for content in gemini_chat['contents']]}
+    return json.dumps(clone, indent=2, default=str)
 
 image_exts = 'png,webp,jpg,jpeg,gif,bmp,svg,tiff,ico'.split(',')
 audio_exts = 'mp3,wav,ogg,flac,m4a,opus,webm'.split(',')
@@ -217,13 +333,76 @@ def price_to_string(price: float | int | str | None) -> str | None:
     except (ValueError, TypeError):
         return None
 
-def convert_image_if_needed(image_bytes, mimetype='image/png'):
+def image_convert_config():
+    return g_config.get('convert', {}).get('image', {}) if g_config else {}
+
+# Speed/quality trade-offs for converting images, selected with convert.image.preset.
+# "quality" reproduces the output of previous versions (WebP method 6, LANCZOS, thumbnail()'s default
+# reducing_gap and no JPEG draft decoding), the default "balanced" is several times faster.
+IMAGE_PRESETS = {
+    "fast":     {"quality": 80, "method": 0, "resample": "BILINEAR", "reducing_gap": 2.0, "draft": True},
+    "balanced": {"quality": 85, "method": 4, "resample": "BICUBIC",  "reducing_gap": 3.0, "draft": True},
+    "quality":  {"quality": 85, "method": 6, "resample": "LANCZOS",  "reducing_gap": 2.0, "draft": False},
+}
+
+# Number of base64 chars decoded to probe an image header (48KB of image data)
+IMAGE_PROBE_BASE64_CHARS = 64 * 1024
+
+def image_preset(convert_config):
+    """Resolve preset settings, individual quality/method/resample values in convert_config take precedence"""
+    preset = IMAGE_PRESETS.get(convert_config.get('preset', 'balanced'), IMAGE_PRESETS['balanced'])
+    return {k: convert_config.get(k, v) for k, v in preset.items()}
+
+def image_limits(convert_config):
+    max_width, max_height = map(int, convert_config.get('max_size', '1536x1024').split('x'))
+    max_length = convert_config.get('max_length', 1.5*1024*1024) # 1.5MB
+    return max_width, max_height, max_length
+
+def image_needs_conversion(width, height, byte_length, convert_config):
+    """Returns (needs_resize, needs_conversion) for an image of the given dimensions and size in bytes"""
+    max_width, max_height, max_length = image_limits(convert_config)
+    # Check if image exceeds limits
+    needs_resize = width > max_width or height > max_height
+    # Check if base64 length would exceed max_length (in KB)
+    # Base64 encoding increases size by ~33%, so check raw bytes * 1.33 / 1024
+    estimated_kb = (byte_length * 1.33) / 1024
+    needs_conversion = estimated_kb > max_length
+    return needs_resize, needs_conversion
+
+def probe_image(image_bytes):
+    """Read (format, (width, height)) from the image header without decoding any pixels, None if unrecognized"""
+    try:
+        with Image.open(BytesIO(image_bytes)) as img:
+            return img.format, img.size
+    except Exception:
+        return None
+
+def image_within_limits(payload, convert_config):
+    """Check whether a MediaPayload image is within convert_config limits by probing just its header"""
+    if not HAS_PIL or not convert_config:
+        return True
+    try:
+        header = base64.b64decode(payload.base64_head(IMAGE_PROBE_BASE64_CHARS))
+        probe = probe_image(header)
+        if probe is None:
+            return False
+        width, height = probe[1]
+        needs_resize, needs_conversion = image_needs_conversion(width, height, payload.raw_length(), convert_config)
+        return not needs_resize and not needs_conversion
+    except Exception:
+        return False
+
+def convert_image_if_needed(image_bytes, mimetype='image/png', convert_config=None):
     """
     Convert and resize image to WebP if it exceeds configured limits.
 
+    Only the image header is read when it's within limits. Oversized JPEGs are decoded at reduced
+    resolution (draft mode) and other formats are reduced before resampling.
+
     Args:
         image_bytes: Raw image bytes
         mimetype: Original image MIME type
+        convert_config: convert.image settings, defaults to the loaded config (pass explicitly in worker processes)
 
     Returns:
         tuple: (converted_bytes, new_mimetype) or (original_bytes, original_mimetype) if no conversion needed
@@ -232,51 +411,51 @@ def convert_image_if_needed(image_bytes, mimetype='image/png'):
         return image_bytes, mimetype
 
     # Get conversion config
-    convert_config = g_config.get('convert', {}).get('image', {}) if g_config else {}
+    if convert_config is None:
+        convert_config = image_convert_config()
     if not convert_config:
         return image_bytes, mimetype
 
-    max_size_str = convert_config.get('max_size', '1536x1024')
-    max_length = convert_config.get('max_length', 1.5*1024*1024) # 1.5MB
-
     try:
-        # Parse max_size (e.g., "1536x1024")
-        max_width, max_height = map(int, max_size_str.split('x'))
+        max_width, max_height, _ = image_limits(convert_config)
+        preset = image_preset(convert_config)
 
-        # Open image
+        # Open image (lazily, only the header is read until pixels are accessed)
         with Image.open(BytesIO(image_bytes)) as img:
             original_width, original_height = img.size
 
-            # Check if image exceeds limits
-            needs_resize = original_width > max_width or original_height > max_height
-
-            # Check if base64 length would exceed max_length (in KB)
-            # Base64 encoding increases size by ~33%, so check raw bytes * 1.33 / 1024
-            estimated_kb = (len(image_bytes) * 1.33) / 1024
-            needs_conversion = estimated_kb > max_length
-
+            needs_resize, needs_conversion = image_needs_conversion(original_width, original_height, len(image_bytes), convert_config)
             if not needs_resize and not needs_conversion:
                 return image_bytes, mimetype
 
+            if needs_resize and img.format == 'JPEG' and preset['draft']:
+                # Let the JPEG decoder downscale by 1/2, 1/4 or 1/8 while still covering the target size
+                img.draft('RGB', (max_width, max_height))
+
+            # Resample in a mode that supports it, palette images need expanding first
+            if img.mode == 'P':
+                img = img.convert('RGBA')
+            elif img.mode not in ('RGB', 'RGBA', 'LA', 'L'):
+                img = img.convert('RGB')
+
+            # Resize if needed (preserve aspect ratio), reducing first by whole factors when reducing_gap is set
+            if needs_resize:
+                resample = getattr(Image.Resampling, preset['resample'], Image.Resampling.LANCZOS)
+                img.thumbnail((max_width, max_height), resample, reducing_gap=preset['reducing_gap'])
+                _log(f"Resized image from {original_width}x{original_height} to {img.size[0]}x{img.size[1]}")
+
             # Convert RGBA to RGB if necessary (WebP doesn't support transparency in RGB mode)
-            if img.mode in ('RGBA', 'LA', 'P'):
+            if img.mode in ('RGBA', 'LA'):
                 # Create a white background
                 background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+                background.paste(img, mask=img.split()[-1])
                 img = background
             elif img.mode != 'RGB':
                 img = img.convert('RGB')
 
-            # Resize if needed (preserve aspect ratio)
-            if needs_resize:
-                img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
-                _log(f"Resized image from {original_width}x{original_height} to {img.size[0]}x{img.size[1]}")
-
             # Convert to WebP
             output = BytesIO()
-            img.save(output, format='WEBP', quality=85, method=6)
+            img.save(output, format='WEBP', quality=preset['quality'], method=preset['method'])
             converted_bytes = output.getvalue()
 
             _log(f"Converted image to WebP: {len(image_bytes)} bytes -> {len(converted_bytes)} bytes ({len(converted_bytes)*100//len(image_bytes)}%)")
@@ -288,7 +467,549 @@ def convert_image_if_needed(image_bytes, mimetype='image/png'):
         # Return original if conversion fails
         return image_bytes, mimetype
 
+class MediaPayload:
+    """Inline media that's serialized lazily, backed by raw bytes, an existing base64 str or a file path.
+
+    It's written as a data uri (or bare base64 when data_uri=False) by JsonBody while the request body is
+    being sent, so raw content is base64 encoded once, in chunks, and existing base64 is never copied whole.
+    """
+    # raw bytes per chunk, a multiple of 3 so each chunk encodes to base64 without padding
+    CHUNK_SIZE = 3 * 64 * 1024
+
+    def __init__(self, mimetype, data=None, base64_data=None, offset=0, path=None, size=None, data_uri=True):
+        self.mimetype = mimetype
+        self.data = data
+        self.base64_data = base64_data
+        self.offset = offset
+        self.path = path
+        self.size = size
+        self.data_uri = data_uri
+        # cached digest(), computed on first use
+        self.sha256 = None
+
+    @classmethod
+    def from_data_uri(cls, url, data_uri=True, default_mimetype='application/octet-stream'):
+        """Reference the base64 part of an existing data uri without copying it"""
+        comma = url.index(',')
+        mimetype = url[5:comma].split(';', 1)[0] if ';' in url[:comma] else default_mimetype
+        return cls(mimetype or default_mimetype, base64_data=url, offset=comma + 1, data_uri=data_uri)
+
+    @classmethod
+    def from_file(cls, path, mimetype, data_uri=True):
+        return cls(mimetype, path=path, size=os.path.getsize(path), data_uri=data_uri)
+
+    def with_data_uri(self, data_uri):
+        payload = MediaPayload(self.mimetype, self.data, self.base64_data, self.offset, self.path, self.size, data_uri)
+        payload.sha256 = self.sha256
+        return payload
+
+    def prefix(self):
+        return f"data:{self.mimetype};base64," if self.data_uri else ""
+
+    def raw_length(self):
+        if self.base64_data is not None:
+            padding = self.base64_data.count('=', max(self.offset, len(self.base64_data) - 2))
+            return self.base64_length() * 3 // 4 - padding
+        return len(self.data) if self.data is not None else self.size
+
+    def base64_length(self):
+        if self.base64_data is not None:
+            return len(self.base64_data) - self.offset
+        return (self.raw_length() + 2) // 3 * 4
+
+    def base64_head(self, length):
+        if self.base64_data is not None:
+            return self.base64_data[self.offset:self.offset + length]
+        return next(self.base64_chunks(length * 3 // 4), b'').decode('ascii')
+
+    def base64_chunks(self, chunk_size=CHUNK_SIZE):
+        """Yield the base64 encoding as ascii bytes, one chunk at a time"""
+        if self.base64_data is not None:
+            step = chunk_size // 3 * 4
+            for i in range(self.offset, len(self.base64_data), step):
+                yield self.base64_data[i:i + step].encode('ascii')
+        elif self.data is not None:
+            view = memoryview(self.data)
+            for i in range(0, len(view), chunk_size):
+                yield base64.b64encode(view[i:i + chunk_size])
+        else:
+            with open(self.path, "rb") as f:
+                remaining = self.size
+                while remaining > 0:
+                    chunk = f.read(min(chunk_size, remaining))
+                    if not chunk:
+                        raise Exception(f"File changed while reading: {self.path}")
+                    remaining -= len(chunk)
+                    yield base64.b64encode(chunk)
+
+    def digest(self):
+        """sha256 of the content, e.g. to key requests by their media, computed once.
+
+        Raw content is hashed as is and base64 content as its base64 text, so nothing is encoded or decoded.
+        """
+        if self.sha256 is None:
+            h = hashlib.sha256()
+            if self.base64_data is not None:
+                for chunk in self.base64_chunks():
+                    h.update(chunk)
+            elif self.data is not None:
+                h.update(self.data)
+            else:
+                with open(self.path, "rb") as f:
+                    while chunk := f.read(self.CHUNK_SIZE):
+                        h.update(chunk)
+            self.sha256 = h.hexdigest()
+        return self.sha256
+
+    def digest_cost(self):
+        """Bytes digest() has left to hash"""
+        return 0 if self.sha256 is not None else self.raw_length()
+
+    def json_chunks(self):
+        yield b'"' + self.prefix().encode('utf-8')
+        yield from self.base64_chunks()
+        yield b'"'
+
+    def json_length(self):
+        return len(self.prefix().encode('utf-8')) + self.base64_length() + 2
+
+    def __str__(self):
+        """Materialize as a str, only for consumers that can't take a streamed body (e.g. SDK clients)"""
+        return self.prefix() + b''.join(self.base64_chunks()).decode('ascii')
+
+def materialize_media(obj):
+    """Copy of obj with any MediaPayload replaced by its str value"""
+    if isinstance(obj, MediaPayload):
+        return str(obj)
+    if isinstance(obj, dict):
+        return {k: materialize_media(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [materialize_media(v) for v in obj]
+    return obj
+
+class JsonBody:
+    """JSON request body that streams any MediaPayload values as they're sent.
+
+    The rest of the document is serialized with g_json as usual, MediaPayloads are swapped for
+    placeholders and written chunk by chunk in their place, so large inline media is never built into
+    one big str. The total length is known upfront so it's sent with a Content-Length, not chunked.
+    """
+    def __init__(self, obj):
+        payloads = []
+        nonce = secrets.token_hex(8)
+        def placeholder(o):
+            if not isinstance(o, MediaPayload):
+                raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+            payloads.append(o)
+            return f"{nonce}:{len(payloads) - 1}"
+        data = g_json.dumps(obj, default=placeholder)
+        if not payloads:
+            self.parts = [data]
+        else:
+            self.parts = []
+            pos = 0
+            for m in re.finditer(f'"{nonce}:(\\d+)"'.encode('ascii'), data):
+                self.parts.append(data[pos:m.start()])
+                self.parts.append(payloads[int(m.group(1))])
+                pos = m.end()
+            self.parts.append(data[pos:])
+        self.length = sum(len(part) if isinstance(part, bytes) else part.json_length() for part in self.parts)
+
+    def chunks(self):
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                yield from part.json_chunks()
+
+    async def stream(self):
+        for chunk in self.chunks():
+            yield chunk
+
+    def data(self):
+        """bytes for plain JSON, otherwise an async generator aiohttp writes chunk by chunk"""
+        return self.parts[0] if len(self.parts) == 1 else self.stream()
+
+    def headers(self, headers):
+        return headers if len(self.parts) == 1 else {**headers, 'Content-Length': str(self.length)}
+
+class MediaCache:
+    """Two-tier cache of resolved media as (mimetype, data) tuples, keyed by content hash or file identity.
+
+    data is a base64 str for converted images and raw bytes for audio and files, which are encoded when sent.
+
+    The memory tier is an LRU bounded by max_bytes, the optional disk tier stores entries under ~/.llms/cache/media.
+    Downloaded URLs remember their ETag/Last-Modified validators so they can be revalidated with a conditional GET.
+    """
+    def __init__(self, cache_config=None):
+        self.config = cache_config or {}
+        self.enabled = bool(self.config.get('enabled', True))
+        self.max_bytes = int(self.config.get('max_bytes', 64*1024*1024))
+        self.max_urls = int(self.config.get('max_urls', 10000))
+        disk = self.config.get('disk', False)
+        self.disk_path = (os.path.expanduser(disk) if isinstance(disk, str) else home_llms_path("cache/media")) if disk else None
+        self.disk_max_bytes = int(self.config.get('disk_max_bytes', 1024*1024*1024))
+        self.disk_bytes = None
+        self.entries = OrderedDict()
+        self.urls = OrderedDict()
+        self.bytes = 0
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "revalidated": 0}
+
+    async def get(self, key):
+        if not self.enabled:
+            return None
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+        if self.disk_path:
+            value = await asyncio.to_thread(self.read_disk, key)
+            if value is not None:
+                self.stats['disk_hits'] += 1
+                self.put_memory(key, value)
+                return value
+        self.stats['misses'] += 1
+        return None
+
+    async def put(self, key, value):
+        if not self.enabled:
+            return
+        self.put_memory(key, value)
+        if self.disk_path:
+            await asyncio.to_thread(self.write_disk, key, value)
+
+    def put_memory(self, key, value):
+        size = len(value[1])
+        if size > self.max_bytes:
+            return
+        existing = self.entries.pop(key, None)
+        if existing is not None:
+            self.bytes -= len(existing[1])
+        self.entries[key] = value
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= len(evicted[1])
+            self.stats['evictions'] += 1
+
+    def url_validators(self, url):
+        return self.urls.get(url) if self.enabled else None
+
+    def put_url(self, url, headers, key):
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not self.enabled or not (etag or last_modified):
+            self.urls.pop(url, None)
+            return
+        self.urls[url] = {"etag": etag, "last_modified": last_modified, "key": key}
+        self.urls.move_to_end(url)
+        while len(self.urls) > self.max_urls:
+            self.urls.popitem(last=False)
+
+    def forget_url(self, url):
+        self.urls.pop(url, None)
+
+    def disk_file(self, key):
+        return os.path.join(self.disk_path, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def read_disk(self, key):
+        path = self.disk_file(key)
+        try:
+            with open(path, "rb") as f:
+                header = f.readline().decode('ascii').rstrip('\n')
+                data = f.read()
+            encoding, _, mimetype = header.partition(' ')
+            if encoding not in ('raw', 'base64'):
+                # entries written before raw data was cached only have the mimetype
+                encoding, mimetype = 'base64', header
+            # touch so disk pruning evicts least recently used entries first
+            os.utime(path)
+            return mimetype, data if encoding == 'raw' else data.decode('ascii')
+        except OSError:
+            return None
+
+    def write_disk(self, key, value):
+        try:
+            os.makedirs(self.disk_path, exist_ok=True)
+            path = self.disk_file(key)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            mimetype, data = value
+            with open(tmp_path, "wb") as f:
+                if isinstance(data, str):
+                    f.write(f"base64 {mimetype}\n".encode('ascii'))
+                    f.write(data.encode('ascii'))
+                else:
+                    f.write(f"raw {mimetype}\n".encode('ascii'))
+                    f.write(data)
+            os.replace(tmp_path, path)
+            if self.disk_bytes is not None:
+                self.disk_bytes += len(value[1])
+            if self.disk_bytes is None or self.disk_bytes > self.disk_max_bytes:
+                self.prune_disk()
+        except OSError as e:
+            _log("Error writing media cache: %s", e, level=LOG_LEVELS["warning"])
+
+    def prune_disk(self):
+        """Remove least recently used files until the disk tier is within 90% of disk_max_bytes"""
+        files = []
+        for entry in os.scandir(self.disk_path):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        if total > self.disk_max_bytes:
+            files.sort()
+            for _, size, path in files:
+                if total <= self.disk_max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    self.stats['evictions'] += 1
+                except OSError:
+                    pass
+        self.disk_bytes = total
+
+    def status(self):
+        return {
+            **self.stats,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "urls": len(self.urls),
+            "disk": self.disk_path is not None,
+        }
+
+g_media_cache = MediaCache()
+
+def media_key(kind, identity, mimetype):
+    key = f"{kind}:{mimetype}:{identity}"
+    if kind == 'image':
+        # converted images depend on the conversion settings
+        convert_config = {k: v for k, v in image_convert_config().items() if k not in ('workers', 'max_concurrent', 'executor')}
+        key += ":" + json.dumps(convert_config, sort_keys=True)
+    return key
+
+def encode_media(content, mimetype, convert_config=None):
+    """Convert image content if convert_config is given and return its (mimetype, base64 data), runs in g_convert_pool"""
+    if convert_config:
+        content, mimetype = convert_image_if_needed(content, mimetype, convert_config)
+    return mimetype, base64.b64encode(content).decode('utf-8')
+
+def decode_encode_media(base64_data, mimetype, convert_config=None):
+    return encode_media(base64.b64decode(base64_data), mimetype, convert_config)
+
+class WorkerPool:
+    """Bounded thread or process pool that runs CPU-heavy media work (image conversion, base64) off the event loop.
+
+    At most max_concurrent jobs are submitted at once, `queued` is the number of jobs waiting for a slot.
+    """
+    def __init__(self, pool_config=None):
+        self.config = pool_config or {}
+        self.workers = max(1, int(self.config.get('workers', min(4, os.cpu_count() or 1))))
+        self.max_concurrent = max(1, int(self.config.get('max_concurrent', self.workers)))
+        self.use_processes = self.config.get('executor', 'thread') == 'process'
+        self.executor = None
+        self._semaphore = None
+        self._loop = None
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+
+    def semaphore(self):
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+            self._loop = loop
+        return self._semaphore
+
+    def get_executor(self):
+        if self.executor is None:
+            if self.use_processes:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                from concurrent.futures import ThreadPoolExecutor
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='llms-convert')
+        return self.executor
+
+    async def run(self, fn, *args):
+        semaphore = self.semaphore()
+        self.queued += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.get_executor(), fn, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            semaphore.release()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def status(self):
+        return {
+            "executor": "process" if self.use_processes else "thread",
+            "workers": self.workers,
+            "max_concurrent": self.max_concurrent,
+            "running": self.running,
+            "queued": self.queued,
+            "completed": self.completed,
+        }
+
+g_convert_pool = WorkerPool()
+
+def read_file_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+async def fetch_media(kind, url, timeout, convert_config=None, mimetype_from_headers=True, raw=False):
+    """Download url and return its (mimetype, base64 data), or its (mimetype, bytes) if raw.
+
+    Known URLs are revalidated with If-None-Match/If-Modified-Since and downloaded content is
+    looked up by hash, so unchanged media isn't downloaded or converted again.
+    """
+    validators = g_media_cache.url_validators(url)
+    headers = {}
+    if validators is not None:
+        if validators['etag']:
+            headers['If-None-Match'] = validators['etag']
+        if validators['last_modified']:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    async with g_http_pool.session().get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+        if response.status == 304 and validators is not None:
+            cached = await g_media_cache.get(validators['key'])
+            if cached is not None:
+                g_media_cache.stats['revalidated'] += 1
+                return cached
+            content = None
+        else:
+            response.raise_for_status()
+            content = await response.read()
+            response_headers = response.headers
+
+    if content is None:
+        # not modified but no longer cached, download it again
+        g_media_cache.forget_url(url)
+        return await fetch_media(kind, url, timeout, convert_config, mimetype_from_headers, raw)
+
+    mimetype = get_file_mime_type(get_filename(url))
+    if mimetype_from_headers and 'Content-Type' in response_headers:
+        mimetype = response_headers['Content-Type']
+    key = media_key(kind, hashlib.sha256(content).hexdigest(), mimetype)
+    value = await g_media_cache.get(key)
+    if value is None:
+        if raw:
+            value = (mimetype, content)
+        else:
+            value = await g_convert_pool.run(encode_media, content, mimetype, convert_config)
+        await g_media_cache.put(key, value)
+    g_media_cache.put_url(url, response_headers, key)
+    return value
+
+async def read_media(kind, path, convert_config=None):
+    """Read local file and return its (mimetype, base64 data), cached by path, size and modified time"""
+    stat = os.stat(path)
+    mimetype = get_file_mime_type(get_filename(path))
+    key = media_key(kind, f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}", mimetype)
+    value = await g_media_cache.get(key)
+    if value is None:
+        content = await asyncio.to_thread(read_file_bytes, path)
+        value = await g_convert_pool.run(encode_media, content, mimetype, convert_config)
+        await g_media_cache.put(key, value)
+    return value
+
+async def process_image_url(image_url, timeout):
+    url = image_url['url']
+    if isinstance(url, MediaPayload):
+        return # already resolved, e.g. by a previous provider
+    if is_url(url):
+        _log("Downloading image: %s", url)
+        # convert/resize image if needed
+        mimetype, data = await fetch_media('image', url, timeout, convert_config=image_convert_config())
+        image_url['url'] = MediaPayload(mimetype, base64_data=data)
+    elif is_file_path(url):
+        _log("Reading image: %s", url)
+        mimetype, data = await read_media('image', url, convert_config=image_convert_config())
+        image_url['url'] = MediaPayload(mimetype, base64_data=data)
+    elif url.startswith('data:'):
+        # Extract existing data URI and process it
+        if ';base64,' in url:
+            payload = MediaPayload.from_data_uri(url, default_mimetype='image/png')
+            convert_config = image_convert_config()
+            if image_within_limits(payload, convert_config):
+                # already within limits, send data uri as-is without decoding or copying it
+                image_url['url'] = payload
+                return
+            base64_data = url[payload.offset:]
+            key = media_key('image', hashlib.sha256(base64_data.encode('utf-8')).hexdigest(), payload.mimetype)
+            value = await g_media_cache.get(key)
+            if value is None:
+                # convert/resize image if needed
+                value = await g_convert_pool.run(decode_encode_media, base64_data, payload.mimetype, convert_config)
+                await g_media_cache.put(key, value)
+            # update data uri with potentially converted image
+            mimetype, data = value
+            image_url['url'] = MediaPayload(mimetype, base64_data=data)
+    else:
+        raise Exception(f"Invalid image: {url}")
+
+async def process_input_audio(input_audio, timeout):
+    url = input_audio['data']
+    if isinstance(url, MediaPayload):
+        return
+    if is_url(url):
+        _log("Downloading audio: %s", url)
+        mimetype, data = await fetch_media('audio', url, timeout, raw=True)
+        input_audio['data'] = MediaPayload(mimetype, data=data, data_uri=False)
+        input_audio['format'] = mimetype.rsplit('/',1)[1]
+    elif is_file_path(url):
+        _log("Reading audio: %s", url)
+        # streamed from the file when the request is sent
+        mimetype = get_file_mime_type(get_filename(url))
+        input_audio['data'] = MediaPayload.from_file(url, mimetype, data_uri=False)
+        input_audio['format'] = mimetype.rsplit('/',1)[1]
+    elif is_base_64(url):
+        pass # use base64 data as-is
+    else:
+        raise Exception(f"Invalid audio: {url}")
+
+async def process_file(file, timeout):
+    url = file['file_data']
+    if isinstance(url, MediaPayload):
+        return
+    if is_url(url):
+        _log("Downloading file: %s", url)
+        mimetype, data = await fetch_media('file', url, timeout, mimetype_from_headers=False, raw=True)
+        file['filename'] = get_filename(url)
+        file['file_data'] = MediaPayload(mimetype, data=data)
+    elif is_file_path(url):
+        _log("Reading file: %s", url)
+        file['filename'] = get_filename(url)
+        file['file_data'] = MediaPayload.from_file(url, get_file_mime_type(get_filename(url)))
+    elif url.startswith('data:'):
+        if 'filename' not in file:
+            file['filename'] = 'file'
+        if ';base64,' in url:
+            file['file_data'] = MediaPayload.from_data_uri(url) # use base64 data as-is
+    else:
+        raise Exception(f"Invalid file: {url}")
+
 async def process_chat(chat):
+    """Resolve all image, audio and file items in chat to inline MediaPayloads, serialized when the request is sent.
+
+    Items are downloaded/read concurrently (bounded by media.concurrency, each limited to
+    media.timeout seconds) and updated in place so they keep their original positions.
+    """
     if not chat:
         raise Exception("No chat provided")
     if 'stream' not in chat:
@@ -296,106 +1017,46 @@ async def process_chat(chat):
     if 'messages' not in chat:
         return chat
 
-    async with aiohttp.ClientSession() as session:
-        for message in chat['messages']:
-            if 'content' not in message:
-                continue
+    media_config = g_config.get('media', {}) if g_config else {}
+    timeout = float(media_config.get('timeout', 120))
 
-            if isinstance(message['content'], list):
-                for item in message['content']:
-                    if 'type' not in item:
-                        continue
-                    if item['type'] == 'image_url' and 'image_url' in item:
-                        image_url = item['image_url']
-                        if 'url' in image_url:
-                            url = image_url['url']
-                            if is_url(url):
-                                _log(f"Downloading image: {url}")
-                                async with session.get(url, timeout=aiohttp.ClientTimeout(total=120)) as response:
-                                    response.raise_for_status()
-                                    content = await response.read()
-                                    # get mimetype from response headers
-                                    mimetype = get_file_mime_type(get_filename(url))
-                                    if 'Content-Type' in response.headers:
-                                        mimetype = response.headers['Content-Type']
-                                    # convert/resize image if needed
-                                    content, mimetype = convert_image_if_needed(content, mimetype)
-                                    # convert to data uri
-                                    image_url['url'] = f"data:{mimetype};base64,{base64.b64encode(content).decode('utf-8')}"
-                            elif is_file_path(url):
-                                _log(f"Reading image: {url}")
-                                with open(url, "rb") as f:
-                                    content = f.read()
-                                    # get mimetype from file extension
-                                    mimetype = get_file_mime_type(get_filename(url))
-                                    # convert/resize image if needed
-                                    content, mimetype = convert_image_if_needed(content, mimetype)
-                                    # convert to data uri
-                                    image_url['url'] = f"data:{mimetype};base64,{base64.b64encode(content).decode('utf-8')}"
-                            elif url.startswith('data:'):
-                                # Extract existing data URI and process it
-                                if ';base64,' in url:
-                                    prefix = url.split(';base64,')[0]
-                                    mimetype = prefix.split(':')[1] if ':' in prefix else 'image/png'
-                                    base64_data = url.split(';base64,')[1]
-                                    content = base64.b64decode(base64_data)
-                                    # convert/resize image if needed
-                                    content, mimetype = convert_image_if_needed(content, mimetype)
-                                    # update data uri with potentially converted image
-                                    image_url['url'] = f"data:{mimetype};base64,{base64.b64encode(content).decode('utf-8')}"
-                            else:
-                                raise Exception(f"Invalid image: {url}")
-                    elif item['type'] == 'input_audio' and 'input_audio' in item:
-                        input_audio = item['input_audio']
-                        if 'data' in input_audio:
-                            url = input_audio['data']
-                            mimetype = get_file_mime_type(get_filename(url))
-                            if is_url(url):
-                                _log(f"Downloading audio: {url}")
-                                async with session.get(url, timeout=aiohttp.ClientTimeout(total=120)) as response:
-                                    response.raise_for_status()
-                                    content = await response.read()
-                                    # get mimetype from response headers
-                                    if 'Content-Type' in response.headers:
-                                        mimetype = response.headers['Content-Type']
-                                    # convert to base64
-                                    input_audio['data'] = base64.b64encode(content).decode('utf-8')
-                                    input_audio['format'] = mimetype.rsplit('/',1)[1]
-                            elif is_file_path(url):
-                                _log(f"Reading audio: {url}")
-                                with open(url, "rb") as f:
-                                    content = f.read()
-                                    # convert to base64
-                                    input_audio['data'] = base64.b64encode(content).decode('utf-8')
-                                    input_audio['format'] = mimetype.rsplit('/',1)[1]
-                            elif is_base_64(url):
-                                pass # use base64 data as-is
-                            else:
-                                raise Exception(f"Invalid audio: {url}")
-                    elif item['type'] == 'file' and 'file' in item:
-                        file = item['file']
-                        if 'file_data' in file:
-                            url = file['file_data']
-                            mimetype = get_file_mime_type(get_filename(url))
-                            if is_url(url):
-                                _log(f"Downloading file: {url}")
-                                async with session.get(url, timeout=aiohttp.ClientTimeout(total=120)) as response:
-                                    response.raise_for_status()
-                                    content = await response.read()
-                                    file['filename'] = get_filename(url)
-                                    file['file_data'] = f"data:{mimetype};base64,{base64.b64encode(content).decode('utf-8')}"
-                            elif is_file_path(url):
-                                _log(f"Reading file: {url}")
-                                with open(url, "rb") as f:
-                                    content = f.read()
-                                    file['filename'] = get_filename(url)
-                                    file['file_data'] = f"data:{mimetype};base64,{base64.b64encode(content).decode('utf-8')}"
-                            elif url.startswith('data:'):
-                                if 'filename' not in file:
-                                    file['filename'] = 'file' 
-                                pass # use base64 data as-is
-                            else:
-                                raise Exception(f"Invalid file: {url}")
+    # collect (processor, item) pairs for every media item in the chat
+    jobs = []
+    for message in chat['messages']:
+        if 'content' not in message:
+            continue
+
+        if isinstance(message['content'], list):
+            for item in message['content']:
+                if 'type' not in item:
+                    continue
+                if item['type'] == 'image_url' and 'image_url' in item:
+                    if 'url' in item['image_url']:
+                        jobs.append((process_image_url, item['image_url']))
+                elif item['type'] == 'input_audio' and 'input_audio' in item:
+                    if 'data' in item['input_audio']:
+                        jobs.append((process_input_audio, item['input_audio']))
+                elif item['type'] == 'file' and 'file' in item:
+                    if 'file_data' in item['file']:
+                        jobs.append((process_file, item['file']))
+
+    if len(jobs) == 0:
+        return chat
+
+    semaphore = asyncio.Semaphore(max(1, int(media_config.get('concurrency', 8))))
+    async def run_job(process, item):
+        async with semaphore:
+            await asyncio.wait_for(process(item, timeout), timeout=timeout)
+
+    tasks = [asyncio.ensure_future(run_job(process, item)) for process, item in jobs]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # fail fast, don't leave the remaining downloads running
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
     return chat
 
 class HTTPError(Exception):
@@ -407,18 +1068,272 @@ class HTTPError(Exception):
         super().__init__(f"HTTP {status} {reason}")
 
 async def response_json(response):
-    text = await response.text()
+    data = await response.read()
     if response.status >= 400:
+        text = data.decode(response.get_encoding(), errors='replace')
         raise HTTPError(response.status, reason=response.reason, body=text, headers=dict(response.headers))
     response.raise_for_status()
-    body = json.loads(text)
+    body = g_json.loads(data)
     return body
 
+# Gemini finishReason -> OpenAI finish_reason
+GEMINI_FINISH_REASONS = {
+    "STOP": "stop",
+    "MAX_TOKENS": "length",
+    "SAFETY": "content_filter",
+    "RECITATION": "content_filter",
+    "BLOCKLIST": "content_filter",
+    "PROHIBITED_CONTENT": "content_filter",
+    "SPII": "content_filter",
+}
+
+class HttpPool:
+    """Long-lived aiohttp connection pool, configured from the `http` config block.
+
+    The ClientSession is created lazily on first use so it's bound to the event loop that uses it
+    (the CLI and server each run their own loop), and re-created if the loop changes or it was closed.
+    """
+    def __init__(self, http_config=None):
+        self.config = http_config or {}
+        self.timeout = aiohttp.ClientTimeout(total=float(self.config.get('timeout', 120)))
+        self._session = None
+        self._loop = None
+
+    def session(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=int(self.config.get('limit', 0)),
+                limit_per_host=int(self.config.get('limit_per_host', 0)),
+                keepalive_timeout=float(self.config.get('keepalive_timeout', 60)),
+                use_dns_cache=True,
+                ttl_dns_cache=int(self.config.get('ttl_dns_cache', 300)),
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._loop = loop
+        return self._session
+
+    async def warmup(self, url, headers=None):
+        """Pre-open `warmup` (true=1) keep-alive connections to url's host"""
+        count = self.config.get('warmup', False)
+        count = 1 if count is True else int(count or 0)
+        if count <= 0:
+            return
+        session = self.session()
+        async def ping():
+            async with session.head(url, headers=headers, allow_redirects=False, timeout=aiohttp.ClientTimeout(total=10)) as res:
+                await res.read()
+        results = await asyncio.gather(*[ping() for _ in range(count)], return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        _log(f"Warmed up {count - len(errors)}/{count} connections to {url}" + (f" ({errors[0]})" if errors else ""))
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+# Shared pool for downloading media and config files
+g_http_pool = HttpPool()
+# Pools and providers replaced on reload, closed once in-flight requests have had time to complete: {resource: close_task}
+g_retired_pools = {}
+
+def retire(resource, loop, timeout):
+    """Close() a replaced resource bound to loop after timeout seconds so in-flight requests aren't cut off"""
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    if loop is not running_loop:
+        return
+    async def close_later():
+        await asyncio.sleep(timeout or 0)
+        g_retired_pools.pop(resource, None)
+        await resource.close()
+    g_retired_pools[resource] = running_loop.create_task(close_later())
+
+def retire_pool(pool):
+    """Close a replaced pool after its request timeout"""
+    if pool._session is None or pool._session.closed:
+        return
+    retire(pool, pool._loop, pool.timeout.total)
+
+def retire_provider(provider):
+    """Close a replaced provider's pool, and its SDK client if it has one, after its request timeout"""
+    client_loop = getattr(provider, '_client_loop', None)
+    if getattr(provider, '_client', None) is None or client_loop is None:
+        retire_pool(provider.pool)
+        return
+    # provider.close() closes its pool too
+    retire(provider, client_loop, provider.pool.timeout.total)
+
+class RateLimitExceeded(Exception):
+    pass
+
+class TokenBucket:
+    """Requests or tokens per minute budget, refilled continuously"""
+    def __init__(self, per_minute):
+        self.limit = per_minute
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        self.refill()
+        amount = min(amount, self.capacity)
+        return 0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def sync(self, limit, remaining, reset):
+        """Adopt the provider's view of the budget from its rate limit headers"""
+        self.refill()
+        if limit:
+            # never exceed a configured limit
+            self.capacity = float(min(limit, self.limit) if self.limit else limit)
+            self.rate = self.capacity / 60
+            if reset and reset > 0 and self.capacity > remaining:
+                # the budget is fully replenished after reset seconds
+                self.rate = (self.capacity - remaining) / reset
+        self.tokens = min(self.capacity, float(remaining))
+
+class RateLimiter:
+    """Client-side requests (rpm) and tokens (tpm) per minute limits of a provider, configured from the
+    `rate_limit` config block which can be overridden per provider and per model.
+
+    Requests wait in order until their estimated tokens fit in the provider's and model's buckets, or fail
+    with RateLimitExceeded when that would take more than max_wait seconds. Estimates are corrected with
+    the actual usage of the response, and when adaptive the model buckets are synced with the
+    x-ratelimit-limit/remaining/reset-{requests,tokens} headers of OpenAI compatible providers.
+    """
+    def __init__(self, rate_limit_config=None):
+        self.config = rate_limit_config or {}
+        self.max_wait = float(self.config.get('max_wait', 30))
+        self.adaptive = bool(self.config.get('adaptive', True))
+        self.buckets = {None: self.create_buckets(self.config)}
+        for model, model_config in self.config.get('models', {}).items():
+            self.buckets[model] = self.create_buckets(model_config)
+        self.locks = {}
+
+    def create_buckets(self, config):
+        buckets = {}
+        if config.get('rpm'):
+            buckets['requests'] = TokenBucket(config['rpm'])
+        if config.get('tpm'):
+            buckets['tokens'] = TokenBucket(config['tpm'])
+        return buckets
+
+    def model_buckets(self, model):
+        return [(kind, bucket) for buckets in (self.buckets[None], self.buckets.get(model, {})) for kind, bucket in buckets.items()]
+
+    def tracks_tokens(self, model):
+        return 'tokens' in self.buckets[None] or 'tokens' in self.buckets.get(model, {})
+
+    async def acquire(self, model, tokens):
+        if not self.buckets[None] and model not in self.buckets:
+            return
+        deadline = time.monotonic() + self.max_wait
+        lock = self.locks.setdefault(model, asyncio.Lock())
+        try:
+            await asyncio.wait_for(lock.acquire(), self.max_wait)
+        except asyncio.TimeoutError:
+            raise RateLimitExceeded(f"Rate limit queue for {model} is full, waited {self.max_wait}s") from None
+        try:
+            while True:
+                buckets = self.model_buckets(model)
+                wait = max((bucket.wait_time(1 if kind == 'requests' else tokens) for kind, bucket in buckets), default=0)
+                if wait <= 0:
+                    for kind, bucket in buckets:
+                        bucket.take(1 if kind == 'requests' else tokens)
+                    return
+                if time.monotonic() + wait > deadline:
+                    raise RateLimitExceeded(f"Rate limit for {model} exceeded, next request allowed in {wait:.1f}s")
+                _log("Rate limited %s, waiting %.2fs", model, wait)
+                await asyncio.sleep(wait)
+        finally:
+            lock.release()
+
+    def settle(self, model, estimated, usage):
+        """Correct the estimated tokens taken by a request with its actual usage"""
+        if not usage or not usage.get('total_tokens'):
+            return
+        for kind, bucket in self.model_buckets(model):
+            if kind == 'tokens':
+                bucket.tokens = min(bucket.capacity, bucket.tokens + min(estimated, bucket.capacity) - usage['total_tokens'])
+
+    def update(self, model, headers):
+        if not self.adaptive or headers is None:
+            return
+        for kind in ('requests', 'tokens'):
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            if remaining is None:
+                continue
+            try:
+                remaining = float(remaining)
+                limit = float(headers.get(f'x-ratelimit-limit-{kind}') or 0)
+            except ValueError:
+                continue
+            reset = headers.get(f'x-ratelimit-reset-{kind}')
+            buckets = self.buckets.setdefault(model, {})
+            if kind not in buckets:
+                if not limit:
+                    continue
+                buckets[kind] = TokenBucket(0)
+            buckets[kind].sync(limit, remaining, parse_duration(reset) if reset else None)
+
+    async def track_stream(self, model, estimated, generator):
+        """Settle a streamed response with the usage reported in its final chunk"""
+        usage = None
+        try:
+            async for chunk in generator:
+                if chunk.get('usage'):
+                    usage = chunk['usage']
+                yield chunk
+        finally:
+            await generator.aclose()
+            self.settle(model, estimated, usage)
+
+    def status(self):
+        ret = {}
+        for model, buckets in self.buckets.items():
+            for kind, bucket in buckets.items():
+                bucket.refill()
+                ret.setdefault(model or '*', {})[kind] = {
+                    "limit": round(bucket.capacity),
+                    "remaining": round(bucket.tokens),
+                }
+        return ret
+
+def estimate_tokens(chat):
+    """Rough token count of a chat request for rate limiting, ~4 characters per token plus its max output tokens"""
+    chars = 0
+    media = 0
+    for message in chat.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for item in content:
+                if item.get('type') == 'text':
+                    chars += len(item.get('text', ''))
+                else:
+                    media += 1
+    return chars // 4 + media * 1000 + int(chat.get('max_completion_tokens') or chat.get('max_tokens') or 0)
+
 class OpenAiProvider:
     def __init__(self, base_url, api_key=None, models={}, **kwargs):
         self.base_url = base_url.strip("/")
         self.api_key = api_key
         self.models = models
+        self.pool = HttpPool(kwargs.get('http'))
+        self.limiter = RateLimiter(kwargs.get('rate_limit'))
 
         # check if base_url ends with /v{\d} to handle providers with different versions (e.g. z.ai uses /v4)
         last_segment = base_url.rsplit('/',1)[1]
@@ -462,6 +1377,12 @@ class OpenAiProvider:
     async def load(self):
         pass
 
+    async def warmup(self):
+        await self.pool.warmup(self.base_url, headers=self.headers)
+
+    async def close(self):
+        await self.pool.close()
+
     def model_pricing(self, model):
         provider_model = self.provider_model(model) or model
         if self.pricing and provider_model in self.pricing:
@@ -481,7 +1402,7 @@ class OpenAiProvider:
             pricing = self.model_pricing(chat['model'])
             if pricing and 'input' in pricing and 'output' in pricing:
                 response['metadata']['pricing'] = f"{pricing['input']}/{pricing['output']}"
-        _log(json.dumps(response, indent=2))
+        _log(format_json, response)
         return response
 
     async def chat(self, chat, stream=False):
@@ -491,6 +1412,7 @@ class OpenAiProvider:
             chat: Chat completion request dict
             stream: If True, returns async generator of SSE chunks
         """
+        model = chat['model']
         chat['model'] = self.provider_model(chat['model']) or chat['model']
 
         if self.frequency_penalty is not None:
@@ -535,36 +1457,50 @@ class OpenAiProvider:
             chat['stream'] = True
 
         chat = await process_chat(chat)
-        _log(f"POST {self.chat_url} (stream={stream})")
-        _log(chat_summary(chat))
+        _log("POST %s (stream=%s)", self.chat_url, stream)
+        _log(chat_summary, chat)
         # remove metadata if any (conflicts with some providers, e.g. Z.ai)
         chat.pop('metadata', None)
 
-        async with aiohttp.ClientSession() as session:
-            started_at = time.time()
-            async with session.post(self.chat_url, headers=self.headers, data=json.dumps(chat), timeout=aiohttp.ClientTimeout(total=120)) as response:
-                if stream:
-                    # Return async generator for streaming
-                    async def stream_generator():
-                        """Parse SSE stream from provider"""
-                        async for line in response.content:
-                            line = line.decode('utf-8').strip()
-                            if not line:
+        session = self.pool.session()
+        started_at = time.time()
+        if stream:
+            body = JsonBody(chat)
+            response = await session.post(self.chat_url, headers=body.headers(self.headers), data=body.data(), timeout=self.pool.timeout)
+            self.limiter.update(model, response.headers)
+            if response.status >= 400:
+                try:
+                    await response_json(response)
+                finally:
+                    response.release()
+
+            # Return async generator for streaming, which owns the response until it's exhausted or closed
+            async def stream_generator():
+                """Parse SSE stream from provider"""
+                try:
+                    async for line in response.content:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        if line.startswith(b'data: '):
+                            data = line[6:]
+                            if data == b'[DONE]':
+                                break
+                            try:
+                                chunk = g_json.loads(data)
+                                yield chunk
+                            except json.JSONDecodeError:
+                                _log(f"Failed to parse SSE chunk: {data}")
                                 continue
-                            if line.startswith('data: '):
-                                data = line[6:]
-                                if data == '[DONE]':
-                                    break
-                                try:
-                                    chunk = json.loads(data)
-                                    yield chunk
-                                except json.JSONDecodeError:
-                                    _log(f"Failed to parse SSE chunk: {data}")
-                                    continue
-                    
-                    return stream_generator()
-                else:
-                    return self.to_response(await response_json(response), chat, started_at)
+                finally:
+                    response.release()
+
+            return stream_generator()
+        else:
+            body = JsonBody(chat)
+            async with session.post(self.chat_url, headers=body.headers(self.headers), data=body.data(), timeout=self.pool.timeout) as response:
+                self.limiter.update(model, response.headers)
+                return self.to_response(await response_json(response), chat, started_at)
 
 class OllamaProvider(OpenAiProvider):
     def __init__(self, base_url, models, all_models=False, **kwargs):
@@ -578,16 +1514,15 @@ class OllamaProvider(OpenAiProvider):
     async def get_models(self):
         ret = {}
         try:
-            async with aiohttp.ClientSession() as session:
-                _log(f"GET {self.base_url}/api/tags")
-                async with session.get(f"{self.base_url}/api/tags", headers=self.headers, timeout=aiohttp.ClientTimeout(total=120)) as response:
-                    data = await response_json(response)
-                    for model in data.get('models', []):
-                        name = model['model']
-                        if name.endswith(":latest"):
-                            name = name[:-7]
-                        ret[name] = name
-                    _log(f"Loaded Ollama models: {ret}")
+            _log(f"GET {self.base_url}/api/tags")
+            async with self.pool.session().get(f"{self.base_url}/api/tags", headers=self.headers, timeout=self.pool.timeout) as response:
+                data = await response_json(response)
+                for model in data.get('models', []):
+                    name = model['model']
+                    if name.endswith(":latest"):
+                        name = name[:-7]
+                    ret[name] = name
+                _log(f"Loaded Ollama models: {ret}")
         except Exception as e:
             _log(f"Error getting Ollama models: {e}")
             # return empty dict if ollama is not available
@@ -613,9 +1548,87 @@ class GoogleOpenAiProvider(OpenAiProvider):
     def test(cls, api_key=None, models={}, **kwargs):
         return api_key and len(models) > 0
 
+def kill_process(proc):
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        pass
+
+def curl_error(returncode, stderr):
+    message = f"curl exited with code {returncode}: {stderr.decode('utf-8', 'replace').strip()}"
+    # 28 = CURLE_OPERATION_TIMEDOUT (--max-time exceeded)
+    return asyncio.TimeoutError(message) if returncode == 28 else Exception(message)
+
+def curl_args(url, timeout, stream=False):
+    # request body is piped through stdin to avoid argv size limits with large inline media
+    args = ['curl', '-sS', '-X', 'POST', '-H', 'Content-Type: application/json', '--data-binary', '@-']
+    if stream:
+        args.append('-N')
+    if timeout:
+        args.extend(['--max-time', str(int(timeout))])
+    args.append(url)
+    return args
+
+async def write_stdin(proc, body):
+    """Write a JsonBody to the process stdin chunk by chunk"""
+    try:
+        for chunk in body.chunks():
+            proc.stdin.write(chunk)
+            await proc.stdin.drain()
+        proc.stdin.close()
+    except (BrokenPipeError, ConnectionResetError):
+        pass # curl exited early, its exit code reports why
+
+async def curl_post(url, body, timeout=120):
+    """POST a JsonBody to url with curl in a non-blocking subprocess and return its stdout.
+
+    The curl process is killed if the request times out or the calling task is cancelled.
+    """
+    proc = await asyncio.create_subprocess_exec(*curl_args(url, timeout),
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    async def communicate():
+        _, stdout, stderr = await asyncio.gather(write_stdin(proc, body), proc.stdout.read(), proc.stderr.read())
+        await proc.wait()
+        return stdout, stderr
+    try:
+        stdout, stderr = await asyncio.wait_for(communicate(), timeout=timeout + 5 if timeout else None)
+    except BaseException:
+        kill_process(proc)
+        await proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise curl_error(proc.returncode, stderr)
+    return stdout
+
+async def curl_stream(url, body, timeout=120):
+    """Like curl_post() but yields stdout lines as they arrive, for streaming responses"""
+    proc = await asyncio.create_subprocess_exec(*curl_args(url, timeout, stream=True),
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        limit=16*1024*1024)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout + 5 if timeout else None
+    # drain stderr concurrently, curl blocks if it fills the pipe while stdout is being read
+    stderr_task = asyncio.ensure_future(proc.stderr.read())
+    try:
+        await asyncio.wait_for(write_stdin(proc, body), timeout=deadline - loop.time() if deadline else None)
+        while True:
+            line = await asyncio.wait_for(proc.stdout.readline(), timeout=deadline - loop.time() if deadline else None)
+            if not line:
+                break
+            yield line
+        await proc.wait()
+        if proc.returncode != 0:
+            raise curl_error(proc.returncode, await stderr_task)
+    finally:
+        if proc.returncode is None:
+            kill_process(proc)
+            await proc.wait()
+        # stderr reaches EOF once curl has exited
+        await asyncio.gather(stderr_task, return_exceptions=True)
+
 class GoogleProvider(OpenAiProvider):
-    def __init__(self, models, api_key, safety_settings=None, thinking_config=None, curl=False, **kwargs):
-        super().__init__(base_url="https://generativelanguage.googleapis.com", api_key=api_key, models=models, **kwargs)
+    def __init__(self, models, api_key, safety_settings=None, thinking_config=None, curl=False, base_url="https://generativelanguage.googleapis.com", **kwargs):
+        super().__init__(base_url=base_url, api_key=api_key, models=models, **kwargs)
         self.safety_settings = safety_settings
         self.thinking_config = thinking_config
         self.curl = curl
@@ -630,7 +1643,13 @@ class GoogleProvider(OpenAiProvider):
     def test(cls, api_key=None, models={}, **kwargs):
         return api_key is not None and len(models) > 0
 
-    async def chat(self, chat):
+    async def chat(self, chat, stream=False):
+        """Perform chat completion with optional streaming.
+
+        Args:
+            chat: Chat completion request dict
+            stream: If True, returns async generator of OpenAI-style chat.completion.chunk dicts
+        """
         chat['model'] = self.provider_model(chat['model']) or chat['model']
 
         chat = await process_chat(chat)
@@ -640,190 +1659,297 @@ class GoogleProvider(OpenAiProvider):
         contents = []
         system_prompt = None
 
-        async with aiohttp.ClientSession() as session:
-            for message in chat['messages']:
-                if message['role'] == 'system':
-                    content = message['content']
-                    if isinstance(content, list):
-                        for item in content:
-                            if 'text' in item:
-                                system_prompt = item['text']
-                                break
-                    elif isinstance(content, str):
-                        system_prompt = content
-                elif 'content' in message:
-                    if isinstance(message['content'], list):
-                        parts = []
-                        for item in message['content']:
-                            if 'type' in item:
-                                if item['type'] == 'image_url' and 'image_url' in item:
-                                    image_url = item['image_url']
-                                    if 'url' not in image_url:
-                                        continue
-                                    url = image_url['url']
+        for message in chat['messages']:
+            if message['role'] == 'system':
+                content = message['content']
+                if isinstance(content, list):
+                    for item in content:
+                        if 'text' in item:
+                            system_prompt = item['text']
+                            break
+                elif isinstance(content, str):
+                    system_prompt = content
+            elif 'content' in message:
+                if isinstance(message['content'], list):
+                    parts = []
+                    for item in message['content']:
+                        if 'type' in item:
+                            if item['type'] == 'image_url' and 'image_url' in item:
+                                image_url = item['image_url']
+                                if 'url' not in image_url:
+                                    continue
+                                url = image_url['url']
+                                if not isinstance(url, MediaPayload):
                                     if not url.startswith('data:'):
                                         raise(Exception("Image was not downloaded: " + url))
-                                    # Extract mime type from data uri
-                                    mimetype = url.split(';',1)[0].split(':',1)[1] if ';' in url else "image/png"
-                                    base64Data = url.split(',',1)[1]
-                                    parts.append({
-                                        "inline_data": {
-                                            "mime_type": mimetype,
-                                            "data": base64Data
-                                        }
-                                    })
-                                elif item['type'] == 'input_audio' and 'input_audio' in item:
-                                    input_audio = item['input_audio']
-                                    if 'data' not in input_audio:
-                                        continue
-                                    data = input_audio['data']
-                                    format = input_audio['format']
-                                    mimetype = f"audio/{format}"
-                                    parts.append({
-                                        "inline_data": {
-                                            "mime_type": mimetype,
-                                            "data": data
-                                        }
-                                    })
-                                elif item['type'] == 'file' and 'file' in item:
-                                    file = item['file']
-                                    if 'file_data' not in file:
-                                        continue
-                                    data = file['file_data']
+                                    url = MediaPayload.from_data_uri(url, default_mimetype="image/png")
+                                # reference the base64 content, it's streamed without the data uri prefix
+                                parts.append({
+                                    "inline_data": {
+                                        "mime_type": url.mimetype,
+                                        "data": url.with_data_uri(False)
+                                    }
+                                })
+                            elif item['type'] == 'input_audio' and 'input_audio' in item:
+                                input_audio = item['input_audio']
+                                if 'data' not in input_audio:
+                                    continue
+                                data = input_audio['data']
+                                format = input_audio['format']
+                                mimetype = f"audio/{format}"
+                                parts.append({
+                                    "inline_data": {
+                                        "mime_type": mimetype,
+                                        "data": data
+                                    }
+                                })
+                            elif item['type'] == 'file' and 'file' in item:
+                                file = item['file']
+                                if 'file_data' not in file:
+                                    continue
+                                data = file['file_data']
+                                if not isinstance(data, MediaPayload):
                                     if not data.startswith('data:'):
                                         raise(Exception("File was not downloaded: " + data))
-                                    # Extract mime type from data uri
-                                    mimetype = data.split(';',1)[0].split(':',1)[1] if ';' in data else "application/octet-stream"
-                                    base64Data = data.split(',',1)[1]
-                                    parts.append({
-                                        "inline_data": {
-                                            "mime_type": mimetype,
-                                            "data": base64Data
-                                        }
-                                    })
-                            if 'text' in item:
-                                text = item['text']
-                                parts.append({"text": text})
-                        if len(parts) > 0:
-                            contents.append({
-                                "role": message['role'] if 'role' in message and message['role'] == 'user' else 'model',
-                                "parts": parts
-                            })
-                    else:
-                        content = message['content']
+                                    data = MediaPayload.from_data_uri(data)
+                                parts.append({
+                                    "inline_data": {
+                                        "mime_type": data.mimetype,
+                                        "data": data.with_data_uri(False)
+                                    }
+                                })
+                        if 'text' in item:
+                            text = item['text']
+                            parts.append({"text": text})
+                    if len(parts) > 0:
                         contents.append({
-                                "role": message['role'] if 'role' in message and message['role'] == 'user' else 'model',
-                            "parts": [{"text": content}]
+                            "role": message['role'] if 'role' in message and message['role'] == 'user' else 'model',
+                            "parts": parts
                         })
+                else:
+                    content = message['content']
+                    contents.append({
+                            "role": message['role'] if 'role' in message and message['role'] == 'user' else 'model',
+                        "parts": [{"text": content}]
+                    })
 
-            gemini_chat = {
-                "contents": contents,
+        gemini_chat = {
+            "contents": contents,
+        }
+
+        if self.safety_settings:
+            gemini_chat['safetySettings'] = self.safety_settings
+
+        # Add system instruction if present
+        if system_prompt is not None:
+            gemini_chat['systemInstruction'] = {
+                "parts": [{"text": system_prompt}]
             }
 
-            if self.safety_settings:
-                gemini_chat['safetySettings'] = self.safety_settings
+        if 'max_completion_tokens' in chat:
+            generationConfig['maxOutputTokens'] = chat['max_completion_tokens']
+        if 'stop' in chat:
+            generationConfig['stopSequences'] = [chat['stop']]
+        if 'temperature' in chat:
+            generationConfig['temperature'] = chat['temperature']
+        if 'top_p' in chat:
+            generationConfig['topP'] = chat['top_p']
+        if 'top_logprobs' in chat:
+            generationConfig['topK'] = chat['top_logprobs']
+
+        if 'thinkingConfig' in chat:
+            generationConfig['thinkingConfig'] = chat['thinkingConfig']
+        elif self.thinking_config:
+            generationConfig['thinkingConfig'] = self.thinking_config
+
+        if len(generationConfig) > 0:
+            gemini_chat['generationConfig'] = generationConfig
 
-            # Add system instruction if present
-            if system_prompt is not None:
-                gemini_chat['systemInstruction'] = {
-                    "parts": [{"text": system_prompt}]
-                }
+        if stream:
+            return await self.stream_chat(gemini_chat, chat)
 
-            if 'max_completion_tokens' in chat:
-                generationConfig['maxOutputTokens'] = chat['max_completion_tokens']
-            if 'stop' in chat:
-                generationConfig['stopSequences'] = [chat['stop']]
-            if 'temperature' in chat:
-                generationConfig['temperature'] = chat['temperature']
-            if 'top_p' in chat:
-                generationConfig['topP'] = chat['top_p']
-            if 'top_logprobs' in chat:
-                generationConfig['topK'] = chat['top_logprobs']
-
-            if 'thinkingConfig' in chat:
-                generationConfig['thinkingConfig'] = chat['thinkingConfig']
-            elif self.thinking_config:
-                generationConfig['thinkingConfig'] = self.thinking_config
-
-            if len(generationConfig) > 0:
-                gemini_chat['generationConfig'] = generationConfig
-
-            started_at = int(time.time() * 1000)
-            gemini_chat_url = f"https://generativelanguage.googleapis.com/v1beta/models/{chat['model']}:generateContent?key={self.api_key}"
-
-            _log(f"POST {gemini_chat_url}")
-            _log(gemini_chat_summary(gemini_chat))
-            started_at = time.time()
-
-            if self.curl:
-                curl_args = [
-                    'curl',
-                    '-X', 'POST',
-                    '-H', 'Content-Type: application/json',
-                    '-d', json.dumps(gemini_chat),
-                    gemini_chat_url
-                ]
-                try:
-                    o = subprocess.run(curl_args, check=True, capture_output=True, text=True, timeout=120)
-                    obj = json.loads(o.stdout)
-                except Exception as e:
-                    raise Exception(f"Error executing curl: {e}")
-            else:
-                async with session.post(gemini_chat_url, headers=self.headers, data=json.dumps(gemini_chat), timeout=aiohttp.ClientTimeout(total=120)) as res:
-                    obj = await response_json(res)
-                    _log(f"google response:\n{json.dumps(obj, indent=2)}")
-
-            response = {
-                "id": f"chatcmpl-{started_at}",
-                "created": started_at,
-                "model": obj.get('modelVersion', chat['model']),
+        started_at = int(time.time() * 1000)
+        gemini_chat_url = f"{self.base_url}/v1beta/models/{chat['model']}:generateContent?key={self.api_key}"
+
+        _log("POST %s", gemini_chat_url)
+        _log(gemini_chat_summary, gemini_chat)
+        started_at = time.time()
+
+        if self.curl:
+            try:
+                stdout = await curl_post(gemini_chat_url, JsonBody(gemini_chat), timeout=self.pool.timeout.total)
+                obj = g_json.loads(stdout)
+            except asyncio.TimeoutError:
+                raise
+            except Exception as e:
+                raise Exception(f"Error executing curl: {e}")
+        else:
+            body = JsonBody(gemini_chat)
+            async with self.pool.session().post(gemini_chat_url, headers=body.headers(self.headers), data=body.data(), timeout=self.pool.timeout) as res:
+                obj = await response_json(res)
+                _log(lambda: f"google response:\n{format_json(obj)}")
+
+        response = {
+            "id": f"chatcmpl-{started_at}",
+            "created": started_at,
+            "model": obj.get('modelVersion', chat['model']),
+        }
+        choices = []
+        i = 0
+        if 'error' in obj:
+            _log(f"Error: {obj['error']}")
+            raise Exception(obj['error']['message'])
+        for candidate in obj['candidates']:
+            role = "assistant"
+            if 'content' in candidate and 'role' in candidate['content']:
+                role = "assistant" if candidate['content']['role'] == 'model' else candidate['content']['role']
+
+            # Safely extract content from all text parts
+            content = ""
+            reasoning = ""
+            if 'content' in candidate and 'parts' in candidate['content']:
+                text_parts = []
+                reasoning_parts = []
+                for part in candidate['content']['parts']:
+                    if 'text' in part:
+                        if 'thought' in part and part['thought']:
+                            reasoning_parts.append(part['text'])
+                        else:
+                            text_parts.append(part['text'])
+                content = ' '.join(text_parts)
+                reasoning = ' '.join(reasoning_parts)
+
+            choice = {
+                "index": i,
+                "finish_reason": candidate.get('finishReason', 'stop'),
+                "message": {
+                    "role": role,
+                    "content": content,
+                },
             }
-            choices = []
-            i = 0
-            if 'error' in obj:
-                _log(f"Error: {obj['error']}")
-                raise Exception(obj['error']['message'])
-            for candidate in obj['candidates']:
-                role = "assistant"
-                if 'content' in candidate and 'role' in candidate['content']:
-                    role = "assistant" if candidate['content']['role'] == 'model' else candidate['content']['role']
-
-                # Safely extract content from all text parts
+            if reasoning:
+                choice['message']['reasoning'] = reasoning
+            choices.append(choice)
+            i += 1
+        response['choices'] = choices
+        if 'usageMetadata' in obj:
+            usage = obj['usageMetadata']
+            response['usage'] = {
+                "completion_tokens": usage['candidatesTokenCount'],
+                "total_tokens": usage['totalTokenCount'],
+                "prompt_tokens": usage['promptTokenCount'],
+            }
+        return self.to_response(response, chat, started_at)
+
+    async def stream_chat(self, gemini_chat, chat):
+        """Stream a Gemini request via streamGenerateContent and translate each SSE event into a chat.completion.chunk"""
+        gemini_chat_url = f"{self.base_url}/v1beta/models/{chat['model']}:streamGenerateContent?alt=sse&key={self.api_key}"
+
+        _log("POST %s", gemini_chat_url)
+        _log(gemini_chat_summary, gemini_chat)
+        started_at = time.time()
+
+        if self.curl:
+            res = None
+            lines = curl_stream(gemini_chat_url, JsonBody(gemini_chat), timeout=self.pool.timeout.total)
+        else:
+            body = JsonBody(gemini_chat)
+            res = await self.pool.session().post(gemini_chat_url, headers=body.headers(self.headers), data=body.data(), timeout=self.pool.timeout)
+            if res.status >= 400:
+                try:
+                    await response_json(res)
+                finally:
+                    res.release()
+            lines = res.content
+
+        async def stream_generator():
+            # curl doesn't fail on HTTP errors, collect any non-SSE output to report the error body
+            other_lines = []
+            yielded = False
+            try:
+                async for line in lines:
+                    line = line.strip()
+                    if not line.startswith(b'data: '):
+                        if line:
+                            other_lines.append(line.decode('utf-8', errors='replace'))
+                        continue
+                    try:
+                        obj = g_json.loads(line[6:])
+                    except json.JSONDecodeError:
+                        _log(f"Failed to parse Gemini SSE chunk: {line}")
+                        continue
+                    if 'error' in obj:
+                        _log(f"Error: {obj['error']}")
+                        raise Exception(obj['error']['message'])
+                    yielded = True
+                    yield self.to_chunk(obj, chat, started_at)
+                if not yielded and other_lines:
+                    body = '\n'.join(other_lines)
+                    try:
+                        obj = json.loads(body)
+                    except json.JSONDecodeError:
+                        obj = {}
+                    if isinstance(obj, dict) and 'error' in obj:
+                        raise Exception(obj['error'].get('message', body))
+                    raise Exception(f"Invalid Gemini stream response: {body[:200]}")
+            finally:
+                if res is not None:
+                    res.release()
+                else:
+                    await lines.aclose()
+
+        return stream_generator()
+
+    def to_chunk(self, obj, chat, started_at):
+        """Convert a streamed Gemini GenerateContentResponse into an OpenAI chat.completion.chunk"""
+        chunk = {
+            "id": f"chatcmpl-{started_at}",
+            "object": "chat.completion.chunk",
+            "created": int(started_at),
+            "model": obj.get('modelVersion', chat['model']),
+        }
+        choices = []
+        for i, candidate in enumerate(obj.get('candidates', [])):
+            delta = {}
+            if 'content' in candidate:
+                if 'role' in candidate['content']:
+                    delta['role'] = "assistant" if candidate['content']['role'] == 'model' else candidate['content']['role']
                 content = ""
                 reasoning = ""
-                if 'content' in candidate and 'parts' in candidate['content']:
-                    text_parts = []
-                    reasoning_parts = []
-                    for part in candidate['content']['parts']:
-                        if 'text' in part:
-                            if 'thought' in part and part['thought']:
-                                reasoning_parts.append(part['text'])
-                            else:
-                                text_parts.append(part['text'])
-                    content = ' '.join(text_parts)
-                    reasoning = ' '.join(reasoning_parts)
-
-                choice = {
-                    "index": i,
-                    "finish_reason": candidate.get('finishReason', 'stop'),
-                    "message": {
-                        "role": role,
-                        "content": content,
-                    },
-                }
+                for part in candidate['content'].get('parts', []):
+                    if 'text' in part:
+                        if 'thought' in part and part['thought']:
+                            reasoning += part['text']
+                        else:
+                            content += part['text']
+                if content:
+                    delta['content'] = content
                 if reasoning:
-                    choice['message']['reasoning'] = reasoning
-                choices.append(choice)
-                i += 1
-            response['choices'] = choices
-            if 'usageMetadata' in obj:
-                usage = obj['usageMetadata']
-                response['usage'] = {
-                    "completion_tokens": usage['candidatesTokenCount'],
-                    "total_tokens": usage['totalTokenCount'],
-                    "prompt_tokens": usage['promptTokenCount'],
-                }
-            return self.to_response(response, chat, started_at)
+                    delta['reasoning'] = reasoning
+            finish_reason = candidate.get('finishReason')
+            choices.append({
+                "index": candidate.get('index', i),
+                "delta": delta,
+                "finish_reason": GEMINI_FINISH_REASONS.get(finish_reason, finish_reason.lower()) if finish_reason else None,
+            })
+        chunk['choices'] = choices
+        # Gemini reports cumulative usage on each event, only forward it with the final chunk
+        if 'usageMetadata' in obj and any(c['finish_reason'] for c in choices):
+            usage = obj['usageMetadata']
+            chunk['usage'] = {
+                "completion_tokens": usage.get('candidatesTokenCount', 0),
+                "total_tokens": usage.get('totalTokenCount', 0),
+                "prompt_tokens": usage.get('promptTokenCount', 0),
+            }
+        return chunk
+
+def sdk_to_dict(obj):
+    """Convert an SDK (Pydantic) response object to a plain dict, supporting both v2 .model_dump() and v1 .dict()"""
+    if isinstance(obj, dict):
+        return obj
+    if hasattr(obj, 'model_dump'):
+        return obj.model_dump()
+    return obj.dict()
 
 class AirRefineryProvider(OpenAiProvider):
     """AI Refinery provider that uses the official SDK for chat completions.
@@ -832,11 +1958,50 @@ class AirRefineryProvider(OpenAiProvider):
     is unavailable for any reason.
     """
 
+    def __init__(self, base_url, api_key=None, models={}, **kwargs):
+        super().__init__(base_url=base_url, api_key=api_key, models=models, **kwargs)
+        self._client = None
+        self._client_loop = None
+
     @classmethod
     def test(cls, base_url=None, api_key=None, models={}, **kwargs):
         # Allow provider to initialize even with empty models dict since we load dynamically
         return bool(base_url and api_key)
 
+    def sdk_client(self):
+        """Return the AsyncAIRefinery client reused for this provider's lifetime, or None if the SDK isn't available.
+
+        Like HttpPool, the client is bound to the event loop that first uses it and re-created if the loop changes.
+        """
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            try:
+                # Import locally to avoid hard-failing import at module import time
+                from air.client import AsyncAIRefinery  # type: ignore
+            except Exception as e:
+                _log(f"airefinery-sdk not available: {e}")
+                return None
+            self._client = AsyncAIRefinery(api_key=self.api_key, base_url=self.base_url)
+            self._client_loop = loop
+        return self._client
+
+    @staticmethod
+    async def close_sdk(obj, name):
+        """close() or aclose() an SDK client or stream, whichever it has"""
+        close = getattr(obj, 'close', None) or getattr(obj, 'aclose', None)
+        if close is not None:
+            try:
+                result = close()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                _log(f"Error closing AI Refinery {name}: {e}")
+
+    async def close(self):
+        client, self._client, self._client_loop = self._client, None, None
+        await self.close_sdk(client, "client")
+        await super().close()
+
     async def load(self):
         """Dynamically fetch available models from AI Refinery and merge into mapping.
 
@@ -847,13 +2012,11 @@ class AirRefineryProvider(OpenAiProvider):
         # Keep a copy of statically configured aliases/mappings
         existing = dict(self.models or {})
         try:
-            try:
-                from air.client import AsyncAIRefinery  # type: ignore
-            except Exception as e:
-                _log(f"airefinery-sdk not available for model discovery: {e}")
+            client = self.sdk_client()
+            if client is None:
+                _log("airefinery-sdk not available for model discovery")
                 return
 
-            client = AsyncAIRefinery(api_key=self.api_key, base_url=self.base_url)
             models = await client.models.list()
 
             live_map = {}
@@ -936,158 +2099,1585 @@ class AirRefineryProvider(OpenAiProvider):
         # Ensure multimodal payload is normalized (downloads/images to data: URIs etc.)
         chat = await process_chat(chat)
 
-        # Always send non-streaming for now (UI expects non-streamed complete JSON)
-        # Respect explicit request flag if provided but default to False
-        if 'stream' not in chat:
+        if stream:
+            chat['stream'] = True
+        elif 'stream' not in chat:
             chat['stream'] = False
 
         # Remove metadata before sending upstream to avoid provider conflicts
         chat.pop('metadata', None)
 
-        _log(f"SDK chat create {self.base_url}/v1/chat/completions")
-        _log(chat_summary(chat))
+        _log("SDK chat create %s/v1/chat/completions (stream=%s)", self.base_url, chat['stream'])
+        _log(chat_summary, chat)
+
+        client = self.sdk_client()
+        if client is None:
+            # SDK not available – fall back to base HTTP implementation
+            _log("airefinery-sdk not available – falling back to HTTP provider")
+            return await super().chat(chat, stream=stream)
 
         # Build kwargs for the SDK call
         kwargs = {k: v for k, v in chat.items() if k not in ('model', 'messages')}
-        # Enforce non-streaming for now to match UI expectations
-        kwargs['stream'] = False
+        # Only stream when the caller can consume an async generator
+        kwargs['stream'] = stream
 
         started_at = time.time()
+        response = await client.chat.completions.create(
+            model=chat['model'],
+            # the SDK serializes messages itself, so inline media needs to be materialized
+            messages=materialize_media(chat['messages']),
+            **kwargs,
+        )
+
+        if stream:
+            # Same contract as OpenAiProvider.chat(stream=True): an async generator of chat.completion.chunk dicts
+            async def stream_generator():
+                try:
+                    async for chunk in response:
+                        yield sdk_to_dict(chunk)
+                finally:
+                    # release the connection when the consumer stops early, e.g. disconnected or a lost hedge
+                    await self.close_sdk(response, "stream")
+            return stream_generator()
+
+        return self.to_response(sdk_to_dict(response), chat, started_at)
+
+    async def generate_image(self, prompt, model, n=1, size="1024x1024", response_format="url", user=None, timeout=60):
+        """Generate images using AI Refinery image generation API.
+        
+        Args:
+            prompt: Text description of the desired image
+            model: Image generation model (e.g., "black-forest-labs/FLUX.1-schnell")
+            n: Number of images to generate (default: 1)
+            size: Image dimensions like "1024x1024" (default: "1024x1024")
+            response_format: "url" or "b64_json" (default: "url")
+            user: User identifier for tracking
+            timeout: Max seconds to wait for response
+            
+        Returns:
+            ImagesResponse dict with created timestamp, data array of Image objects, and usage stats
+        """
+        _log(f"SDK images.generate {self.base_url}/v1/images/generations")
+        _log(f"Prompt: {prompt[:100]}{'...' if len(prompt) > 100 else ''}")
+        _log(f"Model: {model}, n={n}, size={size}")
+
+        started_at = time.time()
+        client = self.sdk_client()
+        if client is None:
+            raise Exception("airefinery-sdk not available for image generation")
+
         try:
-            # Import locally to avoid hard-failing import at module import time
-            from air.client import AsyncAIRefinery  # type: ignore
+            # Call SDK image generation
+            response = await client.images.generate(
+                prompt=prompt,
+                model=model,
+                n=n,
+                size=size,
+                user=user,
+                timeout=timeout
+            )
+
+            resp_obj = sdk_to_dict(response)
+
+            # Ensure proper response format
+            # The SDK returns ImagesResponse with data=[Image(url=..., b64_json=..., revised_prompt=...)]
+            if 'data' not in resp_obj:
+                resp_obj['data'] = []
+            
+            # Convert response_format if needed
+            if response_format == "b64_json":
+                # If SDK returned URLs but we want base64, we'd need to download
+                # For now, SDK should return base64 by default
+                pass
+            elif response_format == "url":
+                # SDK returns URLs by default
+                pass
+
+            # Add created timestamp if not present
+            if 'created' not in resp_obj:
+                resp_obj['created'] = int(started_at)
+
+            duration = int((time.time() - started_at) * 1000)
+            _log(f"Image generation completed in {duration}ms")
+
+            # Add metadata for tracking
+            if 'usage' in resp_obj:
+                usage = resp_obj['usage']
+                resp_obj['metadata'] = {
+                    'duration': duration,
+                    'provider': 'airefinery',
+                    'model': model,
+                }
+
+            return resp_obj
+
+        except Exception as e:
+            _log(f"Image generation error: {e}")
+            raise e
+
+class RoutingStats:
+    """Per (provider, model) EWMA latency, time to first token and error rate used to order providers.
+
+    With the "latency" policy, providers offering the same model are tried in order of their expected
+    latency (TTFT for streaming requests), inflated by their error rate and optionally their relative
+    price. Providers without stats are tried first so they get measured. With the default "ordered"
+    policy, providers are tried in config order and nothing is recorded.
+    """
+    def __init__(self, routing_config=None, stats=None):
+        self.config = routing_config or {}
+        self.policy = self.config.get('policy', 'ordered')
+        self.enabled = self.policy == 'latency'
+        self.alpha = float(self.config.get('alpha', 0.2))
+        self.error_penalty = float(self.config.get('error_penalty', 4))
+        self.price_weight = float(self.config.get('price_weight', 0))
+        self.save_interval = float(self.config.get('save_interval', 30))
+        persist = self.config.get('persist', True)
+        self.path = (os.path.expanduser(persist) if isinstance(persist, str) else home_llms_path("cache/routing.json")) if persist and self.enabled else None
+        self.stats = stats if stats is not None else {}
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        self._save_task = None
+        if stats is None and self.path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for entry in json.load(f):
+                    self.stats[(entry.pop('provider'), entry.pop('model'))] = entry
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            _log("Error loading routing stats: %s", e, level=LOG_LEVELS["warning"])
+
+    def save(self, entries=None):
+        if entries is None:
+            entries = self.entries()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            _log("Error saving routing stats: %s", e, level=LOG_LEVELS["warning"])
+
+    def entries(self):
+        return [{"provider": name, "model": model, **stats} for (name, model), stats in self.stats.items()]
+
+    def flush(self):
+        if self.path and self.dirty:
+            self.dirty = False
+            self.save()
+
+    def changed(self):
+        """Save stats in the background at most every save_interval seconds"""
+        if not self.path:
+            return
+        self.dirty = True
+        now = time.monotonic()
+        if now - self.saved_at >= self.save_interval and (self._save_task is None or self._save_task.done()):
+            self.saved_at = now
+            self.dirty = False
+            self._save_task = asyncio.ensure_future(asyncio.to_thread(self.save, self.entries()))
+
+    def ewma(self, previous, value):
+        return value if previous is None else self.alpha * value + (1 - self.alpha) * previous
+
+    def get(self, name, model):
+        key = (name, model)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = {"latency": None, "ttft": None, "error_rate": 0.0, "requests": 0, "errors": 0}
+        return stats
+
+    def record(self, name, model, latency, ttft=None):
+        if not self.enabled:
+            return
+        stats = self.get(name, model)
+        stats['latency'] = self.ewma(stats['latency'], latency)
+        stats['ttft'] = self.ewma(stats['ttft'], ttft if ttft is not None else latency)
+        stats['error_rate'] = self.ewma(stats['error_rate'], 0.0)
+        stats['requests'] += 1
+        stats['updated'] = int(time.time())
+        self.changed()
+
+    def record_error(self, name, model):
+        if not self.enabled:
+            return
+        stats = self.get(name, model)
+        stats['error_rate'] = self.ewma(stats['error_rate'], 1.0)
+        stats['requests'] += 1
+        stats['errors'] += 1
+        stats['updated'] = int(time.time())
+        self.changed()
+
+    async def track_stream(self, name, model, generator, started_at):
+        """Pass through a streaming response, recording its TTFT and total duration once it completes"""
+        ttft = None
+        try:
+            async for chunk in generator:
+                if ttft is None:
+                    ttft = time.monotonic() - started_at
+                yield chunk
         except Exception:
-            # SDK not available – fall back to base HTTP implementation
-            _log("airefinery-sdk not available – falling back to HTTP provider")
-            return await super().chat(chat)
+            self.record_error(name, model)
+            raise
+        else:
+            self.record(name, model, time.monotonic() - started_at, ttft)
+        finally:
+            if hasattr(generator, 'aclose'):
+                await generator.aclose()
+
+    def cost(self, provider, model):
+        pricing = provider.model_pricing(model)
+        try:
+            return float(pricing['input']) + float(pricing['output'])
+        except (TypeError, KeyError, ValueError):
+            return None
+
+    def score(self, name, model, stream=False):
+        """Expected latency in seconds, 0 if the provider hasn't been measured yet"""
+        stats = self.stats.get((name, model))
+        if stats is None:
+            return 0.0
+        expected = (stats['ttft'] if stream else stats['latency']) or stats['latency'] or stats['ttft']
+        if expected is None:
+            # only errors recorded so far
+            expected = 1.0
+        return expected * (1 + self.error_penalty * stats['error_rate'])
+
+    def scores(self, model, candidates, stream=False):
+        costs = [self.cost(provider, model) for _, provider in candidates]
+        max_cost = max((cost for cost in costs if cost is not None), default=0)
+        scores = []
+        for (name, provider), cost in zip(candidates, costs):
+            score = self.score(name, model, stream)
+            if self.price_weight and max_cost > 0 and cost is not None:
+                score *= 1 + self.price_weight * cost / max_cost
+            scores.append(score)
+        return scores
+
+    def rank(self, model, candidates, stream=False):
+        """Order candidate (name, provider) tuples by score, ties keep config order"""
+        if not self.enabled or len(candidates) < 2:
+            return candidates
+        scores = self.scores(model, candidates, stream)
+        order = sorted(range(len(candidates)), key=lambda i: scores[i])
+        return tuple(candidates[i] for i in order)
+
+    def rankings(self, index):
+        """Current ranking of every model offered by more than one provider"""
+        models = {}
+        for model, candidates in index.routes.items():
+            if len(candidates) < 2:
+                continue
+            scores = self.scores(model, candidates)
+            order = sorted(range(len(candidates)), key=lambda i: scores[i]) if self.enabled else range(len(candidates))
+            models[model] = [{"provider": candidates[i][0], "score": scores[i], **self.stats.get((candidates[i][0], model), {})}
+                for i in order]
+        return {"policy": self.policy, "models": models}
+
+g_routing = RoutingStats()
+
+class CircuitBreaker:
+    """closed -> open after failure_threshold consecutive failures, open -> half_open after cooldown
+    seconds, when up to half_open_probes requests are let through: a success closes it, a failure re-opens it."""
+    def __init__(self, failure_threshold=5, cooldown=30, half_open_probes=1):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.half_open_probes = half_open_probes
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.probes = 0
+
+    def allow(self):
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.state = "half_open"
+            self.probes = 0
+        if self.state == "half_open":
+            if self.probes >= self.half_open_probes:
+                return False
+            self.probes += 1
+        return True
+
+    def release(self):
+        """Give back a half-open probe slot for a request that neither succeeded nor failed, e.g. cancelled"""
+        if self.state == "half_open" and self.probes > 0:
+            self.probes -= 1
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probes = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.probes = 0
+
+    def status(self):
+        ret = {"state": self.state, "failures": self.failures}
+        if self.state == "open":
+            ret["retry_in"] = max(0, round(self.cooldown - (time.monotonic() - self.opened_at), 1))
+        return ret
+
+def is_provider_failure(e):
+    """Whether an error counts against a provider's circuit, client errors (4xx) other than 408 don't.
+
+    Rate limits (429) don't either, they're often per key and brief, and are already paced by the
+    provider's RateLimiter and retried by the RetryPolicy.
+    """
+    if isinstance(e, HTTPError):
+        return e.status >= 500 or e.status == 408
+    return True
+
+class CircuitBreakers:
+    """Circuit breakers per provider and per (provider, model) for the fallback chain in chat_completion.
+
+    A provider or model with an open circuit is skipped immediately instead of waiting for it to time out.
+    """
+    def __init__(self, breaker_config=None):
+        self.config = breaker_config or {}
+        self.enabled = bool(self.config.get('enabled', True))
+        self.failure_threshold = int(self.config.get('failure_threshold', 5))
+        self.model_failure_threshold = int(self.config.get('model_failure_threshold', self.failure_threshold))
+        self.cooldown = float(self.config.get('cooldown', 30))
+        self.half_open_probes = int(self.config.get('half_open_probes', 1))
+        self.providers = {}
+        self.models = {}
+
+    def provider(self, name):
+        breaker = self.providers.get(name)
+        if breaker is None:
+            breaker = self.providers[name] = CircuitBreaker(self.failure_threshold, self.cooldown, self.half_open_probes)
+        return breaker
+
+    def model(self, name, model):
+        breaker = self.models.get((name, model))
+        if breaker is None:
+            breaker = self.models[(name, model)] = CircuitBreaker(self.model_failure_threshold, self.cooldown, self.half_open_probes)
+        return breaker
+
+    def allow(self, name, model):
+        if not self.enabled:
+            return True
+        model_breaker = self.model(name, model)
+        if not model_breaker.allow():
+            return False
+        if not self.provider(name).allow():
+            model_breaker.release()
+            return False
+        return True
+
+    def release(self, name, model):
+        if self.enabled:
+            self.model(name, model).release()
+            self.provider(name).release()
+
+    def success(self, name, model):
+        if self.enabled:
+            self.model(name, model).success()
+            self.provider(name).success()
+
+    def failure(self, name, model, e):
+        if not self.enabled:
+            return
+        if not is_provider_failure(e):
+            self.release(name, model)
+            return
+        self.model(name, model).failure()
+        self.provider(name).failure()
+
+    def status(self):
+        return {
+            "providers": {name: breaker.status() for name, breaker in self.providers.items()},
+            "models": {f"{name}/{model}": breaker.status() for (name, model), breaker in self.models.items() if breaker.state != "closed" or breaker.failures > 0},
+        }
+
+    def open_circuits(self):
+        return [name for name, breaker in self.providers.items() if breaker.state != "closed"] + \
+            [f"{name}/{model}" for (name, model), breaker in self.models.items() if breaker.state != "closed"]
+
+g_breakers = CircuitBreakers()
+
+class Hedging:
+    """Hedged requests: if the first provider hasn't responded (or sent its first stream chunk) within a delay,
+    the same request is sent to the next candidate and the first to answer wins.
+
+    The delay is fixed or the observed p90 of the model's response times (clamped to min_delay..max_delay),
+    hedged requests are capped to a budget share of recent requests.
+    """
+    def __init__(self, hedging_config=None):
+        self.config = hedging_config or {}
+        self.enabled = bool(self.config.get('enabled', False))
+        self.models = set(self.config.get('models', []))
+        self.delay = self.config.get('delay', 'p90')
+        self.min_delay = float(self.config.get('min_delay', 0.2))
+        self.max_delay = float(self.config.get('max_delay', 2))
+        self.budget = float(self.config.get('budget', 0.1))
+        self.samples = {}
+        # recent requests/hedges, halved every 1000 requests so the budget follows recent traffic
+        self.window_requests = 0
+        self.window_hedged = 0
+        self.stats = {"requests": 0, "hedged": 0, "wins": 0, "budget_denied": 0}
+
+    def delay_for(self, chat):
+        """Hedge delay in seconds for this request, None if it shouldn't be hedged"""
+        metadata = chat.get('metadata')
+        hedge = metadata.get('hedge') if isinstance(metadata, dict) else None
+        if hedge is None:
+            if not self.enabled or (self.models and chat['model'] not in self.models):
+                return None
+        elif hedge is False or str(hedge).lower() in ('false', '0'):
+            return None
+        elif hedge is not True and str(hedge).lower() != 'true':
+            try:
+                return float(hedge)
+            except (TypeError, ValueError):
+                # not a delay, hedge with the configured one
+                _log("Invalid hedge delay: %s", hedge)
+        if self.delay != 'p90':
+            return float(self.delay)
+        samples = self.samples.get(chat['model'])
+        if not samples or len(samples) < 10:
+            return self.max_delay
+        ordered = sorted(samples)
+        return min(self.max_delay, max(self.min_delay, ordered[int(len(ordered) * 0.9)]))
+
+    def observe(self, model, elapsed):
+        samples = self.samples.get(model)
+        if samples is None:
+            samples = self.samples[model] = deque(maxlen=100)
+        samples.append(elapsed)
+
+    def request(self):
+        self.stats['requests'] += 1
+        self.window_requests += 1
+        if self.window_requests > 1000:
+            self.window_requests //= 2
+            self.window_hedged //= 2
+
+    def allow_hedge(self):
+        if self.window_hedged + 1 > self.budget * self.window_requests:
+            self.stats['budget_denied'] += 1
+            return False
+        self.window_hedged += 1
+        self.stats['hedged'] += 1
+        return True
+
+    def status(self):
+        requests, hedged = self.stats['requests'], self.stats['hedged']
+        return {
+            **self.stats,
+            "hedge_rate": round(hedged / requests, 4) if requests else 0,
+            "win_rate": round(self.stats['wins'] / hedged, 4) if hedged else 0,
+        }
+
+g_hedging = Hedging()
+
+def parse_duration(value):
+    """Seconds in a rate limit reset value: "1s", "6m0s", "20ms", a number of seconds or an epoch timestamp
+    in seconds or milliseconds (e.g. OpenRouter's X-RateLimit-Reset), 0 for a reset that's already past"""
+    value = str(value).strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        if seconds > 1e12:
+            seconds /= 1000
+        return max(0, seconds - time.time()) if seconds > 1e9 else seconds
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(n) * units[unit] for n, unit in parts)
+
+def retry_after(headers):
+    """Seconds to wait before retrying from Retry-After, retry-after-ms or x-ratelimit-reset-* headers, None if absent"""
+    if not headers:
+        return None
+    headers = {k.lower(): v for k, v in headers.items()}
+    if 'retry-after-ms' in headers:
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    if 'retry-after' in headers:
+        value = headers['retry-after']
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                from email.utils import parsedate_to_datetime
+                return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    # prefer the reset of the limit that's exhausted, e.g. x-ratelimit-remaining-tokens: 0
+    resets = {}
+    for key, value in headers.items():
+        if key.startswith('x-ratelimit-reset'):
+            seconds = parse_duration(value)
+            if seconds is not None:
+                resets[key[len('x-ratelimit-reset'):]] = seconds
+    if not resets:
+        return None
+    exhausted = [seconds for suffix, seconds in resets.items() if headers.get(f'x-ratelimit-remaining{suffix}') == '0']
+    return max(exhausted or resets.values())
+
+def error_status(e):
+    status = e.status if isinstance(e, HTTPError) else getattr(e, 'status_code', None)
+    return status if isinstance(status, int) else None
+
+def error_headers(e):
+    if isinstance(e, HTTPError):
+        return e.headers
+    response = getattr(e, 'response', None)
+    return getattr(response, 'headers', None)
+
+class RetryPolicy:
+    """Classifies provider errors as retryable, failover or terminal.
+
+    retryable errors (rate limits, overloaded or unavailable upstreams, dropped connections) are retried on
+    the same provider with jittered exponential backoff, or after Retry-After/x-ratelimit-reset-* when given,
+    failover errors move on to the next provider and terminal errors (bad requests that would fail on every
+    provider) fail the request immediately. Retries and fail-overs stop once the deadline has passed.
+    """
+    RETRYABLE_STATUS = {408, 429, 502, 503, 504, 529}
+
+    def __init__(self, retry_config=None):
+        self.config = retry_config or {}
+        self.max_retries = int(self.config.get('max_retries', 2))
+        self.backoff = float(self.config.get('backoff', 0.5))
+        self.max_backoff = float(self.config.get('max_backoff', 8))
+        self.max_retry_after = float(self.config.get('max_retry_after', 30))
+        self.deadline = float(self.config.get('deadline', 300))
+        self.terminal_status = set(self.config.get('terminal_status', [400, 422]))
+
+    def classify(self, e):
+        status = error_status(e)
+        if status is not None:
+            if status in self.RETRYABLE_STATUS:
+                return "retryable"
+            if status in self.terminal_status:
+                return "terminal"
+            return "failover"
+        if isinstance(e, (aiohttp.ServerDisconnectedError, aiohttp.ClientOSError)) and not isinstance(e, aiohttp.ClientConnectorError):
+            return "retryable"
+        return "failover"
+
+    def retry_delay(self, e, attempt, deadline):
+        """Seconds to wait before retrying the same provider, None if it shouldn't be retried"""
+        if attempt >= self.max_retries or self.classify(e) != "retryable":
+            return None
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+        wait = retry_after(error_headers(e))
+        if wait is not None:
+            if wait > self.max_retry_after:
+                # rate limited for longer than we're willing to wait, try another provider instead
+                return None
+            delay = max(delay, wait)
+        if time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+g_retry = RetryPolicy()
+
+class Overloaded(Exception):
+    pass
+
+class AdmissionLimit:
+    """Limits the concurrent requests to max_concurrent (0 for unlimited), queueing at most max_queue more"""
+    def __init__(self, max_concurrent=0, max_queue=0):
+        self.max_concurrent = int(max_concurrent)
+        self.max_queue = int(max_queue)
+        self.in_flight = 0
+        self.waiters = deque()
+        self.stats = {"admitted": 0, "rejected": 0, "timed_out": 0}
+
+    async def acquire(self, timeout):
+        if self.max_concurrent <= 0 or (self.in_flight < self.max_concurrent and not self.waiters):
+            self.in_flight += 1
+            self.stats['admitted'] += 1
+            return
+        if len(self.waiters) >= self.max_queue:
+            self.stats['rejected'] += 1
+            raise Overloaded("queue is full")
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just as we gave up, pass it on
+                self.release()
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats['timed_out'] += 1
+                raise Overloaded(f"timed out after {timeout}s in queue") from None
+            raise
+        self.stats['admitted'] += 1
+
+    def release(self):
+        # hand the slot over to the next waiter, if any
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def status(self):
+        return {
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            **self.stats,
+        }
+
+# routes that send requests to providers, always admitted by the global limit
+PROXIED_ROUTES = ('/v1/chat/completions', '/v1/chat/fanout', '/v1/images/generations')
+
+class AdmissionControl:
+    """Server admission control, configured from the `admission` config block.
+
+    Requests to the routes listed in `routes` are admitted by their route's limit, then every proxied
+    route (PROXIED_ROUTES) and listed route by the global limit shared by all of them, waiting in order
+    for up to queue_timeout seconds. When a queue is full or the wait times out the request is shed with
+    a 503 and a Retry-After header instead of piling up in memory.
+    """
+    def __init__(self, admission_config=None):
+        self.config = admission_config or {}
+        self.enabled = bool(self.config.get('enabled', True)) and bool(self.config)
+        self.queue_timeout = float(self.config.get('queue_timeout', 30))
+        self.retry_after = int(self.config.get('retry_after', 1))
+        self.limit = AdmissionLimit(self.config.get('max_concurrent', 0), self.config.get('max_queue', 0))
+        self.routes = {path: AdmissionLimit(route.get('max_concurrent', 0), route.get('max_queue', 0))
+            for path, route in self.config.get('routes', {}).items()}
+
+    async def admit(self, path):
+        """Returns the limits holding a slot for the request, to release() once it's done"""
+        if not self.enabled:
+            return ()
+        route = self.routes.get(path)
+        if route is None:
+            if path not in PROXIED_ROUTES:
+                return ()
+            await self.limit.acquire(self.queue_timeout)
+            return (self.limit,)
+        deadline = time.monotonic() + self.queue_timeout
+        await route.acquire(self.queue_timeout)
+        try:
+            await self.limit.acquire(max(0, deadline - time.monotonic()))
+        except BaseException:
+            route.release()
+            raise
+        return (route, self.limit)
+
+    def release(self, limits):
+        for limit in limits:
+            limit.release()
+
+    def status(self):
+        return {
+            "global": self.limit.status(),
+            "routes": {path: limit.status() for path, limit in self.routes.items()},
+        }
+
+g_admission = AdmissionControl()
+
+@web.middleware
+async def admission_middleware(request, handler):
+    """Admit requests by g_admission, shedding them with a 503 when the server is overloaded"""
+    admission = g_admission
+    try:
+        limits = await admission.admit(request.path)
+    except Overloaded as e:
+        _log("Shedding %s request, %s", request.path, e)
+        return json_response({
+            "responseStatus": {
+                "errorCode": "ServiceUnavailable",
+                "message": f"Server is overloaded, {e}"
+            }
+        }, status=503, headers={'Retry-After': str(admission.retry_after)})
+    try:
+        return await handler(request)
+    finally:
+        admission.release(limits)
+
+def completion_to_chunks(response):
+    """Stream chunks that replay a chat completion response"""
+    base = {k: response[k] for k in ('id', 'created', 'model', 'system_fingerprint') if k in response}
+    base['object'] = "chat.completion.chunk"
+    chunks = []
+    for choice in response.get('choices', []):
+        index = choice.get('index', 0)
+        delta = dict(choice.get('message', {}))
+        if 'tool_calls' in delta:
+            delta['tool_calls'] = [{**call, "index": i} for i, call in enumerate(delta['tool_calls'])]
+        chunks.append({**base, "choices": [{"index": index, "delta": delta, "finish_reason": None}]})
+        chunks.append({**base, "choices": [{"index": index, "delta": {}, "finish_reason": choice.get('finish_reason', 'stop')}]})
+    if not chunks:
+        chunks.append({**base, "choices": []})
+    for key in ('usage', 'metadata'):
+        if key in response:
+            chunks[-1][key] = response[key]
+    return chunks
+
+def chunks_to_completion(chunks):
+    """Assemble streamed chat completion chunks into a chat completion response"""
+    response = {"object": "chat.completion"}
+    choices = {}
+    for chunk in chunks:
+        for key in ('id', 'created', 'model', 'system_fingerprint'):
+            if key in chunk and key not in response:
+                response[key] = chunk[key]
+        for key in ('usage', 'metadata'):
+            if chunk.get(key):
+                response[key] = chunk[key]
+        for choice in chunk.get('choices') or []:
+            index = choice.get('index', 0)
+            target = choices.setdefault(index, {"index": index, "message": {"role": "assistant"}, "finish_reason": None})
+            message = target['message']
+            for key, value in (choice.get('delta') or {}).items():
+                if value is None:
+                    continue
+                if key == 'tool_calls':
+                    calls = message.setdefault('tool_calls', [])
+                    for call in value:
+                        i = call.get('index', len(calls))
+                        while len(calls) <= i:
+                            calls.append({"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+                        for field in ('id', 'type'):
+                            if call.get(field):
+                                calls[i][field] = call[field]
+                        function = call.get('function') or {}
+                        calls[i]['function']['name'] += function.get('name') or ''
+                        calls[i]['function']['arguments'] += function.get('arguments') or ''
+                elif isinstance(value, str) and key != 'role':
+                    message[key] = message.get(key, '') + value
+                else:
+                    message[key] = value
+            if choice.get('finish_reason'):
+                target['finish_reason'] = choice['finish_reason']
+    response['choices'] = [choices[index] for index in sorted(choices)]
+    return response
+
+async def replay_stream(chunks):
+    for chunk in chunks:
+        yield chunk
+
+def cache_key_default(obj):
+    if isinstance(obj, MediaPayload):
+        return {"mimetype": obj.mimetype, "sha256": obj.digest()}
+    return str(obj)
+
+def is_deterministic(chat):
+    return chat.get('temperature') == 0 or chat.get('seed') is not None
+
+# requests costing more than this many bytes to hash are keyed off the event loop
+INLINE_KEY_LIMIT = 64 * 1024
+
+def key_cost(obj):
+    """Approximate bytes canonical_hash(obj) has to serialize and hash"""
+    if isinstance(obj, dict):
+        return sum(key_cost(value) for value in obj.values())
+    if isinstance(obj, list):
+        return sum(key_cost(value) for value in obj)
+    if isinstance(obj, str):
+        return len(obj)
+    if isinstance(obj, MediaPayload):
+        return obj.digest_cost()
+    return 8
+
+def canonical_hash(obj):
+    data = json.dumps(obj, sort_keys=True, separators=(',', ':'), default=cache_key_default)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+async def completion_key(chat):
+    """Hash of the canonical JSON of a chat request after process_chat(), with media replaced by the digest
+    of its content and without transport fields like stream, so identical requests have the same key"""
+    # resolve media here so the key covers their content, it's not repeated as the request is processed
+    await process_chat(chat)
+    canonical = {k: v for k, v in chat.items() if k not in ('stream', 'stream_options', 'metadata')}
+    if key_cost(canonical) <= INLINE_KEY_LIMIT:
+        return canonical_hash(canonical)
+    return await asyncio.to_thread(canonical_hash, canonical)
+
+class CompletionCache:
+    """Opt-in cache of deterministic chat completions (temperature=0 or a fixed seed), keyed by completion_key().
+
+    The memory tier is an LRU of up to max_entries, the optional sqlite tier (WAL, shared by multiple
+    processes) defaults to ~/.llms/cache/completions.db. Entries expire after ttl seconds in both.
+    Requests can opt in or out with "metadata": {"cache": true|false}.
+    """
+    def __init__(self, cache_config=None):
+        self.config = cache_config or {}
+        self.enabled = bool(self.config.get('enabled', False))
+        self.max_entries = int(self.config.get('max_entries', 1000))
+        self.ttl = float(self.config.get('ttl', 3600))
+        self.deterministic_only = bool(self.config.get('deterministic_only', True))
+        sqlite = self.config.get('sqlite', False)
+        self.sqlite_path = (os.path.expanduser(sqlite) if isinstance(sqlite, str) else home_llms_path("cache/completions.db")) if sqlite else None
+        self.db = None
+        self.db_lock = threading.Lock()
+        self.puts = 0
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "sqlite_hits": 0, "misses": 0, "bypassed": 0, "stores": 0}
+
+    def cacheable(self, chat):
+        if not self.enabled:
+            return False
+        opt_in = (chat.get('metadata') or {}).get('cache')
+        cacheable = bool(opt_in) if opt_in is not None else not self.deterministic_only or is_deterministic(chat)
+        if not cacheable:
+            self.stats['bypassed'] += 1
+        return cacheable
+
+    async def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires_at, data = entry
+            if expires_at > time.time():
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.hit(data)
+            del self.entries[key]
+        if self.sqlite_path:
+            row = await asyncio.to_thread(self.read_db, key)
+            if row is not None:
+                self.stats['sqlite_hits'] += 1
+                self.put_memory(key, *row)
+                return self.hit(row[1])
+        self.stats['misses'] += 1
+        return None
+
+    def hit(self, data):
+        response = g_json.loads(data)
+        response.setdefault('metadata', {})['cache'] = "hit"
+        return response
+
+    async def put(self, key, response):
+        if not response.get('choices') or not all(choice.get('finish_reason') for choice in response['choices']):
+            # incomplete or failed
+            return
+        expires_at = time.time() + self.ttl
+        data = g_json.dumps(response)
+        self.put_memory(key, expires_at, data)
+        self.stats['stores'] += 1
+        if self.sqlite_path:
+            await asyncio.to_thread(self.write_db, key, expires_at, data)
+
+    def put_memory(self, key, expires_at, data):
+        self.entries[key] = (expires_at, data)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def track_stream(self, key, generator):
+        """Relay a streamed response, caching it once it completes"""
+        chunks = []
+        try:
+            async for chunk in generator:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            await generator.aclose()
+        await self.put(key, chunks_to_completion(chunks))
+
+    def connect(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.sqlite_path), exist_ok=True)
+            self.db = sqlite3.connect(self.sqlite_path, timeout=10, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, response BLOB NOT NULL)")
+        return self.db
+
+    def read_db(self, key):
+        try:
+            with self.db_lock:
+                row = self.connect().execute("SELECT expires_at, response FROM completions WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+            return (row[0], bytes(row[1])) if row else None
+        except sqlite3.Error as e:
+            _log("Error reading completion cache: %s", e, level=LOG_LEVELS["warning"])
+            return None
+
+    def write_db(self, key, expires_at, data):
+        try:
+            with self.db_lock:
+                db = self.connect()
+                db.execute("INSERT OR REPLACE INTO completions (key, expires_at, response) VALUES (?, ?, ?)", (key, expires_at, data))
+                self.puts += 1
+                if self.puts % 100 == 1:
+                    db.execute("DELETE FROM completions WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error as e:
+            _log("Error writing completion cache: %s", e, level=LOG_LEVELS["warning"])
+
+    def close(self):
+        with self.db_lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def status(self):
+        return {
+            **self.stats,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "sqlite": self.sqlite_path is not None,
+        }
+
+g_completion_cache = CompletionCache()
+
+def retrieve_exception(future):
+    """Done callback marking a future's exception as retrieved, for futures that may have no one left awaiting them"""
+    if not future.cancelled():
+        future.exception()
+
+class Flight:
+    """An upstream call shared by identical in-flight requests"""
+    def __init__(self):
+        self.task = None
+        self.started = asyncio.get_running_loop().create_future()
+        # the leader can fail after every request waiting on it has left
+        self.started.add_done_callback(retrieve_exception)
+        self.waiters = 0
+        self.shared = False
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+class Coalescer:
+    """Shares one upstream call between identical in-flight chat requests (singleflight).
+
+    Requests with the same completion_key() wait on the first one's response, streaming requests replay
+    its chunks as they arrive. The upstream call runs in its own task so it isn't cancelled with the
+    request that started it, only once all requests waiting on it are gone. Requests can opt in or out
+    with "metadata": {"coalesce": true|false}.
+    """
+    def __init__(self, coalesce_config=None):
+        self.config = coalesce_config or {}
+        self.enabled = bool(self.config.get('enabled', False))
+        self.deterministic_only = bool(self.config.get('deterministic_only', True))
+        self.flights = {}
+        self.stats = {"flights": 0, "coalesced": 0}
+
+    def coalescable(self, chat):
+        if not self.enabled:
+            return False
+        opt_in = (chat.get('metadata') or {}).get('coalesce')
+        if opt_in is not None:
+            return bool(opt_in)
+        return not self.deterministic_only or is_deterministic(chat)
+
+    async def run(self, key, upstream, stream=False):
+        """Result of upstream(), shared with identical requests already in flight"""
+        key = (key, stream)
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight()
+            self.flights[key] = flight
+            self.stats['flights'] += 1
+            flight.task = asyncio.ensure_future(self.fly(key, flight, upstream, stream))
+            flight.task.add_done_callback(retrieve_exception)
+        else:
+            flight.shared = True
+            self.stats['coalesced'] += 1
+        flight.waiters += 1
+        if stream:
+            try:
+                await asyncio.shield(flight.started)
+            except BaseException:
+                self.leave(flight)
+                raise
+            return Subscription(self, flight)
+        try:
+            response = await asyncio.shield(flight.task)
+        finally:
+            self.leave(flight)
+        # each request gets its own copy of a shared response
+        return g_json.loads(g_json.dumps(response)) if flight.shared else response
+
+    async def fly(self, key, flight, upstream, stream):
+        try:
+            if not stream:
+                return await upstream()
+            try:
+                generator = await upstream()
+            except BaseException as e:
+                if isinstance(e, Exception):
+                    flight.started.set_exception(e)
+                else:
+                    flight.started.cancel()
+                raise
+            flight.started.set_result(None)
+            try:
+                async for chunk in generator:
+                    flight.chunks.append(chunk)
+                    flight.notify()
+            except Exception as e:
+                flight.error = e
+            finally:
+                flight.done = True
+                flight.notify()
+                await generator.aclose()
+        finally:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def leave(self, flight):
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # no one is waiting for the response anymore
+            flight.task.cancel()
+
+    def status(self):
+        return {
+            **self.stats,
+            "in_flight": len(self.flights),
+        }
+
+class Subscription:
+    """Async iterator replaying a streaming flight's chunks as they arrive.
+
+    It's registered as one of the flight's waiters as soon as it's created and leaves the flight once
+    exhausted, failed, cancelled, closed or garbage collected, even if it was never iterated.
+    """
+    def __init__(self, coalescer, flight):
+        self.coalescer = coalescer
+        self.flight = flight
+        self.index = 0
+        self.left = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        flight = self.flight
+        try:
+            while not self.left:
+                if self.index < len(flight.chunks):
+                    self.index += 1
+                    return flight.chunks[self.index - 1]
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    break
+                await flight.changed.wait()
+        except BaseException:
+            self.leave()
+            raise
+        self.leave()
+        raise StopAsyncIteration
+
+    def leave(self):
+        if not self.left:
+            self.left = True
+            self.coalescer.leave(self.flight)
+
+    async def aclose(self):
+        self.leave()
 
-        try:
-            client = AsyncAIRefinery(api_key=self.api_key, base_url=self.base_url)
-            # Perform non-streaming chat completion via SDK (returns Pydantic model)
-            response = await client.chat.completions.create(
-                model=chat['model'],
-                messages=chat['messages'],
-                **kwargs,
-            )
+    def __del__(self):
+        self.leave()
 
-            # Convert to plain dict (Pydantic v2 BaseModel)
-            # Support both .model_dump() and .dict() for compatibility.
-            if hasattr(response, 'model_dump'):
-                resp_obj = response.model_dump()
-            else:
-                resp_obj = response.dict()
+g_coalescer = Coalescer()
 
-            return self.to_response(resp_obj, chat, started_at)
-        except Exception as e:
-            # If SDK call fails for any reason, rethrow with context so callers see clear error
-            raise e
+class Batches:
+    """OpenAI compatible /v1/files and /v1/batches jobs, persisted under ~/.llms/batches (or the configured path).
 
-    async def generate_image(self, prompt, model, n=1, size="1024x1024", response_format="url", user=None, timeout=60):
-        """Generate images using AI Refinery image generation API.
-        
-        Args:
-            prompt: Text description of the desired image
-            model: Image generation model (e.g., "black-forest-labs/FLUX.1-schnell")
-            n: Number of images to generate (default: 1)
-            size: Image dimensions like "1024x1024" (default: "1024x1024")
-            response_format: "url" or "b64_json" (default: "url")
-            user: User identifier for tracking
-            timeout: Max seconds to wait for response
-            
-        Returns:
-            ImagesResponse dict with created timestamp, data array of Image objects, and usage stats
-        """
-        _log(f"SDK images.generate {self.base_url}/v1/images/generations")
-        _log(f"Prompt: {prompt[:100]}{'...' if len(prompt) > 100 else ''}")
-        _log(f"Model: {model}, n={n}, size={size}")
+    A batch runs the chat requests of its JSONL input file through chat_completion(), at most concurrency
+    at a time so it's paced by the providers' rate limits and circuit breakers, retrying rate limited
+    requests up to max_attempts times. Results are appended to its output file in input order, which is
+    also how it resumes after a restart: requests after the last written result are run again.
+    """
+    ACTIVE = ('validating', 'in_progress', 'finalizing', 'cancelling')
 
-        started_at = time.time()
+    def __init__(self, batch_config=None, running=None):
+        self.config = batch_config or {}
+        self.concurrency = max(1, int(self.config.get('concurrency', 16)))
+        self.max_attempts = max(1, int(self.config.get('max_attempts', 5)))
+        self.save_interval = float(self.config.get('save_interval', 1))
+        # batch id -> (task, batch) of the batches running in this process
+        self.running = running if running is not None else {}
+
+    @property
+    def path(self):
+        path = self.config.get('path')
+        return os.path.expanduser(path) if path else home_llms_path("batches")
+
+    def file_path(self, file_id, ext='jsonl'):
+        return os.path.join(self.path, 'files', f"{file_id}.{ext}")
+
+    def batch_path(self, batch_id):
+        return os.path.join(self.path, f"{batch_id}.json")
+
+    def read_json(self, path):
         try:
-            from air.client import AsyncAIRefinery
-        except Exception:
-            raise Exception("airefinery-sdk not available for image generation")
+            with open(path, "rb") as f:
+                return g_json.loads(f.read())
+        except (OSError, ValueError):
+            return None
 
+    def write_json(self, path, obj):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(g_json.dumps(obj))
+        os.replace(tmp_path, path)
+
+    def valid_id(self, id, prefix):
+        return isinstance(id, str) and re.fullmatch(prefix + r'[0-9a-f]{24}', id) is not None
+
+    async def create_file(self, chunks, filename, purpose='batch'):
+        """Save an uploaded file from an async iterator of byte chunks"""
+        os.makedirs(os.path.join(self.path, 'files'), exist_ok=True)
+        file_id = f"file-{secrets.token_hex(12)}"
+        size = 0
+        buffer = []
+        buffered = 0
+        # written in a thread 1MB at a time so large uploads don't block other requests
+        with open(self.file_path(file_id), "wb") as f:
+            async for chunk in chunks:
+                buffer.append(chunk)
+                buffered += len(chunk)
+                if buffered >= 1024 * 1024:
+                    await asyncio.to_thread(f.write, b''.join(buffer))
+                    size += buffered
+                    buffer.clear()
+                    buffered = 0
+            if buffer:
+                await asyncio.to_thread(f.write, b''.join(buffer))
+                size += buffered
+        file = {"id": file_id, "object": "file", "bytes": size, "created_at": int(time.time()), "filename": filename, "purpose": purpose}
+        self.save_file(file)
+        return file
+
+    def save_file(self, file):
+        self.write_json(self.file_path(file['id'], 'json'), file)
+
+    def get_file(self, file_id):
+        return self.read_json(self.file_path(file_id, 'json')) if self.valid_id(file_id, 'file-') else None
+
+    def get(self, batch_id):
+        if batch_id in self.running:
+            return self.running[batch_id][1]
+        return self.read_json(self.batch_path(batch_id)) if self.valid_id(batch_id, 'batch_') else None
+
+    def save(self, batch):
+        self.write_json(self.batch_path(batch['id']), batch)
+
+    def list(self, limit=20, after=None):
+        batches = []
+        if os.path.isdir(self.path):
+            for entry in os.scandir(self.path):
+                if entry.name.startswith('batch_') and entry.name.endswith('.json'):
+                    batch = self.read_json(entry.path)
+                    if batch is not None:
+                        batches.append(batch)
+        batches.sort(key=lambda batch: (batch['created_at'], batch['id']), reverse=True)
+        if after:
+            ids = [batch['id'] for batch in batches]
+            batches = batches[ids.index(after) + 1:] if after in ids else []
+        return batches[:limit], len(batches) > limit
+
+    def create(self, input_file_id, endpoint='/v1/chat/completions', completion_window='24h', metadata=None):
+        if endpoint != '/v1/chat/completions':
+            raise ValueError(f"Unsupported endpoint: {endpoint}")
+        if self.get_file(input_file_id) is None:
+            raise ValueError(f"File not found: {input_file_id}")
+        now = int(time.time())
+        output_file = {"id": f"file-{secrets.token_hex(12)}", "object": "file", "bytes": 0, "created_at": now, "filename": "batch_output.jsonl", "purpose": "batch_output"}
+        open(self.file_path(output_file['id']), "wb").close()
+        self.save_file(output_file)
+        batch = {
+            "id": f"batch_{secrets.token_hex(12)}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": output_file['id'],
+            "error_file_id": None,
+            "created_at": now,
+            "in_progress_at": None,
+            "expires_at": None,
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": metadata,
+        }
+        self.save(batch)
+        self.start(batch)
+        return batch
+
+    def start(self, batch):
+        if batch['id'] not in self.running:
+            task = asyncio.ensure_future(self.run(batch))
+            self.running[batch['id']] = (task, batch)
+            task.add_done_callback(lambda _: self.running.pop(batch['id'], None))
+
+    def cancel(self, batch_id):
+        batch = self.get(batch_id)
+        if batch is None or batch['status'] not in self.ACTIVE:
+            return batch
+        batch['status'] = "cancelling"
+        batch['cancelling_at'] = int(time.time())
+        self.save(batch)
+        if batch_id in self.running:
+            self.running[batch_id][0].cancel()
+        else:
+            batch['status'] = "cancelled"
+            batch['cancelled_at'] = int(time.time())
+            self.save(batch)
+        return batch
+
+    def resume(self):
+        """Continue the batches that were still running when the server stopped"""
+        batches, _ = self.list(limit=sys.maxsize)
+        for batch in batches:
+            if batch['status'] in self.ACTIVE and batch['id'] not in self.running:
+                if batch['status'] == 'cancelling':
+                    self.cancel(batch['id'])
+                else:
+                    _log("Resuming batch %s", batch['id'])
+                    self.start(batch)
+
+    async def close(self):
+        """Stop running batches, leaving them to be resumed"""
+        tasks = [task for task, _ in self.running.values()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def count_results(self, output_path):
+        """Number of results already written and how many of them failed, dropping a partially written last line"""
+        written = failed = offset = 0
+        with open(output_path, "r+b") as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    f.truncate(offset)
+                    break
+                offset += len(line)
+                written += 1
+                if g_json.loads(line).get('error') is not None:
+                    failed += 1
+        return written, failed
+
+    def count_requests(self, input_path):
+        with open(input_path, "rb") as f:
+            return sum(1 for line in f if line.strip())
+
+    def parse_request(self, request):
+        """(custom_id, chat) of a request in the OpenAI batch format or a bare chat request"""
+        custom_id = request.get('custom_id')
+        chat = request.get('body') if 'custom_id' in request or 'body' in request else request
+        if request.get('url', '/v1/chat/completions') != '/v1/chat/completions':
+            raise ValueError(f"Unsupported url: {request.get('url')}")
+        if not isinstance(chat, dict) or 'model' not in chat:
+            raise ValueError("Request body is missing model")
+        return custom_id, chat
+
+    def error_result(self, custom_id, code, message, status=None):
+        return {"id": f"batch_req_{secrets.token_hex(12)}", "custom_id": custom_id,
+            "response": {"status_code": status, "body": {"error": {"message": message}}} if status else None,
+            "error": {"code": code, "message": message}}
+
+    async def execute(self, line):
+        """Run one line of the input file, returns its output line"""
+        custom_id = None
         try:
-            client = AsyncAIRefinery(api_key=self.api_key, base_url=self.base_url)
-            
-            # Call SDK image generation
-            response = await client.images.generate(
-                prompt=prompt,
-                model=model,
-                n=n,
-                size=size,
-                user=user,
-                timeout=timeout
-            )
+            request = g_json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("Request is not a JSON object")
+            # kept on the error result of an invalid request too
+            custom_id = request.get('custom_id')
+            custom_id, chat = self.parse_request(request)
+        except ValueError as e:
+            return self.error_result(custom_id, "invalid_request", str(e))
+        return await self.run_request(custom_id, chat)
+
+    async def run_request(self, custom_id, chat):
+        """Run a chat request, retrying it while it's rate limited, returns its output line"""
+        chat['stream'] = False
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = await chat_completion(chat)
+                return {"id": f"batch_req_{secrets.token_hex(12)}", "custom_id": custom_id,
+                    "response": {"status_code": 200, "request_id": response.get('id'), "body": response}, "error": None}
+            except Exception as e:
+                if attempt < self.max_attempts and (isinstance(e, RateLimitExceeded) or g_retry.classify(e) == "retryable"):
+                    # wait for the providers' quota to recover instead of failing the request
+                    await asyncio.sleep(min(60, retry_after(error_headers(e)) or 2 ** attempt))
+                    continue
+                code = "rate_limit_exceeded" if isinstance(e, RateLimitExceeded) else "request_failed"
+                return self.error_result(custom_id, code, str(e), status=error_status(e) or 500)
+
+    async def run(self, batch):
+        input_path = self.file_path(batch['input_file_id'])
+        output_path = self.file_path(batch['output_file_id'])
+        counts = batch['request_counts']
+        try:
+            counts['total'] = await asyncio.to_thread(self.count_requests, input_path)
+            written, failed = await asyncio.to_thread(self.count_results, output_path)
+            counts['completed'], counts['failed'] = written - failed, failed
+            if batch['status'] == 'validating':
+                batch['status'] = "in_progress"
+                batch['in_progress_at'] = int(time.time())
+            self.save(batch)
+
+            results = {}
+            next_index = written
+            saved_at = time.monotonic()
+            # results wait for the ones before them to be written, bound how far ahead requests can run
+            window = self.concurrency * 100
+            flushed = asyncio.Event()
+            semaphore = asyncio.Semaphore(self.concurrency)
+            tasks = set()
+
+            # result lines ready to be appended in order, written in a thread so they don't block the event loop
+            pending = []
+            pending_bytes = 0
+            write_lock = asyncio.Lock()
+            # a cancelled write's thread can still be running, appends are ordered by the thread lock too
+            output_lock = threading.Lock()
+
+            with open(input_path, "rb") as input_file, open(output_path, "ab") as output_file:
+                def append(data):
+                    with output_lock:
+                        output_file.write(data)
+                        output_file.flush()
+
+                def take_pending():
+                    nonlocal pending_bytes
+                    data = b''.join(pending)
+                    pending.clear()
+                    pending_bytes = 0
+                    return data
+
+                def flush():
+                    nonlocal next_index, pending_bytes
+                    # queue the results that are next in order
+                    while next_index in results:
+                        result = results.pop(next_index)
+                        line = g_json.dumps(result) + b'\n'
+                        pending.append(line)
+                        pending_bytes += len(line)
+                        if result['error'] is None:
+                            counts['completed'] += 1
+                        else:
+                            counts['failed'] += 1
+                        next_index += 1
+                        flushed.set()
+
+                async def write():
+                    nonlocal saved_at
+                    due = time.monotonic() - saved_at >= self.save_interval
+                    if pending_bytes < 64 * 1024 and not due:
+                        return
+                    async with write_lock:
+                        data = take_pending()
+                        if data:
+                            await asyncio.to_thread(append, data)
+                    if due:
+                        self.save(batch)
+                        saved_at = time.monotonic()
+
+                async def process(index, line):
+                    try:
+                        results[index] = await self.execute(line)
+                        flush()
+                        await write()
+                    finally:
+                        semaphore.release()
 
-            # Convert Pydantic model to dict
-            if hasattr(response, 'model_dump'):
-                resp_obj = response.model_dump()
-            else:
-                resp_obj = response.dict()
+                try:
+                    index = 0
+                    for line in input_file:
+                        if not line.strip():
+                            continue
+                        if index >= written:
+                            while index - next_index >= window:
+                                flushed.clear()
+                                await flushed.wait()
+                            await semaphore.acquire()
+                            task = asyncio.ensure_future(process(index, line))
+                            tasks.add(task)
+                            task.add_done_callback(tasks.discard)
+                        index += 1
+                    while tasks:
+                        await asyncio.wait(set(tasks))
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    if tasks:
+                        await asyncio.wait(set(tasks))
+                    flush()
+                    # written before returning, even when cancelled, so the batch resumes after these results
+                    append(take_pending())
+
+            batch['status'] = "finalizing"
+            batch['finalizing_at'] = int(time.time())
+            output_file = self.get_file(batch['output_file_id'])
+            output_file['bytes'] = os.path.getsize(output_path)
+            self.save_file(output_file)
+            batch['status'] = "completed"
+            batch['completed_at'] = int(time.time())
+            self.save(batch)
+            _log("Batch %s completed: %s", batch['id'], counts)
+        except asyncio.CancelledError:
+            if batch['status'] == 'cancelling':
+                batch['status'] = "cancelled"
+                batch['cancelled_at'] = int(time.time())
+            # otherwise the server is stopping, save the progress to resume from
+            self.save(batch)
+            raise
+        except Exception as e:
+            _log("Batch %s failed: %s", batch['id'], e, level=LOG_LEVELS["warning"])
+            batch['status'] = "failed"
+            batch['failed_at'] = int(time.time())
+            batch['errors'] = {"object": "list", "data": [{"code": "batch_failed", "message": str(e)}]}
+            self.save(batch)
 
-            # Ensure proper response format
-            # The SDK returns ImagesResponse with data=[Image(url=..., b64_json=..., revised_prompt=...)]
-            if 'data' not in resp_obj:
-                resp_obj['data'] = []
-            
-            # Convert response_format if needed
-            if response_format == "b64_json":
-                # If SDK returned URLs but we want base64, we'd need to download
-                # For now, SDK should return base64 by default
-                pass
-            elif response_format == "url":
-                # SDK returns URLs by default
-                pass
+g_batches = Batches()
 
-            # Add created timestamp if not present
-            if 'created' not in resp_obj:
-                resp_obj['created'] = int(started_at)
+class ModelIndex:
+    """Immutable snapshot of the enabled providers' models, rebuilt and swapped whenever they change.
 
-            duration = int((time.time() - started_at) * 1000)
-            _log(f"Image generation completed in {duration}ms")
+    routes maps each model to the ordered (name, provider) tuples that serve it, the /models/list and
+    /models catalogs are pre-serialized with an ETag so unchanged catalogs are answered with a 304.
+    """
+    def __init__(self, handlers=None):
+        routes = {}
+        for name, provider in (handlers or {}).items():
+            for model in provider.models:
+                routes.setdefault(model, []).append((name, provider))
+        self.routes = {model: tuple(providers) for model, providers in routes.items()}
+        self.models = sorted(self.routes)
+        self.active_models = []
+        for model in self.models:
+            name, provider = self.routes[model][0]
+            self.active_models.append({
+                "id": model,
+                "provider": name,
+                "provider_model": provider.models[model],
+                "pricing": provider.model_pricing(model),
+            })
+        self.models_json = g_json.dumps(self.models)
+        self.models_etag = f'"{hashlib.sha256(self.models_json).hexdigest()[:16]}"'
+        self.active_models_json = g_json.dumps(self.active_models)
+        self.active_models_etag = f'"{hashlib.sha256(self.active_models_json).hexdigest()[:16]}"'
 
-            # Add metadata for tracking
-            if 'usage' in resp_obj:
-                usage = resp_obj['usage']
-                resp_obj['metadata'] = {
-                    'duration': duration,
-                    'provider': 'airefinery',
-                    'model': model,
-                }
+    def providers(self, model):
+        return self.routes.get(model, ())
 
-            return resp_obj
+g_model_index = ModelIndex()
 
-        except Exception as e:
-            _log(f"Image generation error: {e}")
-            raise e
+def catalog_response(request, body, etag):
+    """A pre-serialized model catalog, or 304 Not Modified when the client already has this ETag"""
+    if_none_match = request.headers.get('If-None-Match', '')
+    if etag in if_none_match or if_none_match.strip() == '*':
+        return web.Response(status=304, headers={'ETag': etag})
+    return web.Response(body=body, content_type='application/json', charset='utf-8',
+        headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+def update_model_index():
+    global g_model_index
+    g_model_index = ModelIndex(g_handlers)
 
 def get_models():
-    ret = []
-    for provider in g_handlers.values():
-        for model in provider.models.keys():
-            if model not in ret:
-                ret.append(model)
-    ret.sort()
-    return ret
+    return g_model_index.models
 
 def get_active_models():
-    ret = []
-    existing_models = set()
-    for id, provider in g_handlers.items():
-        for model in provider.models.keys():
-            if model not in existing_models:
-                existing_models.add(model)
-                provider_model = provider.models[model]
-                pricing = provider.model_pricing(model)
-                ret.append({
-                    "id": model,
-                    "provider": id,
-                    "provider_model": provider_model,
-                    "pricing": pricing
-                })
-    ret.sort(key=lambda x: x["id"])
-    return ret
+    return g_model_index.active_models
+
+async def provider_chat(name, provider, chat, model, stream=False):
+    """Send chat to a single provider, recording the outcome in its circuit breakers and routing stats"""
+    _log("provider: %s %s (stream=%s)", name, type(provider).__name__, stream)
+    limiter = provider.limiter
+    tokens = estimate_tokens(chat) if limiter.tracks_tokens(model) else 0
+    try:
+        await limiter.acquire(model, tokens)
+    except BaseException:
+        # not the provider's fault, so doesn't count towards its circuit breaker
+        g_breakers.release(name, model)
+        raise
+    started_at = time.monotonic()
+    try:
+        response = await provider.chat(chat.copy(), stream=stream)
+    except Exception as e:
+        g_breakers.failure(name, model, e)
+        g_routing.record_error(name, model)
+        _log("Provider %s failed: %s", name, e)
+        raise
+    except BaseException:
+        # cancelled, e.g. the client disconnected or a hedged request lost
+        g_breakers.release(name, model)
+        raise
+    g_breakers.success(name, model)
+    if stream:
+        if limiter.tracks_tokens(model):
+            response = limiter.track_stream(model, tokens, response)
+    else:
+        limiter.settle(model, tokens, response.get('usage'))
+    if not g_routing.enabled:
+        return response
+    if stream:
+        return g_routing.track_stream(name, model, response, started_at)
+    g_routing.record(name, model, time.monotonic() - started_at)
+    return response
+
+async def retry_provider_chat(name, provider, chat, model, stream=False, deadline=None):
+    """provider_chat() that retries retryable errors on the same provider as allowed by the retry policy"""
+    if deadline is None:
+        deadline = time.monotonic() + g_retry.deadline
+    attempt = 0
+    while True:
+        try:
+            return await provider_chat(name, provider, chat, model, stream)
+        except Exception as e:
+            delay = g_retry.retry_delay(e, attempt, deadline)
+            if delay is None:
+                raise
+            attempt += 1
+            _log("Retrying %s on %s in %.2fs (%d/%d): %s", model, name, delay, attempt, g_retry.max_retries, e)
+            await asyncio.sleep(delay)
+            if not g_breakers.allow(name, model):
+                raise
+
+async def prepend_chunk(first, generator):
+    try:
+        yield first
+        async for chunk in generator:
+            yield chunk
+    finally:
+        await generator.aclose()
+
+async def empty_stream():
+    return
+    yield
 
 async def chat_completion(chat, stream=False):
     """Execute chat completion with optional streaming.
@@ -1096,28 +3686,242 @@ async def chat_completion(chat, stream=False):
         chat: Chat completion request dict
         stream: If True, returns async generator of SSE chunks
     """
+    cache = g_completion_cache.cacheable(chat)
+    coalesce = g_coalescer.coalescable(chat)
+    if not cache and not coalesce:
+        return await route_chat_completion(chat, stream)
+
+    key = await completion_key(chat)
+    if cache:
+        response = await g_completion_cache.get(key)
+        if response is not None:
+            _log("Completion cache hit for %s", chat['model'])
+            return replay_stream(completion_to_chunks(response)) if stream else response
+
+    async def upstream():
+        response = await route_chat_completion(chat, stream)
+        if not cache:
+            return response
+        if stream:
+            return g_completion_cache.track_stream(key, response)
+        await g_completion_cache.put(key, response)
+        return response
+
+    if coalesce:
+        return await g_coalescer.run(key, upstream, stream)
+    return await upstream()
+
+async def route_chat_completion(chat, stream=False):
+    """Send the chat to the model's providers, falling back to the next one on failure"""
     model = chat['model']
-    # get first provider that has the model
-    candidate_providers = [name for name, provider in g_handlers.items() if model in provider.models]
+    # providers that have the model, in configured order or ranked by the routing policy
+    candidate_providers = g_routing.rank(model, g_model_index.providers(model), stream)
     if len(candidate_providers) == 0:
         raise(Exception(f"Model {model} not found"))
 
+    if len(candidate_providers) > 1:
+        delay = g_hedging.delay_for(chat)
+        if delay is not None:
+            return await hedged_chat_completion(chat, model, stream, candidate_providers, delay)
+
+    deadline = time.monotonic() + g_retry.deadline
     first_exception = None
-    for name in candidate_providers:
-        provider = g_handlers[name]
-        _log(f"provider: {name} {type(provider).__name__} (stream={stream})")
+    for name, provider in candidate_providers:
+        if time.monotonic() >= deadline:
+            break
+        if not g_breakers.allow(name, model):
+            _log("Skipping provider %s for %s, circuit is open", name, model)
+            continue
         try:
-            response = await provider.chat(chat.copy(), stream=stream)
-            return response
+            return await retry_provider_chat(name, provider, chat, model, stream, deadline)
         except Exception as e:
+            if g_retry.classify(e) == "terminal":
+                # e.g. a 400 for an invalid request, which every other provider would also reject
+                raise
             if first_exception is None:
                 first_exception = e
-            _log(f"Provider {name} failed: {e}")
             continue
 
     # If we get here, all providers failed
+    if first_exception is None:
+        raise Exception(f"No providers available for {model}, circuits are open: {', '.join(name for name, _ in candidate_providers)}")
     raise first_exception
 
+async def hedged_chat_completion(chat, model, stream, candidate_providers, delay):
+    """Like chat_completion() but if the current provider hasn't responded (or sent its first stream chunk)
+    within delay seconds, the request is also sent to the next candidate. The first response wins and the
+    other request is cancelled, failed requests fall back to the next candidate as usual."""
+    g_hedging.request()
+    remaining = deque(candidate_providers)
+    deadline = time.monotonic() + g_retry.deadline
+
+    async def attempt(name, provider):
+        started_at = time.monotonic()
+        response = await retry_provider_chat(name, provider, chat, model, stream, deadline)
+        if stream:
+            # a streaming response only counts once its first chunk arrives
+            try:
+                first = await response.__anext__()
+            except StopAsyncIteration:
+                response = empty_stream()
+            else:
+                response = prepend_chunk(first, response)
+        g_hedging.observe(model, time.monotonic() - started_at)
+        return response
+
+    def next_candidate():
+        while remaining:
+            name, provider = remaining.popleft()
+            if g_breakers.allow(name, model):
+                return name, provider
+            _log("Skipping provider %s for %s, circuit is open", name, model)
+        return None
+
+    async def discard(task):
+        # close the stream of a request that also succeeded but lost
+        if stream and not task.cancelled() and task.exception() is None:
+            await task.result().aclose()
+
+    candidate = next_candidate()
+    if candidate is None:
+        raise Exception(f"No providers available for {model}, circuits are open: {', '.join(name for name, _ in candidate_providers)}")
+    pending = {asyncio.ensure_future(attempt(*candidate))}
+    hedged = False
+    hedge_task = None
+    first_exception = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=None if hedged else delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # the current provider is slow, hedge to the next one if the budget allows it
+                hedged = True
+                candidate = next_candidate()
+                if candidate is not None:
+                    if g_hedging.allow_hedge():
+                        _log("Hedging %s request to %s after %.2fs", model, candidate[0], delay)
+                        hedge_task = asyncio.ensure_future(attempt(*candidate))
+                        pending.add(hedge_task)
+                    else:
+                        g_breakers.release(candidate[0], model)
+                        remaining.appendleft(candidate)
+                continue
+            winner = None
+            for task in done:
+                if task.exception() is not None:
+                    if g_retry.classify(task.exception()) == "terminal":
+                        raise task.exception()
+                    if first_exception is None:
+                        first_exception = task.exception()
+                elif winner is None:
+                    winner = task
+                else:
+                    await discard(task)
+            if winner is not None:
+                if winner is hedge_task:
+                    g_hedging.stats['wins'] += 1
+                return winner.result()
+            if not pending and time.monotonic() < deadline:
+                # all in-flight requests failed, fall back to the next candidate
+                candidate = next_candidate()
+                if candidate is not None:
+                    pending.add(asyncio.ensure_future(attempt(*candidate)))
+        raise first_exception
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+            for task in pending:
+                await discard(task)
+
+MAX_FANOUT_MODELS = 16
+
+def fanout_result(index, model, response):
+    if isinstance(response, Exception):
+        return {"model": model, "index": index, "response": None, "error": {"message": str(response), "status": error_status(response)}}
+    return {"model": model, "index": index, "response": response, "error": None}
+
+async def fanout_chat_completion(chat, models, stream=False):
+    """Send the same chat to each of models concurrently through chat_completion().
+
+    Returns their responses (or errors) in the order of models, or when streaming an async generator of
+    their chunks interleaved as they arrive, each tagged with "fanout": {"model", "index"}. Every model's
+    stream ends independently with a "fanout.done" event, carrying its error if it failed.
+    """
+    # resolve media once for all models
+    await process_chat(chat)
+    chats = [{**chat, "model": model} for model in models]
+    if stream:
+        return fanout_stream(chats)
+    responses = await asyncio.gather(*[chat_completion(chat) for chat in chats], return_exceptions=True)
+    for response in responses:
+        if isinstance(response, BaseException) and not isinstance(response, Exception):
+            raise response
+    return {
+        "object": "fanout",
+        "results": [fanout_result(index, model, response) for index, (model, response) in enumerate(zip(models, responses))],
+    }
+
+async def fanout_stream(chats):
+    # bounded so a slow consumer applies backpressure to the upstream streams
+    queue = asyncio.Queue(maxsize=64)
+
+    async def relay(index, chat):
+        tag = {"model": chat['model'], "index": index}
+        error = None
+        try:
+            generator = await chat_completion(chat, stream=True)
+            try:
+                async for chunk in generator:
+                    # chunks may be shared with coalesced requests, tag a copy
+                    await queue.put({**chunk, "fanout": tag})
+            finally:
+                await generator.aclose()
+        except Exception as e:
+            _log("Fan-out to %s failed: %s", chat['model'], e)
+            error = {"message": str(e), "status": error_status(e)}
+        await queue.put({"object": "fanout.done", "fanout": tag, "error": error})
+
+    tasks = [asyncio.ensure_future(relay(index, chat)) for index, chat in enumerate(chats)]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            event = await queue.get()
+            if event.get('object') == "fanout.done":
+                remaining -= 1
+            yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def cli_fanout(chat, models, raw=False):
+    """Send chat to multiple models at once, printing each answer as soon as it's complete"""
+    await process_chat(chat)
+    started_at = time.monotonic()
+
+    async def run(index, model):
+        try:
+            response = await chat_completion({**chat, "model": model})
+        except Exception as e:
+            response = e
+        return fanout_result(index, model, response), time.monotonic() - started_at
+
+    results = []
+    for next_result in asyncio.as_completed([run(index, model) for index, model in enumerate(models)]):
+        result, elapsed = await next_result
+        results.append(result)
+        if raw:
+            continue
+        print(f"## {result['model']} ({elapsed:.1f}s)\n")
+        if result['error'] is not None:
+            print(f"Error: {result['error']['message']}\n")
+        else:
+            print(result['response']['choices'][0]['message']['content'] + "\n")
+    if raw:
+        results.sort(key=lambda result: result['index'])
+        print(json.dumps({"object": "fanout", "results": results}, indent=2))
+
 async def cli_chat(chat, image=None, audio=None, file=None, args=None, raw=False):
     if g_default_model:
         chat['model'] = g_default_model
@@ -1218,6 +4022,12 @@ async def cli_chat(chat, image=None, audio=None, file=None, args=None, raw=False
     if g_verbose:
         printdump(chat)
 
+    # -m model1,model2 compares the answers of multiple models
+    models = [model.strip() for model in chat['model'].split(',') if model.strip()]
+    if len(models) > 1:
+        await cli_fanout(chat, models, raw=raw)
+        return
+
     try:
         response = await chat_completion(chat)
         if raw:
@@ -1239,11 +4049,142 @@ async def cli_chat(chat, image=None, audio=None, file=None, args=None, raw=False
         print(f"Timeout error: {e}")
         exit(1)
 
+def set_prompt(chat, prompt):
+    """Replace the content of the last user message with prompt, or add it"""
+    last_msg = chat['messages'][-1] if 'messages' in chat and chat['messages'] else None
+    if last_msg and last_msg['role'] == 'user':
+        if isinstance(last_msg['content'], list):
+            last_msg['content'][-1]['text'] = prompt
+        else:
+            last_msg['content'] = prompt
+    else:
+        chat.setdefault('messages', []).append({'role': 'user', 'content': prompt})
+    return chat
+
+async def cli_batch(input_path, output_path=None, concurrency=None, ordered=True, args=None, system=None):
+    """Run the requests in a JSONL file (or stdin with "-") concurrently, writing their results as JSONL to
+    output_path (or stdout) in input order or as they complete. Lines are chat requests in the OpenAI batch
+    format, bare chat requests or plain text prompts for the defaults/text chat template.
+    Progress is reported on stderr, returns the number of failed requests."""
+    concurrency = concurrency or g_batches.concurrency
+    from_stdin = input_path == '-'
+    input_file = sys.stdin.buffer if from_stdin else open(input_path, "rb")
+    output_file = sys.stdout.buffer if output_path in (None, '-') else open(output_path, "wb")
+    total = None if from_stdin else g_batches.count_requests(input_path)
+    stats = {"done": 0, "errors": 0, "tokens": 0}
+    started_at = time.monotonic()
+    shown_at = 0
+
+    def progress(final=False):
+        nonlocal shown_at
+        now = time.monotonic()
+        if not final and now - shown_at < 0.5:
+            return
+        shown_at = now
+        elapsed = max(now - started_at, 1e-6)
+        count = f"{stats['done']}/{total}" if total is not None else f"{stats['done']}"
+        sys.stderr.write(f"\r{count} requests, {stats['done'] / elapsed:.1f} req/s, {stats['tokens'] / elapsed:.0f} tokens/s, {stats['errors']} errors, {elapsed:.1f}s" + ("\n" if final else ""))
+        sys.stderr.flush()
+
+    def chat_request(index, line):
+        try:
+            request = g_json.loads(line)
+        except ValueError:
+            request = None
+        if isinstance(request, dict):
+            custom_id, chat = g_batches.parse_request(request)
+        else:
+            custom_id = None
+            template = g_config.get('defaults', {}).get('text', {"messages": []})
+            chat = set_prompt(json.loads(json.dumps(template)), line.decode('utf-8').strip())
+        if g_default_model:
+            chat['model'] = g_default_model
+        if system is not None:
+            chat['messages'].insert(0, {'role': 'system', 'content': system})
+        if args:
+            chat = apply_args_to_chat(chat, args)
+        # identify results written as they complete
+        return custom_id if custom_id is not None else f"request-{index + 1}", chat
+
+    results = {}
+    next_index = 0
+    window = concurrency * 100
+    flushed = asyncio.Event()
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    def write(result):
+        output_file.write(g_json.dumps(result) + b'\n')
+
+    async def process(index, line):
+        try:
+            try:
+                custom_id, chat = chat_request(index, line)
+            except Exception as e:
+                result = g_batches.error_result(None, "invalid_request", str(e))
+            else:
+                result = await g_batches.run_request(custom_id, chat)
+            stats['done'] += 1
+            if result['error'] is not None:
+                stats['errors'] += 1
+            else:
+                stats['tokens'] += (result['response']['body'].get('usage') or {}).get('total_tokens', 0)
+            if ordered:
+                nonlocal next_index
+                results[index] = result
+                while next_index in results:
+                    write(results.pop(next_index))
+                    next_index += 1
+                    flushed.set()
+            else:
+                write(result)
+            output_file.flush()
+            progress()
+        finally:
+            semaphore.release()
+
+    try:
+        index = 0
+        while True:
+            # don't block the event loop waiting for piped input
+            line = await asyncio.to_thread(input_file.readline) if from_stdin else input_file.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            while ordered and index - next_index >= window:
+                flushed.clear()
+                await flushed.wait()
+            await semaphore.acquire()
+            task = asyncio.ensure_future(process(index, line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            index += 1
+        while tasks:
+            await asyncio.wait(set(tasks))
+    finally:
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(set(tasks))
+        progress(final=True)
+        if not from_stdin:
+            input_file.close()
+        if output_file is not sys.stdout.buffer:
+            output_file.close()
+    return stats['errors']
+
 def config_str(key):
     return key in g_config and g_config[key] or None
 
 def init_llms(config):
-    global g_config, g_handlers
+    global g_config, g_handlers, g_http_pool, g_media_cache, g_convert_pool, g_json, g_routing, g_breakers, g_hedging, g_retry, g_admission, g_completion_cache, g_coalescer, g_batches
+
+    # release connection pools and clients of the providers being replaced
+    for provider in g_handlers.values():
+        retire_provider(provider)
+    retire_pool(g_http_pool)
+    previous_handlers = g_handlers
 
     g_config = config
     g_handlers = {}
@@ -1255,6 +4196,48 @@ def init_llms(config):
     # if g_verbose:
     #     printdump(g_config)
     providers = g_config['providers']
+    http_config = g_config.get('http', {})
+    g_http_pool = HttpPool(http_config)
+    rate_limit_config = g_config.get('rate_limit', {})
+    json_codec = g_config.get('json', {}).get('codec', 'auto')
+    if json_codec != g_json.config:
+        g_json = JsonCodec(json_codec)
+    # keep measured provider stats across reloads
+    routing_config = g_config.get('routing', {})
+    if routing_config != g_routing.config:
+        g_routing.flush()
+        g_routing = RoutingStats(routing_config, stats=g_routing.stats if g_routing.enabled else None)
+    breaker_config = g_config.get('circuit_breaker', {})
+    if breaker_config != g_breakers.config:
+        g_breakers = CircuitBreakers(breaker_config)
+    hedging_config = g_config.get('hedging', {})
+    if hedging_config != g_hedging.config:
+        g_hedging = Hedging(hedging_config)
+    retry_config = g_config.get('retry', {})
+    if retry_config != g_retry.config:
+        g_retry = RetryPolicy(retry_config)
+    admission_config = g_config.get('admission', {})
+    if admission_config != g_admission.config:
+        g_admission = AdmissionControl(admission_config)
+    completion_cache_config = g_config.get('cache', {})
+    if completion_cache_config != g_completion_cache.config:
+        g_completion_cache.close()
+        g_completion_cache = CompletionCache(completion_cache_config)
+    coalesce_config = g_config.get('coalesce', {})
+    if coalesce_config != g_coalescer.config:
+        g_coalescer = Coalescer(coalesce_config)
+    # keep track of the batches already running
+    batch_config = g_config.get('batch', {})
+    if batch_config != g_batches.config:
+        g_batches = Batches(batch_config, running=g_batches.running)
+    # keep cached media across reloads unless its settings changed
+    media_cache_config = g_config.get('media', {}).get('cache', {})
+    if media_cache_config != g_media_cache.config:
+        g_media_cache = MediaCache(media_cache_config)
+    convert_pool_config = {k: v for k, v in image_convert_config().items() if k in ('workers', 'max_concurrent', 'executor')}
+    if convert_pool_config != g_convert_pool.config:
+        g_convert_pool.shutdown()
+        g_convert_pool = WorkerPool(convert_pool_config)
 
     for name, orig in providers.items():
         definition = orig.copy()
@@ -1271,6 +4254,8 @@ def init_llms(config):
         # Create a copy of definition without the 'type' key for constructor kwargs
         constructor_kwargs = {k: v for k, v in definition.items() if k != 'type' and k != 'enabled'}
         constructor_kwargs['headers'] = g_config['defaults']['headers'].copy()
+        constructor_kwargs['http'] = {**http_config, **definition.get('http', {})}
+        constructor_kwargs['rate_limit'] = {**rate_limit_config, **definition.get('rate_limit', {})}
 
         if provider_type == 'OpenAiProvider' and OpenAiProvider.test(**constructor_kwargs):
             g_handlers[name] = OpenAiProvider(**constructor_kwargs)
@@ -1283,6 +4268,12 @@ def init_llms(config):
         elif provider_type == 'AirRefineryProvider' and AirRefineryProvider.test(**constructor_kwargs):
             g_handlers[name] = AirRefineryProvider(**constructor_kwargs)
 
+        # keep the remaining rate limit budgets across reloads
+        previous = previous_handlers.get(name)
+        if name in g_handlers and previous is not None and previous.limiter.config == g_handlers[name].limiter.config:
+            g_handlers[name].limiter = previous.limiter
+
+    update_model_index()
     return g_handlers
 
 async def load_llms():
@@ -1290,6 +4281,33 @@ async def load_llms():
     _log("Loading providers...")
     for name, provider in g_handlers.items():
         await provider.load()
+    # providers may have discovered more models
+    update_model_index()
+
+async def warmup_llms():
+    """Pre-open pooled connections to every enabled provider"""
+    await asyncio.gather(*[provider.warmup() for provider in g_handlers.values()], return_exceptions=True)
+
+async def close_llms():
+    """Close all pooled HTTP connections, e.g. on shutdown or before the event loop exits"""
+    for resource, task in list(g_retired_pools.items()):
+        task.cancel()
+        await resource.close()
+    g_retired_pools.clear()
+    await g_batches.close()
+    for provider in g_handlers.values():
+        await provider.close()
+    await g_http_pool.close()
+    g_completion_cache.close()
+    g_convert_pool.shutdown()
+    g_routing.flush()
+
+async def run_and_close(coro):
+    """Run coro then close the HTTP pools bound to the current event loop"""
+    try:
+        return await coro
+    finally:
+        await close_llms()
 
 def save_config(config):
     global g_config, g_config_path
@@ -1302,13 +4320,12 @@ def github_url(filename):
     return f"https://raw.githubusercontent.com/ServiceStack/llms/refs/heads/main/llms/{filename}"
 
 async def get_text(url):
-    async with aiohttp.ClientSession() as session:
-        _log(f"GET {url}")
-        async with session.get(url) as resp:
-            text = await resp.text()
-            if resp.status >= 400:
-                raise HTTPError(resp.status, reason=resp.reason, body=text, headers=dict(resp.headers))
-            return text
+    _log(f"GET {url}")
+    async with g_http_pool.session().get(url) as resp:
+        text = await resp.text()
+        if resp.status >= 400:
+            raise HTTPError(resp.status, reason=resp.reason, body=text, headers=dict(resp.headers))
+        return text
 
 async def save_text_url(url, save_path):
     text = await get_text(url)
@@ -1339,6 +4356,9 @@ def print_status():
         print(f"Disabled: {', '.join(disabled)}")
     else:
         print("Disabled: None")
+    open_circuits = g_breakers.open_circuits()
+    if len(open_circuits) > 0:
+        print(f"Open circuits: {', '.join(open_circuits)}")
 
 def home_llms_path(filename):
     return f"{os.environ.get('HOME')}/.llms/{filename}"
@@ -1545,100 +4565,283 @@ def read_resource_file_bytes(resource_file):
     except (OSError, PermissionError, AttributeError) as e:
         _log(f"Error reading resource bytes: {e}")
 
-async def check_models(provider_name, model_names=None):
+def check_error_message(e):
+    """Most descriptive message of a failed model check"""
+    if isinstance(e, asyncio.TimeoutError):
+        return "Timeout"
+    if not isinstance(e, HTTPError):
+        return str(e)[:100]
+    error_msg = f"HTTP {e.status}"
+    try:
+        # Try to parse error body for more details
+        error_body = json.loads(e.body) if e.body else {}
+        if 'error' in error_body:
+            error = error_body['error']
+            if isinstance(error, dict):
+                if 'message' in error:
+                    # OpenRouter
+                    if isinstance(error['message'], str):
+                        error_msg = error['message']
+                        if 'code' in error:
+                            error_msg = f"{error['code']} {error_msg}"
+                        if 'metadata' in error and 'raw' in error['metadata']:
+                            error_msg += f" - {error['metadata']['raw']}"
+                        if 'provider' in error:
+                            error_msg += f" ({error['provider']})"
+            elif isinstance(error, str):
+                error_msg = error
+        elif 'message' in error_body:
+            if isinstance(error_body['message'], str):
+                error_msg = error_body['message']
+            elif isinstance(error_body['message'], dict):
+                # codestral error format
+                if 'detail' in error_body['message'] and isinstance(error_body['message']['detail'], list):
+                    error_msg = error_body['message']['detail'][0]['msg']
+                    if 'loc' in error_body['message']['detail'][0] and len(error_body['message']['detail'][0]['loc']) > 0:
+                        error_msg += f" (in {' '.join(error_body['message']['detail'][0]['loc'])})"
+    except Exception as parse_error:
+        _log(f"Error parsing error body: {parse_error}")
+        error_msg = e.body[:100] if e.body else f"HTTP {e.status}"
+    return error_msg
+
+def percentiles(samples, points=(50, 90, 99)):
+    """Nearest-rank percentiles of samples in ms, None if there are no samples"""
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return {f"p{p}": int(samples[max(0, -(-p * len(samples) // 100) - 1)] * 1000) for p in points}
+
+class HealthCheck:
+    """Parallel model health checks, configured from the `health` config block.
+
+    Pings every model `pings` times, at most `concurrency` at a time across all providers, measuring the
+    time to first token (with streaming) and total time of each ping, and each provider's connect time
+    (DNS, TCP and TLS) with a separate connection per ping. Results are appended to a JSONL history and
+    recorded in the routing stats, so they seed the "latency" routing policy.
+    """
+    def __init__(self, health_config=None):
+        self.config = health_config or {}
+        self.concurrency = max(1, int(self.config.get('concurrency', 8)))
+        self.pings = max(1, int(self.config.get('pings', 1)))
+        self.timeout = float(self.config.get('timeout', 60))
+        self.stream = bool(self.config.get('stream', True))
+        self.persist = self.config.get('persist', True)
+
+    @property
+    def path(self):
+        if not self.persist:
+            return None
+        return os.path.expanduser(self.persist) if isinstance(self.persist, str) else home_llms_path("cache/health.jsonl")
+
+    async def connect(self, provider):
+        """Seconds to open a new connection to the provider's API"""
+        url = urlparse(provider.base_url)
+        port = url.port or (443 if url.scheme == 'https' else 80)
+        started_at = time.monotonic()
+        _, writer = await asyncio.open_connection(url.hostname, port, ssl=True if url.scheme == 'https' else None)
+        elapsed = time.monotonic() - started_at
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+        return elapsed
+
+    async def ping(self, provider, model):
+        """(ttft, total) seconds of a check request"""
+        chat = (provider.check or g_config['defaults']['check']).copy()
+        chat["model"] = model
+        started_at = time.monotonic()
+        if not self.stream:
+            response = await provider.chat(chat)
+            if not response or not response.get('choices'):
+                raise Exception("Invalid response format")
+            total = time.monotonic() - started_at
+            return total, total
+        ttft = None
+        generator = await provider.chat(chat, stream=True)
+        try:
+            async for chunk in generator:
+                if ttft is None and chunk.get('choices'):
+                    ttft = time.monotonic() - started_at
+        finally:
+            await generator.aclose()
+        if ttft is None:
+            raise Exception("Invalid response format")
+        return ttft, time.monotonic() - started_at
+
+    async def run(self, targets, progress=None):
+        """Check [(name, provider, [models])] targets, returns the report"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connects = {name: [] for name, _, _ in targets}
+        samples = {(name, model): {"ttft": [], "total": [], "errors": []} for name, _, models in targets for model in models}
+
+        async def limited(check):
+            # the coroutine is only created once a slot is free, so it's never left un-awaited
+            async with semaphore:
+                return await asyncio.wait_for(check(), self.timeout)
+
+        async def connect(name, provider):
+            try:
+                connects[name].append(await limited(lambda: self.connect(provider)))
+            except Exception as e:
+                _log("Connect to %s failed: %s", name, e)
+
+        async def ping(name, provider, model):
+            sample = samples[(name, model)]
+            try:
+                ttft, total = await limited(lambda: self.ping(provider, model))
+                sample['ttft'].append(ttft)
+                sample['total'].append(total)
+                g_routing.record(name, model, total, ttft)
+            except Exception as e:
+                sample['errors'].append(check_error_message(e))
+                g_routing.record_error(name, model)
+            if progress:
+                progress()
+
+        tasks = []
+        for _ in range(self.pings):
+            for name, provider, models in targets:
+                tasks.append(connect(name, provider))
+                tasks.extend(ping(name, provider, model) for model in models)
+        await asyncio.gather(*tasks)
+
+        created = int(time.time())
+        report = {"object": "health_check", "created": created, "pings": self.pings, "providers": [], "models": []}
+        for name, _, models in targets:
+            connect = percentiles(connects[name])
+            ttfts, totals, ok = [], [], 0
+            for model in models:
+                sample = samples[(name, model)]
+                ttfts.extend(sample['ttft'])
+                totals.extend(sample['total'])
+                ok += len(sample['total']) > 0
+                report['models'].append({
+                    "provider": name,
+                    "model": model,
+                    "ok": len(sample['total']),
+                    "errors": len(sample['errors']),
+                    "error": sample['errors'][-1] if sample['errors'] else None,
+                    "connect": connect,
+                    "ttft": percentiles(sample['ttft']),
+                    "total": percentiles(sample['total']),
+                })
+            report['providers'].append({
+                "provider": name,
+                "models": len(models),
+                "ok": ok,
+                "connect": connect,
+                "ttft": percentiles(ttfts),
+                "total": percentiles(totals),
+            })
+        return report
+
+    def save(self, report):
+        """Append each model's results to the history"""
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                for result in report['models']:
+                    f.write(json.dumps({"created": report['created'], "pings": report['pings'], **result}) + "\n")
+        except OSError as e:
+            _log("Error saving health check results: %s", e, level=LOG_LEVELS["warning"])
+
+def format_percentiles(stats, points=("p50", "p90")):
+    return "/".join(str(stats[p]) for p in points) + "ms" if stats else "-"
+
+async def check_models(provider_names, model_names=None, pings=None, concurrency=None, raw=False):
     """
-    Check validity of models for a specific provider by sending a ping message.
+    Check validity and latency of models by sending them ping messages concurrently.
 
     Args:
-        provider_name: Name of the provider to check
+        provider_names: Comma-separated names of the providers to check, or 'all' for all enabled providers
         model_names: List of specific model names to check, or None to check all models
+        pings: Number of times to ping each model (default: health.pings)
+        concurrency: Number of pings to run at once (default: health.concurrency)
+        raw: Print the report as JSON instead of a table
     """
-    if provider_name not in g_handlers:
-        print(f"Provider '{provider_name}' not found or not enabled")
-        print(f"Available providers: {', '.join(g_handlers.keys())}")
-        return
-
-    provider = g_handlers[provider_name]
-    models_to_check = []
-
-    # Determine which models to check
-    if model_names is None or (len(model_names) == 1 and model_names[0] == 'all'):
-        # Check all models for this provider
-        models_to_check = list(provider.models.keys())
+    if provider_names == 'all':
+        names = list(g_handlers.keys())
     else:
-        # Check only specified models
+        names = [name.strip() for name in provider_names.split(',') if name.strip()]
+    for name in names:
+        if name not in g_handlers:
+            print(f"Provider '{name}' not found or not enabled")
+            print(f"Available providers: {', '.join(g_handlers.keys())}")
+            return
+
+    check_all = model_names is None or (len(model_names) == 1 and model_names[0] == 'all')
+    targets = []
+    for name in names:
+        provider = g_handlers[name]
+        if check_all:
+            # Check all models for this provider
+            models = list(provider.models.keys())
+        else:
+            # Check only specified models
+            models = [model for model in model_names if model in provider.models]
+        if models:
+            targets.append((name, provider, models))
+    if not check_all:
         for model_name in model_names:
-            if model_name in provider.models:
-                models_to_check.append(model_name)
-            else:
-                print(f"Model '{model_name}' not found in provider '{provider_name}'")
+            if not any(model_name in models for _, _, models in targets):
+                print(f"Model '{model_name}' not found in provider{'' if len(names) == 1 else 's'} '{', '.join(names)}'")
 
-    if not models_to_check:
-        print(f"No models to check for provider '{provider_name}'")
+    if not targets:
+        print(f"No models to check for provider{'' if len(names) == 1 else 's'} '{', '.join(names)}'")
         return
 
-    print(f"\nChecking {len(models_to_check)} model{'' if len(models_to_check) == 1 else 's'} for provider '{provider_name}':\n")
-
-    # Test each model
-    for model in models_to_check:
-        # Create a simple ping chat request
-        chat = (provider.check or g_config['defaults']['check']).copy()
-        chat["model"] = model
-
-        started_at = time.time()
-        try:
-            # Try to get a response from the model
-            response = await provider.chat(chat)
-            duration_ms = int((time.time() - started_at) * 1000)
+    health_config = {**g_config.get('health', {})}
+    if pings is not None:
+        health_config['pings'] = pings
+    if concurrency is not None:
+        health_config['concurrency'] = concurrency
+    health = HealthCheck(health_config)
+
+    total = sum(len(models) for _, _, models in targets) * health.pings
+    done = 0
+    def progress():
+        nonlocal done
+        done += 1
+        sys.stderr.write(f"\r  {done}/{total} pings")
+        sys.stderr.flush()
+
+    model_count = sum(len(models) for _, _, models in targets)
+    if not raw:
+        print(f"\nChecking {model_count} model{'' if model_count == 1 else 's'} of {len(targets)} provider{'' if len(targets) == 1 else 's'}"
+            + (f", {health.pings} pings each" if health.pings > 1 else "") + f", {health.concurrency} at a time:\n")
+    # only show progress in a terminal, so it doesn't end up in captured output
+    show_progress = not raw and sys.stderr.isatty()
+    report = await health.run(targets, progress=progress if show_progress else None)
+    health.save(report)
+
+    if raw:
+        print(json.dumps(report, indent=2))
+        return
 
-            # Check if we got a valid response
-            if response and 'choices' in response and len(response['choices']) > 0:
-                print(f"  ✓ {model:<40} ({duration_ms}ms)")
-            else:
-                print(f"  ✗ {model:<40} Invalid response format")
-        except HTTPError as e:
-            duration_ms = int((time.time() - started_at) * 1000)
-            error_msg = f"HTTP {e.status}"
-            try:
-                # Try to parse error body for more details
-                error_body = json.loads(e.body) if e.body else {}
-                if 'error' in error_body:
-                    error = error_body['error']
-                    if isinstance(error, dict):
-                        if 'message' in error:
-                            # OpenRouter
-                            if isinstance(error['message'], str):
-                                error_msg = error['message']
-                                if 'code' in error:
-                                    error_msg = f"{error['code']} {error_msg}"
-                                if 'metadata' in error and 'raw' in error['metadata']:
-                                    error_msg += f" - {error['metadata']['raw']}"
-                                if 'provider' in error:
-                                    error_msg += f" ({error['provider']})"
-                    elif isinstance(error, str):
-                        error_msg = error
-                elif 'message' in error_body:
-                    if isinstance(error_body['message'], str):
-                        error_msg = error_body['message']
-                    elif isinstance(error_body['message'], dict):
-                        # codestral error format
-                        if 'detail' in error_body['message'] and isinstance(error_body['message']['detail'], list):
-                            error_msg = error_body['message']['detail'][0]['msg']
-                            if 'loc' in error_body['message']['detail'][0] and len(error_body['message']['detail'][0]['loc']) > 0:
-                                error_msg += f" (in {' '.join(error_body['message']['detail'][0]['loc'])})"
-            except Exception as parse_error:
-                _log(f"Error parsing error body: {parse_error}")
-                error_msg = e.body[:100] if e.body else f"HTTP {e.status}"
-            print(f"  ✗ {model:<40} {error_msg}")
-        except asyncio.TimeoutError:
-            duration_ms = int((time.time() - started_at) * 1000)
-            print(f"  ✗ {model:<40} Timeout after {duration_ms}ms")
-        except Exception as e:
-            duration_ms = int((time.time() - started_at) * 1000)
-            error_msg = str(e)[:100]
-            print(f"  ✗ {model:<40} {error_msg}")
+    if show_progress:
+        sys.stderr.write("\r" + " " * 40 + "\r")
+    print(f"  {'':2}{'Provider':<16} {'Model':<40} {'OK':>5} {'Connect':>9} {'TTFT p50/p90':>16} {'Total p50/p90':>16}")
+    for name, _, _ in targets:
+        results = [result for result in report['models'] if result['provider'] == name]
+        # fastest first, failures last
+        results.sort(key=lambda result: result['ttft']['p50'] if result['ttft'] else float('inf'))
+        for result in results:
+            mark = "✓" if result['errors'] == 0 else "✗"
+            line = (f"  {mark} {name:<16} {result['model']:<40} {result['ok']:>2}/{result['ok'] + result['errors']:<2} "
+                + f"{format_percentiles(result['connect'], ('p50',)):>9} {format_percentiles(result['ttft']):>16} {format_percentiles(result['total']):>16}")
+            if result['error']:
+                line += f"  {result['error']}"
+            print(line)
 
     print()
+    for summary in report['providers']:
+        print(f"  {summary['provider']}: {summary['ok']}/{summary['models']} models ok, connect {format_percentiles(summary['connect'], ('p50',))}, "
+            + f"TTFT p50/p90 {format_percentiles(summary['ttft'])}, total p50/p90 {format_percentiles(summary['total'])}")
+    print()
 
 def text_from_resource(filename):
     global _ROOT
@@ -1732,7 +4935,7 @@ async def watch_config_files(config_path, ui_path, interval=1):
                         await reload_providers()
                         _log("Providers reloaded successfully")
                     except Exception as e:
-                        _log(f"Error reloading config: {e}")
+                        _log("Error reloading config: %s", e, level=LOG_LEVELS["warning"])
         except FileNotFoundError:
             pass
 
@@ -1752,7 +4955,7 @@ async def watch_config_files(config_path, ui_path, interval=1):
                 pass
 
 def main():
-    global _ROOT, g_verbose, g_default_model, g_logprefix, g_config, g_config_path, g_ui_path
+    global _ROOT, g_verbose, g_default_model, g_logprefix, g_config, g_config_path, g_ui_path, g_log_level, g_log_sink
 
     # Load .env file if it exists
     if HAS_DOTENV:
@@ -1770,7 +4973,7 @@ def main():
 
     parser = argparse.ArgumentParser(description=f"llms v{VERSION}")
     parser.add_argument('--config',       default=None, help='Path to config file', metavar='FILE')
-    parser.add_argument('-m', '--model',  default=None, help='Model to use')
+    parser.add_argument('-m', '--model',  default=None, help='Model to use, or comma-separated models to compare')
 
     parser.add_argument('--chat',         default=None, help='OpenAI Chat Completion Request to send', metavar='REQUEST')
     parser.add_argument('-s', '--system', default=None, help='System prompt to use for chat completion', metavar='PROMPT')
@@ -1780,13 +4983,18 @@ def main():
     parser.add_argument('--args',         default=None, help='URL-encoded parameters to add to chat request (e.g. "temperature=0.7&seed=111")', metavar='PARAMS')
     parser.add_argument('--raw',          action='store_true', help='Return raw AI JSON response')
 
+    parser.add_argument('--batch',        default=None, help='Run the chat requests or prompts in a JSONL file ("-" for stdin) concurrently', metavar='FILE')
+    parser.add_argument('--concurrency',  default=None, type=int, help='Number of --batch requests or --check pings to run at once (default: batch.concurrency, health.concurrency)', metavar='N')
+    parser.add_argument('--as-completed', action='store_true', help='Write --batch results as they complete instead of in input order')
+
     parser.add_argument('--generate-image', default=None, help='Generate an image from a text prompt', metavar='PROMPT')
     parser.add_argument('--size',         default='1024x1024', help='Image size (e.g., "1024x1024", "512x512")', metavar='SIZE')
     parser.add_argument('-n',             default=1, type=int, help='Number of images to generate (1-10)', metavar='N')
-    parser.add_argument('--output',       default=None, help='Output file path for generated image', metavar='PATH')
+    parser.add_argument('--output',       default=None, help='Output file path for generated image or --batch results (default: stdout)', metavar='PATH')
 
     parser.add_argument('--list',         action='store_true', help='Show list of enabled providers and their models (alias ls provider?)')
-    parser.add_argument('--check',        default=None, help='Check validity of models for a provider', metavar='PROVIDER')
+    parser.add_argument('--check',        default=None, help='Check validity and latency of models for comma-separated providers or "all"', metavar='PROVIDER')
+    parser.add_argument('--pings',        default=None, type=int, help='Number of times --check pings each model (default: health.pings)', metavar='N')
 
     parser.add_argument('--serve',        default=None, help='Port to start an OpenAI Chat compatible server on', metavar='PORT')
 
@@ -1799,6 +5007,7 @@ def main():
     parser.add_argument('--root',         default=None, help='Change root directory for UI files', metavar='PATH')
     parser.add_argument('--logprefix',    default="",   help='Prefix used in log messages', metavar='PREFIX')
     parser.add_argument('--verbose',      action='store_true', help='Verbose output')
+    parser.add_argument('--log-level',    default=None, choices=LOG_LEVELS.keys(), help='Minimum level of log messages (default: warning, debug with --verbose)')
 
     cli_args, extra_args = parser.parse_known_args()
 
@@ -1807,6 +5016,12 @@ def main():
     if cli_args.verbose or verbose_env in ('1', 'true'):
         g_verbose = True
         # printdump(cli_args)
+    log_level = cli_args.log_level or os.environ.get('LOG_LEVEL', '').lower()
+    if log_level in LOG_LEVELS:
+        g_log_level = LOG_LEVELS[log_level]
+        g_verbose = g_verbose or g_log_level <= LOG_LEVELS["debug"]
+    elif g_verbose:
+        g_log_level = LOG_LEVELS["debug"]
     if cli_args.model:
         g_default_model = cli_args.model
     if cli_args.logprefix:
@@ -1824,13 +5039,13 @@ def main():
         if os.path.exists(home_config_path):
             print(f"llms.json already exists at {home_config_path}")
         else:
-            asyncio.run(save_default_config(home_config_path))
+            asyncio.run(run_and_close(save_default_config(home_config_path)))
             print(f"Created default config at {home_config_path}")
 
         if os.path.exists(home_ui_path):
             print(f"ui.json already exists at {home_ui_path}")
         else:
-            asyncio.run(save_text_url(github_url("ui.json"), home_ui_path))
+            asyncio.run(run_and_close(save_text_url(github_url("ui.json"), home_ui_path)))
             print(f"Created default ui config at {home_ui_path}")
         exit(0)
 
@@ -1855,12 +5070,12 @@ def main():
             g_ui_path = home_ui_path
     else:
         # ensure llms.json and ui.json exist in home directory
-        asyncio.run(save_home_configs())
+        asyncio.run(run_and_close(save_home_configs()))
         g_config_path = home_config_path
         g_ui_path = home_ui_path
         g_config = json.loads(text_from_file(g_config_path))
 
-    asyncio.run(reload_providers())
+    asyncio.run(run_and_close(reload_providers()))
 
     # print names
     _log(f"enabled providers: {', '.join(g_handlers.keys())}")
@@ -1888,10 +5103,9 @@ def main():
         exit(0)
 
     if cli_args.check is not None:
-        # Check validity of models for a provider
-        provider_name = cli_args.check
+        # Check validity and latency of models for providers
         model_names = extra_args if len(extra_args) > 0 else None
-        asyncio.run(check_models(provider_name, model_names))
+        asyncio.run(run_and_close(check_models(cli_args.check, model_names, pings=cli_args.pings, concurrency=cli_args.concurrency, raw=cli_args.raw)))
         exit(0)
 
     if cli_args.serve is not None:
@@ -1940,7 +5154,8 @@ def main():
 
         client_max_size = g_config.get('limits', {}).get('client_max_size', 20*1024*1024) # 20MB max request size (to handle base64 encoding overhead)
         _log(f"client_max_size set to {client_max_size} bytes ({client_max_size/1024/1024:.1f}MB)")
-        app = web.Application(client_max_size=client_max_size)
+
+        app = web.Application(client_max_size=client_max_size, middlewares=[admission_middleware])
 
         # Authentication middleware helper
         def check_auth(request):
@@ -1966,7 +5181,7 @@ def main():
             # Check authentication if enabled
             is_authenticated, user_data = check_auth(request)
             if not is_authenticated:
-                return web.json_response({
+                return json_response({
                     "responseStatus": {
                         "errorCode": "Unauthorized",
                         "message": "Authentication required"
@@ -1974,8 +5189,11 @@ def main():
                 }, status=401)
 
             try:
-                chat = await request.json()
+                chat = g_json.loads(await request.read())
                 stream = chat.get('stream', False)
+                cache_control = request.headers.get('Cache-Control', '')
+                if 'no-cache' in cache_control or 'no-store' in cache_control:
+                    chat['metadata'] = {**(chat.get('metadata') or {}), "cache": False}
                 
                 if stream:
                     # Handle streaming response with SSE
@@ -1991,15 +5209,18 @@ def main():
                     )
                     await response.prepare(request)
                     
+                    stream_generator = None
                     try:
                         stream_generator = await chat_completion(chat, stream=True)
                         async for chunk in stream_generator:
                             # Send SSE formatted data
-                            data = json.dumps(chunk)
-                            await response.write(f"data: {data}\n\n".encode('utf-8'))
+                            await response.write(b"data: " + g_json.dumps(chunk) + b"\n\n")
                         
                         # Send done marker
                         await response.write(b"data: [DONE]\n\n")
+                    except ConnectionResetError:
+                        # client went away, closing the stream releases its upstream connection
+                        return response
                     except Exception as e:
                         _log(f"Streaming error: {e}")
                         error_chunk = {
@@ -2008,15 +5229,17 @@ def main():
                                 "type": "server_error"
                             }
                         }
-                        await response.write(f"data: {json.dumps(error_chunk)}\n\n".encode('utf-8'))
+                        await response.write(b"data: " + g_json.dumps(error_chunk) + b"\n\n")
                     finally:
-                        await response.write_eof()
+                        if stream_generator is not None:
+                            await stream_generator.aclose()
+                    await response.write_eof()
                     
                     return response
                 else:
                     # Non-streaming response
                     response = await chat_completion(chat, stream=False)
-                    return web.json_response(response)
+                    return json_response(response)
                     
             except HTTPError as e:
                 # Upstream HTTP error (from OpenAI-compatible providers)
@@ -2033,7 +5256,7 @@ def main():
                             message = body['message']
                 except Exception:
                     pass
-                return web.json_response({
+                return json_response({
                     "responseStatus": {
                         "errorCode": e.reason or f"HTTP {status}",
                         "message": message or (e.body[:200] if isinstance(e.body, str) else None)
@@ -2043,7 +5266,7 @@ def main():
                 # Heuristic: Map common SDK auth errors to 401 for clearer UX
                 msg = str(e) if e else ""
                 status = 401 if any(s in msg.lower() for s in ["auth", "unauthorized", "invalid api key", "token", "signature"]) else 500
-                return web.json_response({
+                return json_response({
                     "responseStatus": {
                         "errorCode": "Unauthorized" if status == 401 else "ServerError",
                         "message": msg
@@ -2060,7 +5283,7 @@ def main():
             # Check authentication if enabled
             is_authenticated, user_data = check_auth(request)
             if not is_authenticated:
-                return web.json_response({
+                return json_response({
                     "responseStatus": {
                         "errorCode": "Unauthorized",
                         "message": "Authentication required"
@@ -2074,7 +5297,7 @@ def main():
                 # Required parameters
                 prompt = body.get('prompt')
                 if not prompt:
-                    return web.json_response({
+                    return json_response({
                         "responseStatus": {
                             "errorCode": "BadRequest",
                             "message": "Missing required parameter: prompt"
@@ -2090,7 +5313,7 @@ def main():
                 
                 # Validate parameters
                 if n < 1 or n > 10:
-                    return web.json_response({
+                    return json_response({
                         "responseStatus": {
                             "errorCode": "BadRequest",
                             "message": "Parameter 'n' must be between 1 and 10"
@@ -2098,7 +5321,7 @@ def main():
                     }, status=400)
                 
                 if response_format not in ('url', 'b64_json'):
-                    return web.json_response({
+                    return json_response({
                         "responseStatus": {
                             "errorCode": "BadRequest",
                             "message": "Parameter 'response_format' must be 'url' or 'b64_json'"
@@ -2109,7 +5332,7 @@ def main():
                 # For now, only airefinery supports it
                 provider = g_handlers.get('airefinery')
                 if not provider or not hasattr(provider, 'generate_image'):
-                    return web.json_response({
+                    return json_response({
                         "responseStatus": {
                             "errorCode": "NotImplemented",
                             "message": "Image generation not available. AI Refinery provider not configured."
@@ -2127,7 +5350,7 @@ def main():
                     user=user
                 )
                 
-                return web.json_response(response)
+                return json_response(response)
                 
             except HTTPError as e:
                 status = e.status or 500
@@ -2140,7 +5363,7 @@ def main():
                             message = err.get('message') if isinstance(err, dict) else str(err)
                 except Exception:
                     pass
-                return web.json_response({
+                return json_response({
                     "responseStatus": {
                         "errorCode": e.reason or f"HTTP {status}",
                         "message": message or str(e.body)[:200] if e.body else "Image generation failed"
@@ -2150,7 +5373,7 @@ def main():
                 _log(f"Image generation error: {e}")
                 if g_verbose:
                     traceback.print_exc()
-                return web.json_response({
+                return json_response({
                     "responseStatus": {
                         "errorCode": "ServerError",
                         "message": str(e)
@@ -2159,20 +5382,211 @@ def main():
         
         app.router.add_post('/v1/images/generations', images_handler)
 
+        def error_response(status, error_code, message):
+            return json_response({
+                "responseStatus": {
+                    "errorCode": error_code,
+                    "message": message
+                }
+            }, status=status)
+
+        def unauthorized_response():
+            return error_response(401, "Unauthorized", "Authentication required")
+
+        async def upload_file_handler(request):
+            """Handle POST /v1/files, a multipart upload (file, purpose) or the raw JSONL file as the body"""
+            is_authenticated, user_data = check_auth(request)
+            if not is_authenticated:
+                return unauthorized_response()
+
+            async def part_chunks(part):
+                while True:
+                    chunk = await part.read_chunk()
+                    if not chunk:
+                        break
+                    yield chunk
+
+            # files are streamed to disk, they're not limited by client_max_size
+            file = None
+            purpose = None
+            if request.content_type.startswith('multipart/'):
+                reader = await request.multipart()
+                async for part in reader:
+                    if part.name == 'purpose':
+                        purpose = await part.text()
+                    elif part.name == 'file' and file is None:
+                        file = await g_batches.create_file(part_chunks(part), part.filename or "input.jsonl")
+            else:
+                file = await g_batches.create_file(request.content.iter_chunked(64 * 1024), request.query.get('filename', "input.jsonl"))
+                purpose = request.query.get('purpose')
+            if file is None:
+                return error_response(400, "BadRequest", "Missing required parameter: file")
+            if purpose:
+                file['purpose'] = purpose
+                g_batches.save_file(file)
+            return json_response(file)
+        app.router.add_post('/v1/files', upload_file_handler)
+
+        async def file_handler(request):
+            is_authenticated, user_data = check_auth(request)
+            if not is_authenticated:
+                return unauthorized_response()
+            file = g_batches.get_file(request.match_info['file_id'])
+            if file is None:
+                return error_response(404, "NotFound", "File not found")
+            return json_response(file)
+        app.router.add_get('/v1/files/{file_id}', file_handler)
+
+        async def file_content_handler(request):
+            is_authenticated, user_data = check_auth(request)
+            if not is_authenticated:
+                return unauthorized_response()
+            file = g_batches.get_file(request.match_info['file_id'])
+            if file is None:
+                return error_response(404, "NotFound", "File not found")
+            return web.FileResponse(g_batches.file_path(file['id']), headers={'Content-Type': 'application/jsonl'})
+        app.router.add_get('/v1/files/{file_id}/content', file_content_handler)
+
+        async def create_batch_handler(request):
+            is_authenticated, user_data = check_auth(request)
+            if not is_authenticated:
+                return unauthorized_response()
+            try:
+                body = g_json.loads(await request.read())
+                batch = g_batches.create(
+                    body.get('input_file_id'),
+                    endpoint=body.get('endpoint', '/v1/chat/completions'),
+                    completion_window=body.get('completion_window', '24h'),
+                    metadata=body.get('metadata'))
+            except ValueError as e:
+                return error_response(400, "BadRequest", str(e))
+            return json_response(batch)
+        app.router.add_post('/v1/batches', create_batch_handler)
+
+        async def list_batches_handler(request):
+            is_authenticated, user_data = check_auth(request)
+            if not is_authenticated:
+                return unauthorized_response()
+            batches, has_more = g_batches.list(limit=int(request.query.get('limit', 20)), after=request.query.get('after'))
+            return json_response({
+                "object": "list",
+                "data": batches,
+                "first_id": batches[0]['id'] if batches else None,
+                "last_id": batches[-1]['id'] if batches else None,
+                "has_more": has_more,
+            })
+        app.router.add_get('/v1/batches', list_batches_handler)
+
+        async def batch_handler(request):
+            is_authenticated, user_data = check_auth(request)
+            if not is_authenticated:
+                return unauthorized_response()
+            batch = g_batches.get(request.match_info['batch_id'])
+            if batch is None:
+                return error_response(404, "NotFound", "Batch not found")
+            return json_response(batch)
+        app.router.add_get('/v1/batches/{batch_id}', batch_handler)
+
+        async def cancel_batch_handler(request):
+            is_authenticated, user_data = check_auth(request)
+            if not is_authenticated:
+                return unauthorized_response()
+            batch = g_batches.cancel(request.match_info['batch_id'])
+            if batch is None:
+                return error_response(404, "NotFound", "Batch not found")
+            return json_response(batch)
+        app.router.add_post('/v1/batches/{batch_id}/cancel', cancel_batch_handler)
+
+        async def fanout_handler(request):
+            """Handle POST /v1/chat/fanout, a chat completion request sent to each of its "models" concurrently"""
+            is_authenticated, user_data = check_auth(request)
+            if not is_authenticated:
+                return unauthorized_response()
+
+            try:
+                chat = g_json.loads(await request.read())
+            except Exception as e:
+                return error_response(400, "BadRequest", f"Invalid JSON: {e}")
+            models = chat.pop('models', None)
+            if not isinstance(models, list) or not models or not all(isinstance(model, str) and model for model in models):
+                return error_response(400, "BadRequest", "Missing required parameter: models")
+            if len(models) > MAX_FANOUT_MODELS:
+                return error_response(400, "BadRequest", f"Too many models, at most {MAX_FANOUT_MODELS} are allowed")
+            cache_control = request.headers.get('Cache-Control', '')
+            if 'no-cache' in cache_control or 'no-store' in cache_control:
+                chat['metadata'] = {**(chat.get('metadata') or {}), "cache": False}
+
+            if not chat.get('stream', False):
+                try:
+                    return json_response(await fanout_chat_completion(chat, models))
+                except Exception as e:
+                    return error_response(500, "ServerError", str(e))
+
+            response = web.StreamResponse(
+                status=200,
+                reason='OK',
+                headers={
+                    'Content-Type': 'text/event-stream',
+                    'Cache-Control': 'no-cache',
+                    'Connection': 'keep-alive',
+                    'X-Accel-Buffering': 'no',
+                }
+            )
+            await response.prepare(request)
+            events = None
+            try:
+                events = await fanout_chat_completion(chat, models, stream=True)
+                async for event in events:
+                    await response.write(b"data: " + g_json.dumps(event) + b"\n\n")
+                await response.write(b"data: [DONE]\n\n")
+            except ConnectionResetError:
+                # client went away, closing events cancels the models still streaming
+                return response
+            except Exception as e:
+                _log(f"Fan-out streaming error: {e}")
+                error_chunk = {
+                    "error": {
+                        "message": str(e),
+                        "type": "server_error"
+                    }
+                }
+                await response.write(b"data: " + g_json.dumps(error_chunk) + b"\n\n")
+            finally:
+                if events is not None:
+                    await events.aclose()
+            await response.write_eof()
+            return response
+        app.router.add_post('/v1/chat/fanout', fanout_handler)
+
         async def models_handler(request):
-            return web.json_response(get_models())
+            index = g_model_index
+            return catalog_response(request, index.models_json, index.models_etag)
         app.router.add_get('/models/list', models_handler)
 
         async def active_models_handler(request):
-            return web.json_response(get_active_models())
+            index = g_model_index
+            return catalog_response(request, index.active_models_json, index.active_models_etag)
         app.router.add_get('/models', active_models_handler)
 
+        async def routing_handler(request):
+            return json_response(g_routing.rankings(g_model_index))
+        app.router.add_get('/routing', routing_handler)
+
         async def status_handler(request):
             enabled, disabled = provider_status()
-            return web.json_response({
+            return json_response({
                 "all": list(g_config['providers'].keys()),
                 "enabled": enabled,
                 "disabled": disabled,
+                "media_cache": g_media_cache.status(),
+                "convert": g_convert_pool.status(),
+                "circuits": g_breakers.status(),
+                "hedging": g_hedging.status(),
+                "admission": g_admission.status(),
+                "completion_cache": g_completion_cache.status(),
+                "coalescing": g_coalescer.status(),
+                "batches": {batch_id: batch['request_counts'] for batch_id, (_, batch) in g_batches.running.items()},
+                "rate_limits": {name: status for name, provider in g_handlers.items() if (status := provider.limiter.status())},
             })
         app.router.add_get('/status', status_handler)
 
@@ -2189,7 +5603,7 @@ def main():
                     disable_provider(provider)
                     _log(f"Disabled provider {provider}")
             enabled, disabled = provider_status()
-            return web.json_response({
+            return json_response({
                 "enabled": enabled,
                 "disabled": disabled,
                 "feedback": msg or "",
@@ -2200,7 +5614,7 @@ def main():
         async def github_auth_handler(request):
             """Initiate GitHub OAuth flow"""
             if 'auth' not in g_config or 'github' not in g_config['auth']:
-                return web.json_response({"error": "GitHub OAuth not configured"}, status=500)
+                return json_response({"error": "GitHub OAuth not configured"}, status=500)
 
             auth_config = g_config['auth']['github']
             client_id = auth_config.get('client_id', '')
@@ -2213,7 +5627,7 @@ def main():
                 redirect_uri = os.environ.get(redirect_uri[1:], '')
 
             if not client_id:
-                return web.json_response({"error": "GitHub client_id not configured"}, status=500)
+                return json_response({"error": "GitHub client_id not configured"}, status=500)
 
             # Generate CSRF state token
             state = secrets.token_urlsafe(32)
@@ -2277,7 +5691,7 @@ def main():
             state_data = g_oauth_states.pop(state)
 
             if 'auth' not in g_config or 'github' not in g_config['auth']:
-                return web.json_response({"error": "GitHub OAuth not configured"}, status=500)
+                return json_response({"error": "GitHub OAuth not configured"}, status=500)
 
             auth_config = g_config['auth']['github']
             client_id = auth_config.get('client_id', '')
@@ -2293,7 +5707,7 @@ def main():
                 redirect_uri = os.environ.get(redirect_uri[1:], '')
 
             if not client_id or not client_secret:
-                return web.json_response({"error": "GitHub OAuth credentials not configured"}, status=500)
+                return json_response({"error": "GitHub OAuth credentials not configured"}, status=500)
 
             # Exchange code for access token
             async with aiohttp.ClientSession() as session:
@@ -2348,7 +5762,7 @@ def main():
             session_token = request.query.get('session') or request.headers.get('X-Session-Token')
 
             if not session_token or session_token not in g_sessions:
-                return web.json_response({"error": "Invalid or expired session"}, status=401)
+                return json_response({"error": "Invalid or expired session"}, status=401)
 
             session_data = g_sessions[session_token]
 
@@ -2358,7 +5772,7 @@ def main():
             for token in expired_sessions:
                 del g_sessions[token]
 
-            return web.json_response({
+            return json_response({
                 **session_data,
                 "sessionToken": session_token
             })
@@ -2370,7 +5784,7 @@ def main():
             if session_token and session_token in g_sessions:
                 del g_sessions[session_token]
 
-            return web.json_response({"success": True})
+            return json_response({"success": True})
 
         async def auth_handler(request):
             """Check authentication status and return user info"""
@@ -2379,7 +5793,7 @@ def main():
 
             if session_token and session_token in g_sessions:
                 session_data = g_sessions[session_token]
-                return web.json_response({
+                return json_response({
                     "userId": session_data.get("userId", ""),
                     "userName": session_data.get("userName", ""),
                     "displayName": session_data.get("displayName", ""),
@@ -2394,7 +5808,7 @@ def main():
             #     # You can customize this based on your API key validation logic
             #     api_key = auth_header[7:]
             #     if api_key:  # Add your API key validation logic here
-            #         return web.json_response({
+            #         return json_response({
             #             "userId": "1",
             #             "userName": "apiuser",
             #             "displayName": "API User",
@@ -2403,7 +5817,7 @@ def main():
             #         })
 
             # Not authenticated - return error in expected format
-            return web.json_response({
+            return json_response({
                 "responseStatus": {
                     "errorCode": "Unauthorized",
                     "message": "Not authenticated"
@@ -2471,7 +5885,7 @@ def main():
             # Add auth configuration
             ui['requiresAuth'] = auth_enabled
             ui['authType'] = 'oauth' if auth_enabled else 'apikey'
-            return web.json_response(ui)
+            return json_response(ui)
         app.router.add_get('/config', ui_config_handler)
 
         async def not_found_handler(request):
@@ -2494,11 +5908,25 @@ def main():
             """Start background tasks when the app starts"""
             # Start watching config files in the background
             asyncio.create_task(watch_config_files(g_config_path, g_ui_path))
+            # Pre-open upstream connections for providers configured with http.warmup
+            asyncio.create_task(warmup_llms())
+            # Continue batches interrupted by the last shutdown
+            g_batches.resume()
+
+        async def cleanup_background_tasks(app):
+            await close_llms()
 
         app.on_startup.append(start_background_tasks)
+        app.on_cleanup.append(cleanup_background_tasks)
 
         print(f"Starting server on port {port}...")
-        web.run_app(app, host='0.0.0.0', port=port, print=_log)
+        # write server logs from a background thread instead of the event loop
+        g_log_sink = LogSink()
+        try:
+            web.run_app(app, host='0.0.0.0', port=port, print=_log)
+        finally:
+            g_log_sink.close()
+            g_log_sink = None
         exit(0)
 
     if cli_args.enable is not None:
@@ -2596,7 +6024,7 @@ def main():
                 )
                 return result
 
-            response = asyncio.run(generate())
+            response = asyncio.run(run_and_close(generate()))
             
             if cli_args.raw:
                 print(json.dumps(response, indent=2))
@@ -2658,6 +6086,18 @@ def main():
                 traceback.print_exc()
             exit(1)
 
+    if cli_args.batch is not None:
+        try:
+            args = parse_args_params(cli_args.args) if cli_args.args is not None else None
+            errors = asyncio.run(run_and_close(cli_batch(cli_args.batch, cli_args.output, concurrency=cli_args.concurrency,
+                ordered=not cli_args.as_completed, args=args, system=cli_args.system)))
+            exit(1 if errors else 0)
+        except Exception as e:
+            print(f"{cli_args.logprefix}Error: {e}", file=sys.stderr)
+            if cli_args.verbose:
+                traceback.print_exc()
+            exit(1)
+
     if cli_args.chat is not None or cli_args.image is not None or cli_args.audio is not None or cli_args.file is not None or len(extra_args) > 0:
         try:
             chat = g_config['defaults']['text']
@@ -2682,23 +6122,14 @@ def main():
                 chat['messages'].insert(0, {'role': 'system', 'content': cli_args.system})
 
             if len(extra_args) > 0:
-                prompt = ' '.join(extra_args)
-                # replace content of last message if exists, else add
-                last_msg = chat['messages'][-1] if 'messages' in chat else None
-                if last_msg and last_msg['role'] == 'user':
-                    if isinstance(last_msg['content'], list):
-                        last_msg['content'][-1]['text'] = prompt
-                    else:
-                        last_msg['content'] = prompt
-                else:
-                    chat['messages'].append({'role': 'user', 'content': prompt})
+                set_prompt(chat, ' '.join(extra_args))
 
             # Parse args parameters if provided
             args = None
             if cli_args.args is not None:
                 args = parse_args_params(cli_args.args)
 
-            asyncio.run(cli_chat(chat, image=cli_args.image, audio=cli_args.audio, file=cli_args.file, args=args, raw=cli_args.raw))
+            asyncio.run(run_and_close(cli_chat(chat, image=cli_args.image, audio=cli_args.audio, file=cli_args.file, args=args, raw=cli_args.raw)))
             exit(0)
         except Exception as e:
             print(f"{cli_args.logprefix}Error: {e}")
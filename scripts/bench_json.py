@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Benchmark of the JSON codecs on the request/response hot path:
+#   relay     - decode an upstream SSE line and encode it as a downstream SSE event (per chunk)
+#   request   - parse a chat request body
+#   upstream  - serialize a chat request body for the upstream provider
+#
+# "before" is the previous str-based stdlib path, the codecs are the bytes-based JsonCodec paths.
+#
+# Usage: python scripts/bench_json.py [iterations]
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from llms.main import JsonCodec, JsonBody, HAS_ORJSON, HAS_MSGSPEC
+
+# llms.main is shadowed by the main() function re-exported from the llms package
+llms_main = sys.modules['llms.main']
+
+CHUNK = {
+    "id": "chatcmpl-9f8e7d6c5b4a",
+    "object": "chat.completion.chunk",
+    "created": 1760000000,
+    "model": "gpt-4o-mini-2024-07-18",
+    "system_fingerprint": "fp_0123456789",
+    "choices": [{"index": 0, "delta": {"content": " the quick brown fox"}, "logprobs": None, "finish_reason": None}],
+}
+
+CHAT = {
+    "model": "gpt-4o-mini",
+    "stream": True,
+    "temperature": 0.7,
+    "messages": [
+        {"role": "system", "content": "You are a helpful assistant. " * 20},
+        *[{"role": "user" if i % 2 == 0 else "assistant", "content": f"Message {i}: " + "lorem ipsum dolor sit amet " * 40} for i in range(20)],
+    ],
+}
+
+def timeit(fn, iterations):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def bench_before(iterations):
+    line = f"data: {json.dumps(CHUNK)}\n".encode('utf-8')
+    body = json.dumps(CHAT).encode('utf-8')
+    def relay():
+        data = line.decode('utf-8').strip()[6:]
+        chunk = json.loads(data)
+        return f"data: {json.dumps(chunk)}\n\n".encode('utf-8')
+    return {
+        "relay": timeit(relay, iterations),
+        "request": timeit(lambda: json.loads(body.decode('utf-8')), iterations // 10),
+        "upstream": timeit(lambda: json.dumps(CHAT).encode('utf-8'), iterations // 10),
+    }
+
+def bench_codec(codec, iterations):
+    line = b"data: " + codec.dumps(CHUNK) + b"\n"
+    body = codec.dumps(CHAT)
+    def relay():
+        chunk = codec.loads(line.strip()[6:])
+        return b"data: " + codec.dumps(chunk) + b"\n\n"
+    def upstream():
+        return JsonBody(CHAT).data()
+    return {
+        "relay": timeit(relay, iterations),
+        "request": timeit(lambda: codec.loads(body), iterations // 10),
+        "upstream": timeit(upstream, iterations // 10),
+    }
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    results = {"before": bench_before(iterations)}
+    for name in ["stdlib"] + (["msgspec"] if HAS_MSGSPEC else []) + (["orjson"] if HAS_ORJSON else []):
+        llms_main.g_json = JsonCodec(name)
+        results[name] = bench_codec(llms_main.g_json, iterations)
+
+    print(f"{'codec':<10} {'relay/chunk':>14} {'request':>12} {'upstream':>12}")
+    for name, result in results.items():
+        print(f"{name:<10} {result['relay']:>12.2f}us {result['request']:>10.2f}us {result['upstream']:>10.2f}us")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Microbenchmark of the logging done for every chat request when logging is disabled (not --verbose).
+#
+#   before - the previous eager calls, which formatted every message and deep-cloned/summarized the
+#            chat (including its base64 image) before _log() checked g_verbose
+#   after  - the lazy _log() calls used now
+#
+# Reports the time and the peak memory allocated per request, measured with tracemalloc.
+#
+# Usage: python scripts/bench_logging.py [iterations]
+
+import os
+import sys
+import json
+import time
+import base64
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from llms.main import _log, chat_summary, format_json
+
+def old_chat_summary(chat):
+    clone = json.loads(json.dumps(chat))
+    for message in clone['messages']:
+        if isinstance(message.get('content'), list):
+            for item in message['content']:
+                if 'image_url' in item:
+                    url = item['image_url']['url']
+                    prefix = url.split(',', 1)[0]
+                    item['image_url']['url'] = prefix + f",({len(url) - len(prefix)})"
+    return json.dumps(clone, indent=2)
+
+def old_log(message):
+    if False:
+        print(message, flush=True)
+
+CHAT_URL = "https://api.openai.com/v1/chat/completions"
+CHAT = {
+    "model": "gpt-4o-mini",
+    "messages": [{"role": "user", "content": [
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64," + base64.b64encode(os.urandom(1024 * 1024)).decode()}},
+        {"type": "text", "text": "Describe the key features of the input image"},
+    ]}],
+}
+RESPONSE = {
+    "id": "chatcmpl-123", "object": "chat.completion", "model": "gpt-4o-mini",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "A mountain landscape. " * 50}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1000, "completion_tokens": 200, "total_tokens": 1200},
+}
+
+def before(name="openai", stream=False):
+    old_log(f"provider: {name} OpenAiProvider (stream={stream})")
+    old_log(f"POST {CHAT_URL} (stream={stream})")
+    old_log(old_chat_summary(CHAT))
+    old_log(json.dumps(RESPONSE, indent=2))
+
+def after(name="openai", stream=False):
+    _log("provider: %s %s (stream=%s)", name, "OpenAiProvider", stream)
+    _log("POST %s (stream=%s)", CHAT_URL, stream)
+    _log(chat_summary, CHAT)
+    _log(format_json, RESPONSE)
+
+def bench(fn, iterations):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = (time.perf_counter() - start) / iterations * 1e6
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak - baseline, current - baseline
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    print(f"{'':<8} {'time/request':>14} {'peak alloc':>14} {'retained':>10}")
+    for name, fn in [("before", before), ("after", after)]:
+        elapsed, peak, retained = bench(fn, iterations)
+        print(f"{name:<8} {elapsed:>12.2f}us {peak:>12,}B {retained:>9,}B")
+
+if __name__ == "__main__":
+    main()
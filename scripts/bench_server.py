@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+
+# Offline benchmark of the overhead `llms --serve` adds to chat requests.
+#
+# Starts a mock upstream serving the OpenAI, Ollama and Gemini APIs with a configurable latency and
+# token rate, runs `llms --serve` against it and drives both with a load generator, reporting:
+#
+#   latency     - added latency of chat requests, through the server minus direct to the upstream
+#   ttfb        - added time to first byte of streaming requests
+#   throughput  - max requests/s through the server with an instant upstream, and its CPU per request
+#   memory      - server RSS per concurrent open stream
+#
+# Results are printed as JSON (and written to --output), so a regression in chat_handler, process_chat
+# or the SSE relay shows up as a number. Nothing leaves the machine and the server runs with a
+# temporary HOME, so ~/.llms is left untouched.
+#
+# Usage: python scripts/bench_server.py [--requests N] [--concurrency N] [--latency MS]
+#                                       [--tokens N] [--tokens-per-second N] [--duration SECONDS]
+#                                       [--streams N] [--output results.json]
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+PROMPT = "Summarize the following notes in three bullet points.\n\n" + "The quick brown fox jumps over the lazy dog. " * 40
+
+PROVIDERS = {
+    "openai": {"type": "OpenAiProvider", "path": "/openai", "api_key": "bench"},
+    "ollama": {"type": "OllamaProvider", "path": "/ollama"},
+    "gemini": {"type": "GoogleProvider", "path": "/gemini", "api_key": "bench"},
+}
+
+# Mock upstream, run in its own process so it doesn't compete with the load generator
+
+class MockUpstream:
+    def __init__(self):
+        self.latency = 0.0
+        self.tokens = 64
+        self.tokens_per_second = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/_config', self.configure)
+        app.router.add_post('/openai/v1/chat/completions', self.openai_chat)
+        app.router.add_post('/ollama/v1/chat/completions', self.openai_chat)
+        app.router.add_get('/ollama/api/tags', self.ollama_tags)
+        app.router.add_post('/gemini/v1beta/models/{action}', self.gemini_chat)
+        return app
+
+    async def configure(self, request):
+        config = await request.json()
+        self.latency = config.get('latency', self.latency)
+        self.tokens = config.get('tokens', self.tokens)
+        self.tokens_per_second = config.get('tokens_per_second', self.tokens_per_second)
+        return web.json_response({"latency": self.latency, "tokens": self.tokens, "tokens_per_second": self.tokens_per_second})
+
+    async def token_delay(self):
+        if self.tokens_per_second:
+            await asyncio.sleep(1 / self.tokens_per_second)
+
+    async def sse(self, request, events, done=False):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        try:
+            async for event in events:
+                await response.write(b"data: " + json.dumps(event).encode('utf-8') + b"\n\n")
+            if done:
+                await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            return response
+        await response.write_eof()
+        return response
+
+    def usage(self):
+        return {"prompt_tokens": len(PROMPT) // 4, "completion_tokens": self.tokens, "total_tokens": len(PROMPT) // 4 + self.tokens}
+
+    async def openai_chat(self, request):
+        chat = await request.json()
+        await asyncio.sleep(self.latency)
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": chat['model']}
+        if not chat.get('stream'):
+            return web.json_response({**base, "object": "chat.completion", "usage": self.usage(),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " token" * self.tokens}, "finish_reason": "stop"}]})
+
+        async def events():
+            for i in range(self.tokens):
+                if i > 0:
+                    await self.token_delay()
+                last = i == self.tokens - 1
+                chunk = {**base, "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": " token"}, "finish_reason": "stop" if last else None}]}
+                if last:
+                    chunk['usage'] = self.usage()
+                yield chunk
+        return await self.sse(request, events(), done=True)
+
+    async def ollama_tags(self, request):
+        return web.json_response({"models": [{"name": "bench-ollama"}]})
+
+    async def gemini_chat(self, request):
+        model, method = request.match_info['action'].split(':', 1)
+        await request.json()
+        await asyncio.sleep(self.latency)
+        usage = {"promptTokenCount": len(PROMPT) // 4, "candidatesTokenCount": self.tokens, "totalTokenCount": len(PROMPT) // 4 + self.tokens}
+        if method == 'generateContent':
+            return web.json_response({"modelVersion": model, "usageMetadata": usage,
+                "candidates": [{"index": 0, "finishReason": "STOP", "content": {"role": "model", "parts": [{"text": " token" * self.tokens}]}}]})
+
+        async def events():
+            for i in range(self.tokens):
+                if i > 0:
+                    await self.token_delay()
+                candidate = {"index": 0, "content": {"role": "model", "parts": [{"text": " token"}]}}
+                event = {"modelVersion": model, "candidates": [candidate]}
+                if i == self.tokens - 1:
+                    candidate['finishReason'] = "STOP"
+                    event['usageMetadata'] = usage
+                yield event
+        return await self.sse(request, events())
+
+def run_mock(port):
+    web.run_app(MockUpstream().app(), host='127.0.0.1', port=port, print=None, access_log=None)
+
+# Load generator
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+async def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception(f"Process exited with {process.returncode}")
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise Exception(f"Timed out waiting for port {port}")
+
+def process_stats(pid):
+    """(cpu seconds, rss bytes) of a process"""
+    try:
+        import psutil
+        process = psutil.Process(pid)
+        cpu = process.cpu_times()
+        return cpu.user + cpu.system, process.memory_info().rss
+    except ImportError:
+        pass
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return cpu, rss
+
+def percentiles(samples, points=(50, 90, 99)):
+    samples = sorted(samples)
+    return {f"p{p}": round(samples[max(0, -(-p * len(samples) // 100) - 1)] * 1000, 3) for p in points}
+
+def difference(proxy, direct):
+    return {p: round(proxy[p] - direct[p], 3) for p in proxy}
+
+def openai_request(model, stream):
+    return {
+        "model": model,
+        "temperature": 0.7,
+        "stream": stream,
+        "messages": [
+            {"role": "system", "content": "You are a concise assistant."},
+            {"role": "user", "content": PROMPT},
+        ],
+    }
+
+def gemini_request():
+    return {
+        "systemInstruction": {"parts": [{"text": "You are a concise assistant."}]},
+        "contents": [{"role": "user", "parts": [{"text": PROMPT}]}],
+        "generationConfig": {"temperature": 0.7},
+    }
+
+class Bench:
+    def __init__(self, args, mock_url, server_url, server_pid):
+        self.args = args
+        self.mock_url = mock_url
+        self.server_url = server_url
+        self.server_pid = server_pid
+        self.session = None
+
+    def direct_request(self, name, stream):
+        """(url, body) of a request sent straight to the mock upstream"""
+        path = PROVIDERS[name]['path']
+        if name == 'gemini':
+            method = "streamGenerateContent?alt=sse&key=bench" if stream else "generateContent?key=bench"
+            return f"{self.mock_url}{path}/v1beta/models/bench-gemini:{method}", gemini_request()
+        return f"{self.mock_url}{path}/v1/chat/completions", openai_request(f"bench-{name}", stream)
+
+    def proxy_request(self, name, stream):
+        return f"{self.server_url}/v1/chat/completions", openai_request(f"bench-{name}", stream)
+
+    async def configure(self, **config):
+        async with self.session.post(f"{self.mock_url}/_config", json=config) as res:
+            await res.read()
+
+    async def request(self, url, body, stream):
+        """(time to first byte, total time) of a request"""
+        started_at = time.perf_counter()
+        async with self.session.post(url, data=json.dumps(body), headers={"Content-Type": "application/json"}) as res:
+            if res.status != 200:
+                raise Exception(f"HTTP {res.status}: {(await res.text())[:200]}")
+            if not stream:
+                await res.read()
+                elapsed = time.perf_counter() - started_at
+                return elapsed, elapsed
+            await res.content.readany()
+            ttfb = time.perf_counter() - started_at
+            async for _ in res.content.iter_any():
+                pass
+            return ttfb, time.perf_counter() - started_at
+
+    async def load(self, url, body, stream, requests, concurrency):
+        """Send requests with at most concurrency in flight, returns their (ttfb, total) times"""
+        results = []
+        remaining = requests
+        async def worker():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                results.append(await self.request(url, body, stream))
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        return results
+
+    async def closed_loop(self, url, body, stream, concurrency, duration):
+        """Number of requests completed in duration with concurrency in flight"""
+        deadline = time.monotonic() + duration
+        completed = 0
+        async def worker():
+            nonlocal completed
+            while time.monotonic() < deadline:
+                await self.request(url, body, stream)
+                completed += 1
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        return completed
+
+    async def compare(self, name, stream):
+        """Latency (or TTFB when streaming) percentiles direct to the upstream and through the server"""
+        index = 0 if stream else 1
+        report = {}
+        for target, request in [("direct", self.direct_request), ("proxy", self.proxy_request)]:
+            url, body = request(name, stream)
+            # warm up connections
+            await self.load(url, body, stream, self.args.concurrency, self.args.concurrency)
+            results = await self.load(url, body, stream, self.args.requests, self.args.concurrency)
+            report[target] = percentiles([result[index] for result in results])
+        report['added'] = difference(report['proxy'], report['direct'])
+        return report
+
+    async def throughput(self, stream):
+        url, body = self.proxy_request("openai", stream)
+        await self.load(url, body, stream, 64, 64)
+        cpu_before, _ = process_stats(self.server_pid)
+        started_at = time.monotonic()
+        completed = await self.closed_loop(url, body, stream, 64, self.args.duration)
+        elapsed = time.monotonic() - started_at
+        cpu_after, _ = process_stats(self.server_pid)
+        return {
+            "requests": completed,
+            "requests_per_second": round(completed / elapsed, 1),
+            "cpu_ms_per_request": round((cpu_after - cpu_before) * 1000 / max(1, completed), 3),
+        }
+
+    async def memory(self):
+        """Server RSS growth per stream with streams concurrently open"""
+        streams = self.args.streams
+        # each stream stays open for its whole duration while RSS is measured
+        await self.configure(latency=0, tokens=30, tokens_per_second=1)
+        url, body = self.proxy_request("openai", True)
+        _, baseline = process_stats(self.server_pid)
+        opened = asyncio.Event()
+        count = 0
+        async def hold():
+            nonlocal count
+            async with self.session.post(url, data=json.dumps(body), headers={"Content-Type": "application/json"}) as res:
+                await res.content.readany()
+                count += 1
+                if count == streams:
+                    opened.set()
+                await asyncio.sleep(3600)
+        tasks = [asyncio.ensure_future(hold()) for _ in range(streams)]
+        try:
+            await asyncio.wait_for(opened.wait(), 60)
+            await asyncio.sleep(0.5)
+            _, rss = process_stats(self.server_pid)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return {
+            "streams": streams,
+            "baseline_rss_mb": round(baseline / 1024 / 1024, 1),
+            "rss_mb": round(rss / 1024 / 1024, 1),
+            "kb_per_stream": round((rss - baseline) / 1024 / streams, 1),
+        }
+
+    async def run(self):
+        args = self.args
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=600)) as session:
+            self.session = session
+            results = {
+                "config": {
+                    "requests": args.requests,
+                    "concurrency": args.concurrency,
+                    "latency_ms": args.latency,
+                    "tokens": args.tokens,
+                    "tokens_per_second": args.tokens_per_second,
+                    "duration": args.duration,
+                    "python": sys.version.split()[0],
+                },
+                "providers": {},
+            }
+            for name in PROVIDERS:
+                log(f"{name}: latency")
+                await self.configure(latency=args.latency / 1000, tokens=args.tokens, tokens_per_second=0)
+                latency = await self.compare(name, stream=False)
+                log(f"{name}: ttfb")
+                await self.configure(tokens_per_second=args.tokens_per_second)
+                ttfb = await self.compare(name, stream=True)
+                results['providers'][name] = {"latency": latency, "ttfb": ttfb}
+
+            await self.configure(latency=0, tokens=args.tokens, tokens_per_second=0)
+            log("throughput: chat")
+            chat = await self.throughput(stream=False)
+            log("throughput: stream")
+            stream = await self.throughput(stream=True)
+            results['throughput'] = {"chat": chat, "stream": stream}
+            log("memory")
+            results['memory'] = await self.memory()
+            return results
+
+def log(message):
+    sys.stderr.write(f"{message}\n")
+    sys.stderr.flush()
+
+def write_config(path, mock_url):
+    config = {
+        "defaults": {
+            "headers": {"Content-Type": "application/json"},
+            "text": {"model": "bench-openai", "messages": [{"role": "user", "content": ""}]},
+        },
+        "providers": {},
+    }
+    for name, provider in PROVIDERS.items():
+        config['providers'][name] = {
+            "enabled": True,
+            "type": provider['type'],
+            "base_url": f"{mock_url}{provider['path']}",
+            "models": {f"bench-{name}": f"bench-{name}"},
+            **({"api_key": provider['api_key']} if 'api_key' in provider else {}),
+        }
+    with open(path, "w") as f:
+        json.dump(config, f, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the overhead of llms --serve against a mock upstream")
+    parser.add_argument('--requests', default=500, type=int, help='Requests per latency measurement')
+    parser.add_argument('--concurrency', default=8, type=int, help='Concurrent requests of latency measurements')
+    parser.add_argument('--latency', default=20, type=float, help='Upstream latency in ms')
+    parser.add_argument('--tokens', default=64, type=int, help='Tokens in each response')
+    parser.add_argument('--tokens-per-second', default=1000, type=float, help='Upstream token rate of streaming responses')
+    parser.add_argument('--duration', default=5, type=float, help='Seconds to run each throughput measurement')
+    parser.add_argument('--streams', default=200, type=int, help='Concurrent streams of the memory measurement')
+    parser.add_argument('--output', default=None, help='Also write the JSON results to this file')
+    parser.add_argument('--mock', default=None, type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mock is not None:
+        run_mock(args.mock)
+        return
+
+    tmp = tempfile.mkdtemp(prefix="llms-bench-")
+    processes = []
+    try:
+        mock_port = free_port()
+        server_port = free_port()
+        mock_url = f"http://127.0.0.1:{mock_port}"
+        config_path = os.path.join(tmp, "llms.json")
+        write_config(config_path, mock_url)
+        shutil.copy(os.path.join(ROOT, "llms", "ui.json"), os.path.join(tmp, "ui.json"))
+
+        mock = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--mock", str(mock_port)])
+        processes.append(mock)
+        server_log = open(os.path.join(tmp, "server.log"), "w")
+        server = subprocess.Popen([sys.executable, "-m", "llms", "--config", config_path, "--serve", str(server_port)],
+            cwd=ROOT, env={**os.environ, "HOME": tmp}, stdout=server_log, stderr=subprocess.STDOUT)
+        processes.append(server)
+
+        async def run():
+            await wait_for_port(mock_port, mock)
+            await wait_for_port(server_port, server)
+            return await Bench(args, mock_url, f"http://127.0.0.1:{server_port}", server.pid).run()
+
+        try:
+            results = asyncio.run(run())
+        except Exception:
+            server_log.flush()
+            with open(os.path.join(tmp, "server.log")) as f:
+                log(f.read()[-2000:])
+            raise
+
+        output = json.dumps(results, indent=2)
+        print(output)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output + "\n")
+    finally:
+        for process in processes:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -39,6 +39,9 @@ setup(
         ]
     },
     install_requires=requirements,
+    extras_require={
+        "fast": ["orjson"],
+    },
     python_requires=">=3.12",
     entry_points={
         "console_scripts": [
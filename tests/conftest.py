@@ -0,0 +1,299 @@
+"""
+Shared fixtures for the llms tests.
+
+There's no async pytest plugin dependency, coroutine tests are run on a fresh event loop by
+pytest_pyfunc_call below, which also closes the HTTP pools and providers they created.
+Upstream providers are mocked with aiohttp test servers.
+"""
+import asyncio
+import hashlib
+import importlib
+import inspect
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+# llms/__init__.py re-exports main's names, the module itself is needed to reach its globals
+m = importlib.import_module('llms.main')
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    kwargs = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    asyncio.run(m.run_and_close(pyfuncitem.obj(**kwargs)))
+    return True
+
+
+@pytest.fixture(autouse=True)
+def llms_state(tmp_path, monkeypatch):
+    """Isolate ~/.llms and reset the module's global state between tests"""
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setattr(m, 'g_handlers', {})
+    monkeypatch.setattr(m, 'g_json', m.JsonCodec())
+    monkeypatch.setattr(m, 'g_routing', m.RoutingStats())
+    monkeypatch.setattr(m, 'g_breakers', m.CircuitBreakers())
+    monkeypatch.setattr(m, 'g_hedging', m.Hedging())
+    monkeypatch.setattr(m, 'g_retry', m.RetryPolicy())
+    monkeypatch.setattr(m, 'g_admission', m.AdmissionControl())
+    monkeypatch.setattr(m, 'g_completion_cache', m.CompletionCache())
+    monkeypatch.setattr(m, 'g_coalescer', m.Coalescer())
+    monkeypatch.setattr(m, 'g_batches', m.Batches())
+    monkeypatch.setattr(m, 'g_model_index', m.ModelIndex())
+    monkeypatch.setattr(m, 'g_retired_pools', {})
+    monkeypatch.setattr(m, 'g_http_pool', m.HttpPool())
+    monkeypatch.setattr(m, 'g_media_cache', m.MediaCache())
+    monkeypatch.setattr(m, 'g_convert_pool', m.WorkerPool())
+    return m
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Fake time.monotonic(), only for sync tests as the event loop's clock is time.monotonic() too"""
+    clock = Clock()
+    monkeypatch.setattr(m.time, 'monotonic', clock)
+    return clock
+
+
+def completion(content, id='chatcmpl-test', usage=None):
+    return {
+        "id": id,
+        "object": "chat.completion",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": usage or {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5},
+    }
+
+
+def chunk(content, finish_reason=None, id='chatcmpl-test'):
+    return {
+        "id": id,
+        "object": "chat.completion.chunk",
+        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": finish_reason}],
+    }
+
+
+class Upstream:
+    """Mock OpenAI compatible /v1/chat/completions upstream.
+
+    Replies with completion(reply) or streams it one word per chunk, after delay seconds, with the
+    given response headers. Queued (status, headers) failures are returned first, one per request.
+    """
+    def __init__(self, reply="hello world", delay=0, headers=None):
+        self.reply = reply
+        self.delay = delay
+        self.headers = headers or {}
+        self.failures = []
+        self.requests = []
+        self.bodies = []
+        self.content_lengths = []
+        self.cancelled = 0
+        self.server = None
+
+    @property
+    def calls(self):
+        return len(self.requests)
+
+    @property
+    def url(self):
+        return str(self.server.make_url('')).rstrip('/')
+
+    async def handler(self, request):
+        body = await request.read()
+        self.bodies.append(body)
+        self.content_lengths.append(request.content_length)
+        chat = json.loads(body)
+        self.requests.append(chat)
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.failures:
+            status, headers = self.failures.pop(0)
+            return web.json_response({"error": {"message": f"HTTP {status}"}}, status=status, headers=headers)
+        if not chat.get('stream'):
+            return web.json_response(completion(self.reply), headers=self.headers)
+        response = web.StreamResponse(headers={**self.headers, 'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        words = self.reply.split(' ')
+        for i, word in enumerate(words):
+            data = chunk(word if i == 0 else ' ' + word, 'stop' if i == len(words) - 1 else None)
+            await response.write(b'data: ' + json.dumps(data).encode('utf-8') + b'\n\n')
+            await asyncio.sleep(0.01)
+        await response.write(b'data: [DONE]\n\n')
+        return response
+
+    def add_routes(self, router):
+        router.add_post('/v1/chat/completions', self.handler)
+
+    async def __aenter__(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.add_routes(app.router)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.server.close()
+
+
+class GeminiUpstream(Upstream):
+    """Mock Gemini generateContent and streamGenerateContent (SSE) upstream.
+
+    Streams thought, then reply one word per event, the last one with finish_reason and every event with
+    the cumulative usageMetadata. Queued failures are returned as Gemini error bodies.
+    """
+    def __init__(self, reply="hello world", thought=None, finish_reason="STOP", delay=0):
+        super().__init__(reply, delay)
+        self.thought = thought
+        self.finish_reason = finish_reason
+        self.urls = []
+
+    def add_routes(self, router):
+        router.add_post('/v1beta/models/{method}', self.handler)
+
+    def usage(self, completion_tokens):
+        return {"promptTokenCount": 3, "candidatesTokenCount": completion_tokens, "totalTokenCount": 3 + completion_tokens}
+
+    def event(self, parts, finish_reason=None, usage=None):
+        candidate = {"content": {"role": "model", "parts": parts}, "index": 0}
+        if finish_reason:
+            candidate["finishReason"] = finish_reason
+        return {"candidates": [candidate], "usageMetadata": usage, "modelVersion": "gemini-test"}
+
+    async def handler(self, request):
+        body = await request.read()
+        self.bodies.append(body)
+        self.content_lengths.append(request.content_length)
+        self.urls.append(request.rel_url)
+        self.requests.append(json.loads(body))
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            status, headers = self.failures.pop(0)
+            error = {"error": {"code": status, "message": f"Gemini error {status}", "status": "INVALID_ARGUMENT"}}
+            return web.json_response(error, status=status, headers=headers)
+        words = self.reply.split(' ')
+        thought = [{"text": self.thought, "thought": True}] if self.thought else []
+        if request.match_info['method'].endswith(':generateContent'):
+            parts = thought + [{"text": self.reply}]
+            return web.json_response(self.event(parts, self.finish_reason, self.usage(len(words))))
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        events = [self.event(thought, usage=self.usage(0))] if thought else []
+        for i, word in enumerate(words):
+            last = i == len(words) - 1
+            events.append(self.event([{"text": word if i == 0 else ' ' + word}], self.finish_reason if last else None, self.usage(i + 1)))
+        for event in events:
+            await response.write(b'data: ' + json.dumps(event).encode('utf-8') + b'\r\n\r\n')
+            await asyncio.sleep(0.01)
+        return response
+
+
+class MediaServer:
+    """Mock media host serving files {name: (content_type, data)} after delay seconds.
+
+    Responses carry an ETag, so conditional requests get a 304 while the file is unchanged.
+    Names in missing are a 404, returned straight away.
+    """
+    def __init__(self, files=None, delay=0):
+        self.files = files or {}
+        self.delay = delay
+        self.missing = set()
+        self.requests = []
+        self.not_modified = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.server = None
+
+    def url(self, name):
+        return str(self.server.make_url(f'/{name}'))
+
+    def etag(self, name):
+        return '"' + hashlib.sha256(self.files[name][1]).hexdigest()[:16] + '"'
+
+    async def handler(self, request):
+        name = request.match_info['name']
+        self.requests.append(name)
+        if name in self.missing or name not in self.files:
+            return web.Response(status=404)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        etag = self.etag(name)
+        if request.headers.get('If-None-Match') == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={'ETag': etag})
+        content_type, data = self.files[name]
+        return web.Response(body=data, headers={'Content-Type': content_type, 'ETag': etag})
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get('/{name}', self.handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.server.close()
+
+
+@pytest.fixture
+def upstream():
+    return Upstream
+
+
+@pytest.fixture
+def media_server():
+    return MediaServer
+
+
+@pytest.fixture
+def gemini_upstream():
+    return GeminiUpstream
+
+
+@pytest.fixture
+def provider():
+    """OpenAiProvider config for an Upstream"""
+    def config(upstream, models=('m',), **kwargs):
+        return {
+            "type": "OpenAiProvider",
+            "base_url": upstream.url,
+            "api_key": "test",
+            "models": {model: model for model in models},
+            **kwargs,
+        }
+    return config
+
+
+@pytest.fixture
+def init_llms():
+    """init_llms() with the given providers and config blocks"""
+    def init(providers, **config):
+        return m.init_llms({
+            "defaults": {"headers": {"Content-Type": "application/json"}},
+            "providers": providers,
+            **config,
+        })
+    return init
+
+
+@pytest.fixture
+def chat():
+    def create(content="hi", model="m", **kwargs):
+        return {"model": model, "messages": [{"role": "user", "content": content}], **kwargs}
+    return create
@@ -0,0 +1,144 @@
+import asyncio
+import importlib
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+m = importlib.import_module('llms.main')
+
+
+class App:
+    """Server behind admission_middleware whose handlers wait until released"""
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.running = 0
+        self.max_running = 0
+        self.order = []
+
+    async def handler(self, request):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        self.order.append(request.query.get('n'))
+        try:
+            await self.release.wait()
+        finally:
+            self.running -= 1
+        return web.json_response({"ok": True})
+
+    async def __aenter__(self):
+        app = web.Application(middlewares=[m.admission_middleware])
+        for path in (*m.PROXIED_ROUTES, '/models'):
+            app.router.add_post(path, self.handler)
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release.set()
+        await self.client.close()
+
+    async def post(self, path='/v1/chat/completions', n=None):
+        return await self.client.post(path, params={'n': str(n)} if n is not None else None)
+
+
+async def wait_until(predicate, timeout=5):
+    async with asyncio.timeout(timeout):
+        while not predicate():
+            await asyncio.sleep(0.01)
+
+
+def admission(**config):
+    return m.AdmissionControl({"queue_timeout": 5, **config})
+
+
+async def test_requests_over_the_limit_are_queued_in_order(monkeypatch):
+    monkeypatch.setattr(m, 'g_admission', admission(max_concurrent=2, max_queue=10))
+    async with App() as app:
+        requests = []
+        for n in range(6):
+            requests.append(asyncio.ensure_future(app.post(n=n)))
+            await wait_until(lambda: app.running + len(m.g_admission.limit.waiters) == n + 1)
+        assert (app.running, len(m.g_admission.limit.waiters)) == (2, 4)
+        app.release.set()
+        responses = await asyncio.gather(*requests)
+        assert [response.status for response in responses] == [200] * 6
+        assert app.max_running == 2
+        assert app.order == [str(n) for n in range(6)]
+        assert m.g_admission.status()["global"]["in_flight"] == 0
+
+
+async def test_full_queue_is_shed_with_retry_after(monkeypatch):
+    monkeypatch.setattr(m, 'g_admission', admission(max_concurrent=1, max_queue=1, retry_after=3))
+    async with App() as app:
+        running = asyncio.ensure_future(app.post())
+        await wait_until(lambda: app.running == 1)
+        queued = asyncio.ensure_future(app.post())
+        await wait_until(lambda: len(m.g_admission.limit.waiters) == 1)
+
+        response = await app.post()
+        assert response.status == 503
+        assert response.headers['Retry-After'] == "3"
+        body = await response.json()
+        assert body["responseStatus"]["errorCode"] == "ServiceUnavailable"
+        assert "queue is full" in body["responseStatus"]["message"]
+
+        app.release.set()
+        assert [(await request).status for request in (running, queued)] == [200, 200]
+        assert m.g_admission.limit.stats == {"admitted": 2, "rejected": 1, "timed_out": 0}
+
+
+async def test_queue_timeout(monkeypatch):
+    monkeypatch.setattr(m, 'g_admission', admission(max_concurrent=1, max_queue=10, queue_timeout=0.1))
+    async with App() as app:
+        running = asyncio.ensure_future(app.post())
+        await wait_until(lambda: app.running == 1)
+        response = await app.post()
+        assert response.status == 503
+        assert response.headers['Retry-After'] == "1"
+        assert "timed out after 0.1s in queue" in (await response.json())["responseStatus"]["message"]
+        # the timed out request gave up its place in the queue
+        assert not m.g_admission.limit.waiters
+        app.release.set()
+        assert (await running).status == 200
+        assert m.g_admission.limit.stats["timed_out"] == 1
+
+
+async def test_route_limit_and_global_limit(monkeypatch):
+    monkeypatch.setattr(m, 'g_admission', admission(max_concurrent=3, max_queue=0,
+        routes={"/v1/chat/fanout": {"max_concurrent": 1, "max_queue": 0}}))
+    async with App() as app:
+        fanout = asyncio.ensure_future(app.post('/v1/chat/fanout'))
+        await wait_until(lambda: app.running == 1)
+        # the route's own limit
+        assert (await app.post('/v1/chat/fanout')).status == 503
+        assert m.g_admission.routes["/v1/chat/fanout"].stats["rejected"] == 1
+        # the global limit is shared with the routes that aren't listed
+        chats = [asyncio.ensure_future(app.post()) for _ in range(2)]
+        await wait_until(lambda: app.running == 3)
+        assert (await app.post('/v1/images/generations')).status == 503
+        app.release.set()
+        assert [(await request).status for request in (fanout, *chats)] == [200] * 3
+
+
+@pytest.mark.parametrize("path", m.PROXIED_ROUTES)
+async def test_unlisted_proxied_routes_are_limited(monkeypatch, path):
+    monkeypatch.setattr(m, 'g_admission', admission(max_concurrent=1, max_queue=0, routes={}))
+    async with App() as app:
+        running = asyncio.ensure_future(app.post(path))
+        await wait_until(lambda: app.running == 1)
+        assert (await app.post(path)).status == 503
+        # other routes aren't admitted
+        models = asyncio.ensure_future(app.post('/models'))
+        await wait_until(lambda: app.running == 2)
+        app.release.set()
+        assert [(await request).status for request in (running, models)] == [200, 200]
+
+
+async def test_disabled(monkeypatch):
+    monkeypatch.setattr(m, 'g_admission', admission(enabled=False, max_concurrent=1, max_queue=0))
+    async with App() as app:
+        requests = [asyncio.ensure_future(app.post()) for _ in range(3)]
+        await wait_until(lambda: app.running == 3)
+        app.release.set()
+        assert [(await request).status for request in requests] == [200] * 3
@@ -0,0 +1,149 @@
+import asyncio
+import importlib
+import sys
+import types
+
+import pytest
+
+m = importlib.import_module('llms.main')
+
+
+class Model:
+    """Pydantic-like SDK object"""
+    def __init__(self, **data):
+        self.data = data
+
+    def model_dump(self):
+        return self.data
+
+
+class Stream:
+    def __init__(self, chunks, gate):
+        self.chunks = chunks
+        self.gate = gate
+        self.closed = False
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for i, chunk in enumerate(self.chunks):
+            if i == 1:
+                # the rest of the stream only arrives once the first chunk was consumed
+                await self.gate.wait()
+            yield Model(**chunk)
+
+    async def close(self):
+        self.closed = True
+
+
+class AsyncAIRefinery:
+    """Fake airefinery-sdk client"""
+    instances = []
+
+    def __init__(self, api_key, base_url):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.calls = []
+        self.streams = []
+        self.gate = asyncio.Event()
+        self.closed = False
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+        self.instances.append(self)
+
+    async def create(self, model, messages, **kwargs):
+        self.calls.append({"model": model, "messages": messages, **kwargs})
+        words = ["hello", " sdk"]
+        if not kwargs['stream']:
+            return Model(id="sdk", object="chat.completion", model=model,
+                choices=[{"index": 0, "message": {"role": "assistant", "content": ''.join(words)}, "finish_reason": "stop"}])
+        chunks = [{"id": "sdk", "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            for word in words]
+        stream = Stream(chunks, self.gate)
+        self.streams.append(stream)
+        return stream
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def sdk(monkeypatch):
+    air = types.ModuleType('air')
+    client = types.ModuleType('air.client')
+    client.AsyncAIRefinery = AsyncAIRefinery
+    air.client = client
+    monkeypatch.setitem(sys.modules, 'air', air)
+    monkeypatch.setitem(sys.modules, 'air.client', client)
+    monkeypatch.setattr(AsyncAIRefinery, 'instances', [])
+    return AsyncAIRefinery
+
+
+@pytest.fixture
+def airefinery():
+    def config(base_url="http://airefinery.test", **kwargs):
+        return {"type": "AirRefineryProvider", "base_url": base_url, "api_key": "secret", "models": {"m": "provider-m"}, **kwargs}
+    return config
+
+
+async def test_chat(sdk, airefinery, init_llms, chat):
+    init_llms({"air": airefinery(temperature=0.5)})
+    response = await m.chat_completion(chat(metadata={"cache": False}))
+    assert response["choices"][0]["message"]["content"] == "hello sdk"
+    client, = sdk.instances
+    assert (client.api_key, client.base_url) == ("secret", "http://airefinery.test")
+    call, = client.calls
+    assert (call["model"], call["stream"], call["temperature"]) == ("provider-m", False, 0.5)
+    assert call["messages"] == [{"role": "user", "content": "hi"}]
+    assert "metadata" not in call
+
+
+async def test_stream_is_relayed_as_it_arrives(sdk, airefinery, init_llms, chat):
+    init_llms({"air": airefinery()})
+    response = await m.chat_completion(chat(stream=True), stream=True)
+    client, = sdk.instances
+    assert client.calls[0]["stream"] is True
+    # the first chunk is yielded before the rest of the stream arrived
+    first = await asyncio.wait_for(response.__anext__(), 1)
+    assert first["choices"][0]["delta"]["content"] == "hello"
+    client.gate.set()
+    assert [chunk["choices"][0]["delta"]["content"] async for chunk in response] == [" sdk"]
+    assert client.streams[0].closed
+
+
+async def test_closing_the_stream_early_closes_the_sdk_stream(sdk, airefinery, init_llms, chat):
+    init_llms({"air": airefinery()})
+    response = await m.chat_completion(chat(stream=True), stream=True)
+    async for _ in response:
+        break
+    await response.aclose()
+    assert sdk.instances[0].streams[0].closed
+
+
+async def test_client_is_reused(sdk, airefinery, init_llms, chat):
+    init_llms({"air": airefinery()})
+    await asyncio.gather(*[m.chat_completion(chat()) for _ in range(3)])
+    client, = sdk.instances
+    assert len(client.calls) == 3
+    await m.g_handlers["air"].close()
+    assert client.closed
+
+
+async def test_replaced_client_is_closed_after_its_timeout(sdk, airefinery, init_llms, chat):
+    init_llms({"air": airefinery(http={"timeout": 0.1})})
+    old = m.g_handlers["air"]
+    await m.chat_completion(chat())
+    init_llms({"air": airefinery()})
+    assert old in m.g_retired_pools
+    await asyncio.sleep(0.2)
+    assert sdk.instances[0].closed
+    assert old not in m.g_retired_pools
+
+
+async def test_falls_back_to_http_without_the_sdk(monkeypatch, upstream, airefinery, init_llms, chat):
+    monkeypatch.setitem(sys.modules, 'air.client', None)
+    async with upstream(reply="over http") as up:
+        init_llms({"air": airefinery(up.url)})
+        response = await m.chat_completion(chat())
+    assert response["choices"][0]["message"]["content"] == "over http"
+    assert up.requests[0]["model"] == "provider-m"
@@ -0,0 +1,160 @@
+import asyncio
+import importlib
+import json
+
+import pytest
+
+m = importlib.import_module('llms.main')
+
+
+async def chunks(data, size=7):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def jsonl(requests):
+    return b''.join(json.dumps(request).encode('utf-8') + b'\n' for request in requests)
+
+
+def request(i, content=None):
+    return {"custom_id": f"req-{i}", "method": "POST", "url": "/v1/chat/completions",
+        "body": {"model": "m", "messages": [{"role": "user", "content": content or f"hello {i}"}]}}
+
+
+def results(batches, batch):
+    with open(batches.file_path(batch['output_file_id']), 'rb') as f:
+        return [json.loads(line) for line in f]
+
+
+async def wait_for(batches, batch_id, timeout=10):
+    task, _ = batches.running[batch_id]
+    await asyncio.wait_for(asyncio.shield(task), timeout)
+    return batches.get(batch_id)
+
+
+@pytest.fixture
+def batch_path(tmp_path):
+    return str(tmp_path / "batches")
+
+
+async def test_create_file(batch_path):
+    batches = m.Batches({"path": batch_path})
+    data = jsonl([request(i) for i in range(3)])
+    file = await batches.create_file(chunks(data), "input.jsonl")
+    assert file["bytes"] == len(data)
+    assert batches.get_file(file["id"]) == file
+    with open(batches.file_path(file["id"]), 'rb') as f:
+        assert f.read() == data
+    assert batches.get_file("file-../../etc/passwd") is None
+    with pytest.raises(ValueError):
+        batches.create("file-" + "0" * 24)
+    with pytest.raises(ValueError):
+        batches.create(file["id"], endpoint="/v1/embeddings")
+
+
+async def test_batch_results_are_in_input_order(upstream, provider, init_llms, batch_path):
+    async with upstream() as up:
+        init_llms({"a": provider(up)})
+        batches = m.Batches({"path": batch_path, "concurrency": 4})
+        lines = [request(i) for i in range(20)]
+        lines[5] = {"custom_id": "req-5", "body": {"messages": []}}
+        data = jsonl(lines[:10]) + b'\n' + b'not json\n' + jsonl(lines[10:])
+        file = await batches.create_file(chunks(data), "input.jsonl")
+        batch = batches.create(file["id"], metadata={"job": "test"})
+        assert batch["status"] == "validating"
+        batch = await wait_for(batches, batch["id"])
+
+        assert batch["status"] == "completed"
+        assert batch["request_counts"] == {"total": 21, "completed": 19, "failed": 2}
+        assert batch["metadata"] == {"job": "test"}
+        output = results(batches, batch)
+        assert [result["custom_id"] for result in output] == [f"req-{i}" for i in range(10)] + [None] + [f"req-{i}" for i in range(10, 20)]
+        assert output[5]["error"]["code"] == "invalid_request"
+        assert output[10]["error"]["code"] == "invalid_request"
+        assert output[0]["response"]["status_code"] == 200
+        assert output[0]["response"]["body"]["choices"][0]["message"]["content"] == "hello world"
+        assert batches.get_file(batch["output_file_id"])["bytes"] > 0
+        # persisted
+        assert m.Batches({"path": batch_path}).get(batch["id"]) == batch
+        assert m.Batches({"path": batch_path}).list() == ([batch], False)
+
+
+async def test_batch_resumes_after_restart(upstream, provider, init_llms, batch_path):
+    async with upstream(delay=0.05) as up:
+        init_llms({"a": provider(up)})
+        batches = m.Batches({"path": batch_path, "concurrency": 2})
+        file = await batches.create_file(chunks(jsonl([request(i) for i in range(30)])), "input.jsonl")
+        batch = batches.create(file["id"])
+        await asyncio.sleep(0.3)
+        # the server stops
+        await batches.close()
+        stopped = m.Batches({"path": batch_path}).get(batch["id"])
+        assert stopped["status"] == "in_progress"
+        written = len(results(batches, stopped))
+        assert 0 < written < 30
+        assert stopped["request_counts"]["completed"] == written
+        calls = up.calls
+
+        restarted = m.Batches({"path": batch_path, "concurrency": 8})
+        restarted.resume()
+        batch = await wait_for(restarted, batch["id"])
+        assert batch["status"] == "completed"
+        assert batch["request_counts"] == {"total": 30, "completed": 30, "failed": 0}
+        assert [result["custom_id"] for result in results(restarted, batch)] == [f"req-{i}" for i in range(30)]
+        # only requests without a result were run again
+        assert up.calls - calls <= 30 - written + 2
+
+
+async def test_partial_result_line_is_dropped(tmp_path):
+    batches = m.Batches({"path": str(tmp_path)})
+    path = tmp_path / "output.jsonl"
+    path.write_bytes(b'{"error": null}\n{"error": {"code": "x"}}\n{"error": nu')
+    assert batches.count_results(str(path)) == (2, 1)
+    assert path.read_bytes() == b'{"error": null}\n{"error": {"code": "x"}}\n'
+
+
+async def test_cancel(upstream, provider, init_llms, batch_path):
+    async with upstream(delay=0.1) as up:
+        init_llms({"a": provider(up)})
+        batches = m.Batches({"path": batch_path, "concurrency": 1})
+        file = await batches.create_file(chunks(jsonl([request(i) for i in range(20)])), "input.jsonl")
+        batch = batches.create(file["id"])
+        await asyncio.sleep(0.25)
+        assert batches.cancel(batch["id"])["status"] == "cancelling"
+        with pytest.raises(asyncio.CancelledError):
+            await wait_for(batches, batch["id"])
+        batch = m.Batches({"path": batch_path}).get(batch["id"])
+        assert batch["status"] == "cancelled"
+        assert batch["request_counts"]["completed"] == len(results(batches, batch)) < 20
+
+
+async def test_cancelling_batch_is_cancelled_on_resume(upstream, provider, init_llms, batch_path):
+    async with upstream(delay=0.1) as up:
+        init_llms({"a": provider(up)})
+        batches = m.Batches({"path": batch_path})
+        file = await batches.create_file(chunks(jsonl([request(i) for i in range(5)])), "input.jsonl")
+        batch = batches.create(file["id"])
+        await asyncio.sleep(0)
+        # the server stopped while the batch was being cancelled
+        batch["status"] = "cancelling"
+        await batches.close()
+        restarted = m.Batches({"path": batch_path})
+        restarted.resume()
+        assert restarted.running == {}
+        assert restarted.get(batch["id"])["status"] == "cancelled"
+
+
+async def test_rate_limited_requests_are_retried(upstream, provider, init_llms, batch_path):
+    async with upstream() as up:
+        up.failures = [(429, {"Retry-After": "0.01"})] * 2
+        init_llms({"a": provider(up)}, retry={"max_retries": 0})
+        batches = m.Batches({"path": batch_path, "max_attempts": 3})
+        file = await batches.create_file(chunks(jsonl([request(0)])), "input.jsonl")
+        batch = await wait_for(batches, batches.create(file["id"])["id"])
+        assert batch["request_counts"] == {"total": 1, "completed": 1, "failed": 0}
+        assert up.calls == 3
+
+        up.failures = [(429, {"Retry-After": "0.01"})] * 3
+        batch = await wait_for(batches, batches.create(file["id"])["id"])
+        assert batch["request_counts"] == {"total": 1, "completed": 0, "failed": 1}
+        assert results(batches, batch)[0]["response"]["status_code"] == 429
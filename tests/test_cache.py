@@ -0,0 +1,156 @@
+import asyncio
+import importlib
+
+m = importlib.import_module('llms.main')
+
+
+def completion(content):
+    return {"id": content, "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]}
+
+
+def test_cacheable(chat):
+    assert not m.CompletionCache().cacheable(chat(temperature=0))
+    cache = m.CompletionCache({"enabled": True})
+    assert cache.cacheable(chat(temperature=0))
+    assert cache.cacheable(chat(seed=1))
+    assert not cache.cacheable(chat())
+    assert cache.cacheable(chat(metadata={"cache": True}))
+    assert not cache.cacheable(chat(temperature=0, metadata={"cache": False}))
+    assert cache.stats["bypassed"] == 2
+    assert m.CompletionCache({"enabled": True, "deterministic_only": False}).cacheable(chat())
+
+
+async def test_completion_key(chat):
+    key = await m.completion_key(chat(temperature=0))
+    assert key == await m.completion_key(chat(temperature=0, stream=True, metadata={"cache": True}))
+    assert key != await m.completion_key(chat("other", temperature=0))
+    assert key != await m.completion_key(chat(temperature=0, seed=1))
+    # large requests are hashed in a thread, to the same key
+    large = "x" * (m.INLINE_KEY_LIMIT + 1)
+    assert m.key_cost(chat(large)) > m.INLINE_KEY_LIMIT
+    assert await m.completion_key(chat(large)) == m.canonical_hash(chat(large))
+
+
+async def test_media_is_keyed_by_content(tmp_path, chat):
+    for name, data in (("a", b"a"), ("b", b"a"), ("c", b"c")):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "doc.pdf").write_bytes(data * 1000)
+
+    def request(name):
+        return chat([{"type": "file", "file": {"file_data": str(tmp_path / name / "doc.pdf")}}])
+    assert await m.completion_key(request("a")) == await m.completion_key(request("b"))
+    assert await m.completion_key(request("a")) != await m.completion_key(request("c"))
+
+
+async def test_lru_eviction():
+    cache = m.CompletionCache({"enabled": True, "max_entries": 2})
+    await cache.put("a", completion("a"))
+    await cache.put("b", completion("b"))
+    assert (await cache.get("a"))["id"] == "a"
+    await cache.put("c", completion("c"))
+    # b was the least recently used
+    assert await cache.get("b") is None
+    assert (await cache.get("a"))["metadata"]["cache"] == "hit"
+    assert (await cache.get("c"))["id"] == "c"
+    assert cache.status() == {"hits": 3, "sqlite_hits": 0, "misses": 1, "bypassed": 0, "stores": 3,
+        "entries": 2, "max_entries": 2, "sqlite": False}
+
+
+async def test_ttl():
+    cache = m.CompletionCache({"enabled": True, "ttl": 0.05})
+    await cache.put("a", completion("a"))
+    assert await cache.get("a") is not None
+    await asyncio.sleep(0.1)
+    assert await cache.get("a") is None
+    assert cache.status()["entries"] == 0
+
+
+async def test_incomplete_responses_arent_stored():
+    cache = m.CompletionCache({"enabled": True})
+    await cache.put("empty", {"choices": []})
+    response = completion("partial")
+    response["choices"][0]["finish_reason"] = None
+    await cache.put("partial", response)
+    assert cache.status()["stores"] == 0
+
+
+async def test_sqlite_tier_is_shared(tmp_path):
+    path = str(tmp_path / "completions.db")
+    writer = m.CompletionCache({"enabled": True, "sqlite": path})
+    reader = m.CompletionCache({"enabled": True, "sqlite": path})
+    try:
+        await writer.put("a", completion("a"))
+        assert (await reader.get("a"))["id"] == "a"
+        # promoted to the reader's memory tier
+        assert (await reader.get("a"))["id"] == "a"
+        assert (reader.stats["sqlite_hits"], reader.stats["hits"]) == (1, 1)
+        assert await reader.get("b") is None
+    finally:
+        writer.close()
+        reader.close()
+
+    # survives a restart
+    restarted = m.CompletionCache({"enabled": True, "sqlite": path})
+    try:
+        assert (await restarted.get("a"))["id"] == "a"
+    finally:
+        restarted.close()
+
+
+async def test_sqlite_entries_expire(tmp_path):
+    cache = m.CompletionCache({"enabled": True, "sqlite": str(tmp_path / "completions.db"), "ttl": 0.05})
+    try:
+        await cache.put("a", completion("a"))
+        await asyncio.sleep(0.1)
+        assert await cache.get("a") is None
+        assert cache.stats["sqlite_hits"] == 0
+    finally:
+        cache.close()
+
+
+async def test_default_sqlite_path(tmp_path):
+    cache = m.CompletionCache({"enabled": True, "sqlite": True})
+    try:
+        await cache.put("a", completion("a"))
+    finally:
+        cache.close()
+    assert (tmp_path / ".llms" / "cache" / "completions.db").exists()
+
+
+async def test_chat_completions_are_cached(upstream, provider, init_llms, chat):
+    async with upstream(reply="cached reply") as up:
+        init_llms({"a": provider(up)}, cache={"enabled": True})
+        first = await m.chat_completion(chat(temperature=0))
+        assert "cache" not in first.get("metadata", {})
+        second = await m.chat_completion(chat(temperature=0))
+        assert second["choices"][0]["message"]["content"] == "cached reply"
+        assert second["metadata"]["cache"] == "hit"
+        # replayed as a stream
+        response = await m.chat_completion(chat(temperature=0, stream=True), stream=True)
+        assert ''.join([chunk['choices'][0]['delta'].get('content', '') async for chunk in response]) == "cached reply"
+        assert up.calls == 1
+        # not deterministic
+        await m.chat_completion(chat(temperature=1))
+        assert up.calls == 2
+
+
+async def test_streamed_completions_are_cached(upstream, provider, init_llms, chat):
+    async with upstream(reply="streamed reply") as up:
+        init_llms({"a": provider(up)}, cache={"enabled": True})
+        response = await m.chat_completion(chat(seed=1, stream=True), stream=True)
+        assert ''.join([chunk['choices'][0]['delta']['content'] async for chunk in response]) == "streamed reply"
+        cached = await m.chat_completion(chat(seed=1))
+        assert cached["choices"][0]["message"]["content"] == "streamed reply"
+        assert cached["choices"][0]["finish_reason"] == "stop"
+        assert up.calls == 1
+
+
+async def test_abandoned_streams_arent_cached(upstream, provider, init_llms, chat):
+    async with upstream(reply="one two three") as up:
+        init_llms({"a": provider(up)}, cache={"enabled": True})
+        response = await m.chat_completion(chat(seed=1, stream=True), stream=True)
+        async for _ in response:
+            break
+        await response.aclose()
+        await m.chat_completion(chat(seed=1))
+        assert up.calls == 2
@@ -0,0 +1,122 @@
+import importlib
+
+import pytest
+
+m = importlib.import_module('llms.main')
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = m.CircuitBreaker(failure_threshold=3, cooldown=10)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.status() == {"state": "open", "failures": 3, "retry_in": 10}
+
+
+def test_half_open_probe_closes_on_success(clock):
+    breaker = m.CircuitBreaker(failure_threshold=1, cooldown=10, half_open_probes=1)
+    breaker.failure()
+    clock.now += 9.9
+    assert not breaker.allow()
+    clock.now += 0.1
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    # only one probe at a time
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed" and breaker.failures == 0
+    assert breaker.allow() and breaker.allow()
+
+
+def test_half_open_probe_reopens_on_failure(clock):
+    breaker = m.CircuitBreaker(failure_threshold=5, cooldown=10)
+    for _ in range(5):
+        breaker.failure()
+    clock.now += 10
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    clock.now += 10
+    assert breaker.allow()
+
+
+def test_released_probe_can_be_retried(clock):
+    breaker = m.CircuitBreaker(failure_threshold=1, cooldown=10)
+    breaker.failure()
+    clock.now += 10
+    assert breaker.allow()
+    assert not breaker.allow()
+    # e.g. the probing request was cancelled
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_client_errors_dont_count(clock):
+    breakers = m.CircuitBreakers({"failure_threshold": 2})
+    for status in (400, 401, 404, 422, 429):
+        assert breakers.allow("a", "m")
+        breakers.failure("a", "m", m.HTTPError(status, "", ""))
+    assert breakers.open_circuits() == []
+    for e in (m.HTTPError(500, "", ""), m.HTTPError(408, "", "")):
+        assert breakers.allow("a", "m")
+        breakers.failure("a", "m", e)
+    assert breakers.open_circuits() == ["a", "a/m"]
+    assert not breakers.allow("a", "other")
+
+
+def test_model_circuit_leaves_provider_open_for_other_models(clock):
+    breakers = m.CircuitBreakers({"failure_threshold": 3, "model_failure_threshold": 1})
+    breakers.failure("a", "m1", m.HTTPError(503, "", ""))
+    assert not breakers.allow("a", "m1")
+    assert breakers.allow("a", "m2")
+    assert breakers.status()["models"] == {"a/m1": {"state": "open", "failures": 1, "retry_in": 30}}
+
+
+def test_disabled(clock):
+    breakers = m.CircuitBreakers({"enabled": False, "failure_threshold": 1})
+    breakers.failure("a", "m", m.HTTPError(500, "", ""))
+    assert breakers.allow("a", "m")
+    assert breakers.open_circuits() == []
+
+
+async def test_fallback_skips_open_circuits(upstream, provider, init_llms, chat):
+    async with upstream(reply="from a") as a, upstream(reply="from b") as b:
+        init_llms({"a": provider(a), "b": provider(b)},
+            circuit_breaker={"failure_threshold": 2, "cooldown": 60}, retry={"max_retries": 0})
+        a.failures = [(500, None)] * 2
+        for _ in range(2):
+            response = await m.chat_completion(chat())
+            assert response['choices'][0]['message']['content'] == "from b"
+        assert a.calls == 2
+        assert m.g_breakers.open_circuits() == ["a", "a/m"]
+
+        response = await m.chat_completion(chat())
+        assert response['choices'][0]['message']['content'] == "from b"
+        # a wasn't tried while its circuit is open
+        assert a.calls == 2 and b.calls == 3
+
+        init_llms({"a": provider(a)}, circuit_breaker={"failure_threshold": 2, "cooldown": 60}, retry={"max_retries": 0})
+        with pytest.raises(Exception, match="circuits are open"):
+            await m.chat_completion(chat())
+
+
+async def test_retried_rate_limit_doesnt_open_the_circuit(upstream, provider, init_llms, chat):
+    async with upstream(reply="from a") as a, upstream(reply="from b") as b:
+        # the default thresholds and retries
+        init_llms({"a": provider(a), "b": provider(b)},
+            circuit_breaker={"failure_threshold": 5, "model_failure_threshold": 3}, retry={"max_retries": 2, "max_retry_after": 1})
+        a.failures = [(429, {"Retry-After": "0.01"})] * 3
+        response = await m.chat_completion(chat())
+        # 1 try + 2 retries were rate limited before falling back
+        assert response['choices'][0]['message']['content'] == "from b"
+        assert a.calls == 3
+        assert m.g_breakers.open_circuits() == []
+        response = await m.chat_completion(chat())
+        assert response['choices'][0]['message']['content'] == "from a"
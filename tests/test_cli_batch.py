@@ -0,0 +1,124 @@
+import importlib
+import io
+import json
+from types import SimpleNamespace
+
+m = importlib.import_module('llms.main')
+
+DEFAULTS = {
+    "headers": {"Content-Type": "application/json"},
+    "text": {"model": "m", "temperature": 0.5, "messages": [{"role": "user", "content": ""}]},
+}
+
+
+def jsonl(lines):
+    return b''.join((json.dumps(line) if isinstance(line, dict) else line).encode('utf-8') + b'\n' for line in lines)
+
+
+def read_results(path):
+    with open(path, 'rb') as f:
+        return [json.loads(line) for line in f]
+
+
+async def test_lines_in_each_format(tmp_path, upstream, provider, init_llms, chat):
+    input_path = tmp_path / "input.jsonl"
+    input_path.write_bytes(jsonl([
+        {"custom_id": "batch", "method": "POST", "url": "/v1/chat/completions", "body": chat("in batch format")},
+        chat("bare chat"),
+        "",
+        "a plain text prompt",
+        {"custom_id": "missing model", "body": {"messages": []}},
+    ]))
+    async with upstream(reply="batched reply") as up:
+        init_llms({"a": provider(up)}, defaults=DEFAULTS)
+        errors = await m.cli_batch(str(input_path), str(tmp_path / "output.jsonl"), concurrency=2)
+    assert errors == 1
+    results = read_results(tmp_path / "output.jsonl")
+    # blank lines are skipped, results without a custom_id are numbered by request
+    assert [result["custom_id"] for result in results] == ["batch", "request-2", "request-3", None]
+    assert [result["response"]["body"]["choices"][0]["message"]["content"] for result in results[:3]] == ["batched reply"] * 3
+    assert results[3]["error"]["code"] == "invalid_request"
+    assert sorted(request["messages"][-1]["content"] for request in up.requests) == ["a plain text prompt", "bare chat", "in batch format"]
+    # plain text prompts use the defaults/text template
+    assert [request["temperature"] for request in up.requests if request["messages"][-1]["content"] == "a plain text prompt"] == [0.5]
+
+
+async def test_system_prompt_and_args(tmp_path, upstream, provider, init_llms, chat):
+    input_path = tmp_path / "input.jsonl"
+    input_path.write_bytes(jsonl([chat("one"), "two"]))
+    async with upstream() as up:
+        init_llms({"a": provider(up)}, defaults=DEFAULTS)
+        await m.cli_batch(str(input_path), str(tmp_path / "output.jsonl"), system="be brief", args={"max_completion_tokens": "10"})
+    for request in up.requests:
+        assert request["messages"][0] == {"role": "system", "content": "be brief"}
+        assert request["max_completion_tokens"] == 10
+
+
+class CountingUpstream:
+    """Upstream wrapper recording the most requests it was handling at once"""
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.in_flight = 0
+        self.max_in_flight = 0
+        handler = upstream.handler
+
+        async def counting_handler(request):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                return await handler(request)
+            finally:
+                self.in_flight -= 1
+        upstream.handler = counting_handler
+
+
+async def test_concurrency_and_input_order(tmp_path, upstream, provider, init_llms, chat):
+    input_path = tmp_path / "input.jsonl"
+    input_path.write_bytes(jsonl([chat(f"prompt {i}") for i in range(40)]))
+    up = upstream(delay=0.02)
+    counter = CountingUpstream(up)
+    async with up:
+        init_llms({"a": provider(up)})
+        errors = await m.cli_batch(str(input_path), str(tmp_path / "output.jsonl"), concurrency=8)
+    assert errors == 0
+    assert counter.max_in_flight == 8
+    assert [result["custom_id"] for result in read_results(tmp_path / "output.jsonl")] == [f"request-{i + 1}" for i in range(40)]
+
+
+async def test_as_completed(tmp_path, upstream, provider, init_llms, chat):
+    input_path = tmp_path / "input.jsonl"
+    input_path.write_bytes(jsonl([chat(f"prompt {i}") for i in range(20)]))
+    async with upstream() as up:
+        init_llms({"a": provider(up)})
+        await m.cli_batch(str(input_path), str(tmp_path / "output.jsonl"), concurrency=4, ordered=False)
+    results = read_results(tmp_path / "output.jsonl")
+    assert sorted(result["custom_id"] for result in results) == sorted(f"request-{i + 1}" for i in range(20))
+
+
+async def test_failed_requests_are_counted(tmp_path, upstream, provider, init_llms, chat, capsys):
+    input_path = tmp_path / "input.jsonl"
+    input_path.write_bytes(jsonl([chat("one"), chat("two")]))
+    async with upstream() as up:
+        up.failures = [(400, None)]
+        init_llms({"a": provider(up)})
+        errors = await m.cli_batch(str(input_path), str(tmp_path / "output.jsonl"), concurrency=1)
+    assert errors == 1
+    results = read_results(tmp_path / "output.jsonl")
+    assert results[0]["response"]["status_code"] == 400
+    assert results[0]["error"]["code"] == "request_failed"
+    assert results[1]["error"] is None
+    # progress is reported on stderr
+    assert "2/2 requests" in capsys.readouterr().err
+
+
+async def test_stdin_to_stdout(monkeypatch, upstream, provider, init_llms, chat, capsys):
+    stdout = SimpleNamespace(buffer=io.BytesIO())
+    monkeypatch.setattr(m.sys, 'stdin', SimpleNamespace(buffer=io.BytesIO(jsonl([chat("one"), chat("two")]))))
+    monkeypatch.setattr(m.sys, 'stdout', stdout)
+    async with upstream(reply="piped") as up:
+        init_llms({"a": provider(up)})
+        assert await m.cli_batch('-') == 0
+    results = [json.loads(line) for line in stdout.buffer.getvalue().splitlines()]
+    assert [result["response"]["body"]["choices"][0]["message"]["content"] for result in results] == ["piped", "piped"]
+    # the total isn't known up front
+    assert "2 requests" in capsys.readouterr().err
@@ -0,0 +1,121 @@
+import asyncio
+import gc
+import importlib
+
+import pytest
+
+m = importlib.import_module('llms.main')
+
+
+def test_coalescable(chat):
+    assert not m.Coalescer().coalescable(chat(temperature=0))
+    coalescer = m.Coalescer({"enabled": True})
+    assert coalescer.coalescable(chat(temperature=0))
+    assert not coalescer.coalescable(chat())
+    assert coalescer.coalescable(chat(metadata={"coalesce": True}))
+    assert not coalescer.coalescable(chat(seed=1, metadata={"coalesce": False}))
+
+
+async def content(response):
+    return ''.join([chunk['choices'][0]['delta']['content'] async for chunk in response])
+
+
+async def test_identical_requests_share_one_call(upstream, provider, init_llms, chat):
+    async with upstream(reply="shared", delay=0.2) as up:
+        init_llms({"a": provider(up)}, coalesce={"enabled": True})
+        responses = await asyncio.gather(*[m.chat_completion(chat(temperature=0)) for _ in range(5)])
+        assert up.calls == 1
+        assert [response["choices"][0]["message"]["content"] for response in responses] == ["shared"] * 5
+        # each request gets its own copy
+        assert len({id(response) for response in responses}) == 5
+        assert m.g_coalescer.status() == {"flights": 1, "coalesced": 4, "in_flight": 0}
+
+        # different requests aren't coalesced
+        await asyncio.gather(m.chat_completion(chat("a", temperature=0)), m.chat_completion(chat("b", temperature=0)))
+        assert up.calls == 3
+
+
+async def test_identical_streams_share_one_call(upstream, provider, init_llms, chat):
+    async with upstream(reply="one two three four", delay=0.1) as up:
+        init_llms({"a": provider(up)}, coalesce={"enabled": True})
+
+        async def stream(delay):
+            await asyncio.sleep(delay)
+            return await content(await m.chat_completion(chat(temperature=0, stream=True), stream=True))
+        # late subscribers replay the chunks they missed
+        assert await asyncio.gather(*[stream(delay) for delay in (0, 0, 0.12)]) == ["one two three four"] * 3
+        assert up.calls == 1
+        # streams and plain requests don't share a flight
+        await asyncio.gather(stream(0), m.chat_completion(chat(temperature=0)))
+        assert up.calls == 3
+
+
+async def test_errors_are_shared(upstream, provider, init_llms, chat):
+    async with upstream(delay=0.1) as up:
+        up.failures = [(400, None)]
+        init_llms({"a": provider(up)}, coalesce={"enabled": True})
+        results = await asyncio.gather(*[m.chat_completion(chat(temperature=0)) for _ in range(3)], return_exceptions=True)
+        assert [type(result) for result in results] == [m.HTTPError] * 3
+        assert up.calls == 1
+
+        up.failures = [(400, None)]
+        results = await asyncio.gather(*[m.chat_completion(chat(temperature=0, stream=True), stream=True) for _ in range(3)], return_exceptions=True)
+        assert [type(result) for result in results] == [m.HTTPError] * 3
+        assert up.calls == 2
+
+
+async def test_cancelled_leader_doesnt_cancel_followers(upstream, provider, init_llms, chat):
+    async with upstream(reply="survived", delay=0.3) as up:
+        init_llms({"a": provider(up)}, coalesce={"enabled": True})
+        leader = asyncio.ensure_future(m.chat_completion(chat(temperature=0)))
+        await asyncio.sleep(0.05)
+        follower = asyncio.ensure_future(m.chat_completion(chat(temperature=0)))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        assert (await follower)["choices"][0]["message"]["content"] == "survived"
+        assert up.calls == 1
+
+
+async def test_flight_is_cancelled_once_everyone_left(upstream, provider, init_llms, chat):
+    async with upstream(delay=0.5) as up:
+        init_llms({"a": provider(up)}, coalesce={"enabled": True})
+        tasks = [asyncio.ensure_future(m.chat_completion(chat(temperature=0))) for _ in range(3)]
+        await asyncio.sleep(0.1)
+        flight, = m.g_coalescer.flights.values()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert flight.task.cancelled()
+        assert m.g_coalescer.status()["in_flight"] == 0
+
+
+async def test_unused_subscriptions_release_the_flight(upstream, provider, init_llms, chat):
+    async with upstream(reply="one two three", delay=0.05) as up:
+        init_llms({"a": provider(up)}, coalesce={"enabled": True})
+        closed = await m.chat_completion(chat(temperature=0, stream=True), stream=True)
+        flight = closed.flight
+        dropped = await m.chat_completion(chat(temperature=0, stream=True), stream=True)
+        assert flight.waiters == 2
+        await closed.aclose()
+        # never iterated, released when garbage collected
+        del dropped
+        gc.collect()
+        assert flight.waiters == 0
+        await asyncio.sleep(0)
+        assert flight.task.done()
+
+
+async def test_failed_stream_flights_are_retrieved(upstream, provider, init_llms, chat):
+    loop = asyncio.get_running_loop()
+    errors = []
+    loop.set_exception_handler(lambda loop, context: errors.append(context))
+    async with upstream(delay=0.1) as up:
+        up.failures = [(500, None)]
+        init_llms({"a": provider(up)}, coalesce={"enabled": True}, retry={"max_retries": 0})
+        # nothing awaits a streaming flight's task, the requests wait for it to start
+        with pytest.raises(m.HTTPError):
+            await m.chat_completion(chat(temperature=0, stream=True), stream=True)
+        await asyncio.sleep(0)
+        gc.collect()
+    assert errors == []
@@ -0,0 +1,76 @@
+import asyncio
+import importlib
+import json
+
+m = importlib.import_module('llms.main')
+
+
+async def test_responses_in_model_order(upstream, provider, init_llms, chat):
+    async with upstream(reply="from a", delay=0.1) as a, upstream(reply="from b") as b:
+        init_llms({"a": provider(a, models=("ma",)), "b": provider(b, models=("mb",))})
+        response = await m.fanout_chat_completion(chat(), ["ma", "mb", "unknown"])
+    assert response["object"] == "fanout"
+    results = response["results"]
+    assert [(result["model"], result["index"]) for result in results] == [("ma", 0), ("mb", 1), ("unknown", 2)]
+    assert [result["response"]["choices"][0]["message"]["content"] for result in results[:2]] == ["from a", "from b"]
+    assert [result["error"] for result in results[:2]] == [None, None]
+    assert results[2]["response"] is None
+    assert "unknown" in results[2]["error"]["message"]
+    assert (a.requests[0]["model"], b.requests[0]["model"]) == ("ma", "mb")
+
+
+async def test_failed_models_report_their_status(upstream, provider, init_llms, chat):
+    async with upstream() as a, upstream() as b:
+        b.failures = [(400, None)]
+        init_llms({"a": provider(a, models=("ma",)), "b": provider(b, models=("mb",))})
+        response = await m.fanout_chat_completion(chat(), ["ma", "mb"])
+    assert response["results"][0]["error"] is None
+    assert response["results"][1]["error"]["status"] == 400
+
+
+async def test_streams_are_merged(upstream, provider, init_llms, chat):
+    async with upstream(reply="a1 a2 a3") as a, upstream(reply="b1 b2 b3") as b, upstream() as broken:
+        broken.failures = [(400, None)]
+        init_llms({"a": provider(a, models=("ma",)), "b": provider(b, models=("mb",)), "broken": provider(broken, models=("mc",))})
+        events = [event async for event in await m.fanout_chat_completion(chat(stream=True), ["ma", "mb", "mc"], stream=True)]
+
+    def content(model):
+        return ''.join(event["choices"][0]["delta"]["content"] for event in events
+            if event["fanout"]["model"] == model and event.get("object") != "fanout.done")
+    assert (content("ma"), content("mb"), content("mc")) == ("a1 a2 a3", "b1 b2 b3", "")
+    # the chunks arrive interleaved, not one model after the other
+    models = [event["fanout"]["model"] for event in events if event.get("object") != "fanout.done"]
+    assert models != sorted(models)
+    done = [event for event in events if event.get("object") == "fanout.done"]
+    assert sorted((event["fanout"]["model"], event["fanout"]["index"]) for event in done) == [("ma", 0), ("mb", 1), ("mc", 2)]
+    errors = {event["fanout"]["model"]: event["error"] for event in done}
+    assert (errors["ma"], errors["mb"]) == (None, None)
+    assert errors["mc"]["status"] == 400
+    # each model's done event is its last
+    for model in ("ma", "mb"):
+        assert [event for event in events if event["fanout"]["model"] == model][-1]["object"] == "fanout.done"
+
+
+async def test_closing_the_stream_cancels_the_models(upstream, provider, init_llms, chat):
+    async with upstream(reply="fast") as fast, upstream(reply="slow", delay=5) as slow:
+        init_llms({"fast": provider(fast, models=("mf",)), "slow": provider(slow, models=("ms",))})
+        events = await m.fanout_chat_completion(chat(stream=True), ["mf", "ms"], stream=True)
+        async for event in events:
+            if event.get("object") == "fanout.done":
+                break
+        await events.aclose()
+        await asyncio.sleep(0.1)
+        assert slow.cancelled == 1
+
+
+async def test_cli_fanout(upstream, provider, init_llms, chat, capsys):
+    async with upstream(reply="slow answer", delay=0.1) as a, upstream(reply="fast answer") as b:
+        init_llms({"a": provider(a, models=("ma",)), "b": provider(b, models=("mb",))})
+        await m.cli_fanout(chat(), ["ma", "mb"])
+        out = capsys.readouterr().out
+        # printed as soon as each is complete
+        assert out.index("## mb") < out.index("fast answer") < out.index("## ma") < out.index("slow answer")
+
+        await m.cli_fanout(chat(), ["ma", "mb"], raw=True)
+        results = json.loads(capsys.readouterr().out)["results"]
+        assert [result["model"] for result in results] == ["ma", "mb"]
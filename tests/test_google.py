@@ -0,0 +1,168 @@
+import base64
+import importlib
+import shutil
+import socket
+from types import SimpleNamespace
+
+import pytest
+
+m = importlib.import_module('llms.main')
+
+
+@pytest.fixture
+def gemini():
+    """GoogleProvider config for a GeminiUpstream"""
+    def config(upstream, **kwargs):
+        return {"type": "GoogleProvider", "base_url": upstream.url, "api_key": "secret", "models": {"g": "gemini-test"}, **kwargs}
+    return config
+
+
+async def collect(response):
+    return [chunk async for chunk in response]
+
+
+async def test_stream_maps_events_to_chunks(gemini_upstream, gemini, init_llms, chat):
+    async with gemini_upstream(reply="one two three", thought="thinking") as up:
+        init_llms({"google": gemini(up)})
+        request = chat(model="g", temperature=0.5, max_completion_tokens=100)
+        request["messages"].insert(0, {"role": "system", "content": "be brief"})
+        chunks = await collect(await m.chat_completion(request, stream=True))
+
+    assert str(up.urls[0]) == "/v1beta/models/gemini-test:streamGenerateContent?alt=sse&key=secret"
+    assert up.requests[0] == {
+        "contents": [{"role": "user", "parts": [{"text": "hi"}]}],
+        "systemInstruction": {"parts": [{"text": "be brief"}]},
+        "generationConfig": {"maxOutputTokens": 100, "temperature": 0.5},
+    }
+    assert [chunk["object"] for chunk in chunks] == ["chat.completion.chunk"] * 4
+    assert {chunk["model"] for chunk in chunks} == {"gemini-test"}
+    deltas = [chunk["choices"][0]["delta"] for chunk in chunks]
+    assert deltas[0] == {"role": "assistant", "reasoning": "thinking"}
+    assert ''.join(delta.get("content", "") for delta in deltas) == "one two three"
+    assert [chunk["choices"][0]["finish_reason"] for chunk in chunks] == [None, None, None, "stop"]
+    # Gemini's usage is cumulative, only the final chunk reports it
+    assert [chunk.get("usage") for chunk in chunks[:-1]] == [None] * 3
+    assert chunks[-1]["usage"] == {"completion_tokens": 3, "total_tokens": 6, "prompt_tokens": 3}
+
+
+@pytest.mark.parametrize("finish_reason, expected", [
+    ("MAX_TOKENS", "length"),
+    ("SAFETY", "content_filter"),
+    ("RECITATION", "content_filter"),
+    ("MALFORMED_FUNCTION_CALL", "malformed_function_call"),
+])
+async def test_stream_finish_reasons(gemini_upstream, gemini, init_llms, chat, finish_reason, expected):
+    async with gemini_upstream(finish_reason=finish_reason) as up:
+        init_llms({"google": gemini(up)})
+        chunks = await collect(await m.chat_completion(chat(model="g"), stream=True))
+    assert chunks[-1]["choices"][0]["finish_reason"] == expected
+
+
+async def test_non_stream_response(gemini_upstream, gemini, init_llms, chat):
+    async with gemini_upstream(reply="one two", thought="thinking") as up:
+        init_llms({"google": gemini(up)})
+        response = await m.chat_completion(chat(model="g"))
+    assert str(up.urls[0]) == "/v1beta/models/gemini-test:generateContent?key=secret"
+    assert response["model"] == "gemini-test"
+    assert response["choices"][0]["message"] == {"role": "assistant", "content": "one two", "reasoning": "thinking"}
+    assert response["usage"] == {"completion_tokens": 2, "total_tokens": 5, "prompt_tokens": 3}
+
+
+async def test_stream_through_the_cache_reassembles_the_completion(gemini_upstream, gemini, init_llms, chat):
+    async with gemini_upstream(reply="one two") as up:
+        init_llms({"google": gemini(up)}, cache={"enabled": True})
+        await collect(await m.chat_completion(chat(model="g", temperature=0), stream=True))
+        response = await m.chat_completion(chat(model="g", temperature=0))
+    assert response["choices"][0]["message"]["content"] == "one two"
+    assert response["choices"][0]["finish_reason"] == "stop"
+    assert up.calls == 1
+
+
+async def test_inline_media_is_streamed(tmp_path, gemini_upstream, gemini, init_llms, chat):
+    data = bytes(range(256)) * 1000
+    (tmp_path / "doc.pdf").write_bytes(data)
+    async with gemini_upstream() as up:
+        init_llms({"google": gemini(up)})
+        request = chat(model="g", content=[
+            {"type": "text", "text": "summarize"},
+            {"type": "file", "file": {"file_data": str(tmp_path / "doc.pdf")}},
+        ])
+        await collect(await m.chat_completion(request, stream=True))
+    assert up.content_lengths == [len(up.bodies[0])]
+    assert up.requests[0]["contents"][0]["parts"] == [
+        {"text": "summarize"},
+        {"inline_data": {"mime_type": "application/pdf", "data": base64.b64encode(data).decode('ascii')}},
+    ]
+
+
+@pytest.mark.parametrize("stream", [False, True])
+async def test_errors(gemini_upstream, gemini, init_llms, chat, stream):
+    async with gemini_upstream() as up:
+        up.failures = [(400, None)]
+        init_llms({"google": gemini(up)})
+        with pytest.raises(m.HTTPError) as e:
+            await m.chat_completion(chat(model="g"), stream=stream)
+    assert e.value.status == 400
+    assert "Gemini error 400" in e.value.body
+
+
+@pytest.mark.skipif(shutil.which('curl') is None, reason="curl is not installed")
+class TestCurl:
+    async def test_stream(self, gemini_upstream, gemini, init_llms, chat):
+        async with gemini_upstream(reply="one two three", thought="thinking") as up:
+            init_llms({"google": gemini(up, curl=True)})
+            chunks = await collect(await m.chat_completion(chat(model="g"), stream=True))
+        assert ''.join(chunk["choices"][0]["delta"].get("content", "") for chunk in chunks) == "one two three"
+        assert chunks[0]["choices"][0]["delta"]["reasoning"] == "thinking"
+        assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+        assert chunks[-1]["usage"]["total_tokens"] == 6
+
+    async def test_non_stream(self, gemini_upstream, gemini, init_llms, chat):
+        async with gemini_upstream(reply="one two") as up:
+            init_llms({"google": gemini(up, curl=True)})
+            response = await m.chat_completion(chat(model="g"))
+        assert response["choices"][0]["message"]["content"] == "one two"
+        assert response["usage"]["total_tokens"] == 5
+
+    async def test_request_body_is_piped(self, tmp_path, gemini_upstream, gemini, init_llms, chat):
+        data = bytes(range(256)) * 4000
+        (tmp_path / "doc.pdf").write_bytes(data)
+        async with gemini_upstream() as up:
+            init_llms({"google": gemini(up, curl=True)})
+            request = chat(model="g", content=[{"type": "file", "file": {"file_data": str(tmp_path / "doc.pdf")}}])
+            await collect(await m.chat_completion(request, stream=True))
+        assert up.requests[0]["contents"][0]["parts"][0]["inline_data"]["data"] == base64.b64encode(data).decode('ascii')
+
+    @pytest.mark.parametrize("stream", [False, True])
+    async def test_error_body_is_reported(self, gemini_upstream, gemini, init_llms, chat, stream):
+        # curl doesn't fail on HTTP errors, the error is read from the response body
+        async with gemini_upstream() as up:
+            up.failures = [(400, None)]
+            init_llms({"google": gemini(up, curl=True)})
+            with pytest.raises(Exception, match="Gemini error 400"):
+                response = await m.chat_completion(chat(model="g"), stream=stream)
+                await collect(response)
+
+    async def test_connection_error(self, gemini, init_llms, chat, unused_port):
+        init_llms({"google": gemini(SimpleNamespace(url=f"http://127.0.0.1:{unused_port}"), curl=True)})
+        for stream in (False, True):
+            with pytest.raises(Exception, match="curl"):
+                response = await m.chat_completion(chat(model="g"), stream=stream)
+                await collect(response)
+
+    async def test_closing_the_stream_stops_curl(self, gemini_upstream, gemini, init_llms, chat):
+        async with gemini_upstream(reply=' '.join(['word'] * 200)) as up:
+            init_llms({"google": gemini(up, curl=True)})
+            response = await m.chat_completion(chat(model="g"), stream=True)
+            async for _ in response:
+                break
+            await response.aclose()
+            # the next request isn't blocked by the abandoned one
+            assert (await m.chat_completion(chat(model="g")))["choices"][0]["message"]["content"].startswith("word")
+
+
+@pytest.fixture
+def unused_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
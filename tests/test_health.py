@@ -0,0 +1,117 @@
+import importlib
+import json
+
+import pytest
+
+m = importlib.import_module('llms.main')
+
+DEFAULTS = {
+    "headers": {"Content-Type": "application/json"},
+    "check": {"messages": [{"role": "user", "content": "ping"}]},
+}
+
+
+class InFlight:
+    """Records the most requests the upstreams were handling at once"""
+    def __init__(self, *upstreams):
+        self.count = 0
+        self.max = 0
+        for upstream in upstreams:
+            upstream.handler = self.wrap(upstream.handler)
+
+    def wrap(self, handler):
+        async def counting_handler(request):
+            self.count += 1
+            self.max = max(self.max, self.count)
+            try:
+                return await handler(request)
+            finally:
+                self.count -= 1
+        return counting_handler
+
+
+def test_percentiles():
+    assert m.percentiles([]) is None
+    assert m.percentiles([0.1]) == {"p50": 100, "p90": 100, "p99": 100}
+    assert m.percentiles([i / 1000 for i in range(100, 0, -1)]) == {"p50": 50, "p90": 90, "p99": 99}
+
+
+@pytest.mark.parametrize("stream", [True, False])
+async def test_report(upstream, provider, init_llms, stream):
+    async with upstream(reply="pong", delay=0.05) as a, upstream() as b:
+        b.failures = [(500, None)] * 2
+        init_llms({"a": provider(a, models=("m1", "m2")), "b": provider(b, models=("m3",))}, defaults=DEFAULTS)
+        health = m.HealthCheck({"pings": 2, "stream": stream})
+        report = await health.run([(name, m.g_handlers[name], list(m.g_handlers[name].models)) for name in ("a", "b")])
+
+    assert report["object"] == "health_check"
+    assert report["pings"] == 2
+    assert {request["messages"][0]["content"] for request in a.requests} == {"ping"}
+    assert sorted(request["model"] for request in a.requests) == ["m1", "m1", "m2", "m2"]
+    assert all(request["stream"] == stream for request in a.requests)
+
+    models = {result["model"]: result for result in report["models"]}
+    assert (models["m1"]["ok"], models["m1"]["errors"], models["m1"]["error"]) == (2, 0, None)
+    assert models["m1"]["ttft"]["p50"] >= 50
+    assert models["m1"]["total"]["p50"] >= models["m1"]["ttft"]["p50"]
+    assert models["m1"]["connect"]["p50"] < 1000
+    assert (models["m3"]["ok"], models["m3"]["errors"]) == (0, 2)
+    assert models["m3"]["error"].startswith("HTTP 500")
+    assert models["m3"]["ttft"] is None
+
+    providers = {summary["provider"]: summary for summary in report["providers"]}
+    assert (providers["a"]["models"], providers["a"]["ok"]) == (2, 2)
+    assert (providers["b"]["models"], providers["b"]["ok"]) == (1, 0)
+
+
+async def test_concurrency_is_shared_by_all_providers(upstream, provider, init_llms):
+    a, b = upstream(delay=0.05), upstream(delay=0.05)
+    in_flight = InFlight(a, b)
+    async with a, b:
+        init_llms({"a": provider(a, models=("m1", "m2", "m3")), "b": provider(b, models=("m4", "m5", "m6"))}, defaults=DEFAULTS)
+        health = m.HealthCheck({"pings": 2, "concurrency": 3})
+        await health.run([(name, m.g_handlers[name], list(m.g_handlers[name].models)) for name in ("a", "b")])
+    assert a.calls + b.calls == 12
+    assert in_flight.max == 3
+
+
+async def test_timeout(upstream, provider, init_llms):
+    async with upstream(delay=5) as up:
+        init_llms({"a": provider(up)}, defaults=DEFAULTS)
+        report = await m.HealthCheck({"timeout": 0.1}).run([("a", m.g_handlers["a"], ["m"])])
+    assert report["models"][0]["error"] == "Timeout"
+
+
+async def test_results_seed_the_routing_stats(upstream, provider, init_llms):
+    async with upstream() as up:
+        init_llms({"a": provider(up)}, defaults=DEFAULTS, routing={"policy": "latency", "persist": False})
+        await m.HealthCheck({"pings": 3}).run([("a", m.g_handlers["a"], ["m"])])
+    assert m.g_routing.stats[("a", "m")]["requests"] == 3
+
+
+async def test_check_models(tmp_path, upstream, provider, init_llms, capsys):
+    async with upstream() as a, upstream() as b:
+        b.failures = [(500, None)]
+        init_llms({"a": provider(a, models=("m1", "m2")), "b": provider(b, models=("m3",))}, defaults=DEFAULTS)
+        await m.check_models("all", concurrency=2)
+        out = capsys.readouterr().out
+        assert "Checking 3 models of 2 providers, 2 at a time" in out
+        assert "✓ a" in out and "✗ b" in out
+        assert "a: 2/2 models ok" in out and "b: 0/1 models ok" in out
+
+        await m.check_models("a", ["m2", "missing"], pings=2, raw=True)
+        out = capsys.readouterr().out
+        assert out.startswith("Model 'missing' not found in provider 'a'")
+        report = json.loads(out[out.index("{"):])
+        assert [(result["model"], result["ok"]) for result in report["models"]] == [("m2", 2)]
+
+    # every run is appended to the history
+    with open(tmp_path / ".llms" / "cache" / "health.jsonl") as f:
+        history = [json.loads(line) for line in f]
+    assert [result["model"] for result in history] == ["m1", "m2", "m3", "m2"]
+
+
+async def test_unknown_provider(init_llms, capsys):
+    init_llms({})
+    await m.check_models("missing")
+    assert "Provider 'missing' not found or not enabled" in capsys.readouterr().out
@@ -0,0 +1,100 @@
+import importlib
+import time
+
+m = importlib.import_module('llms.main')
+
+
+def test_delay_for(chat):
+    hedging = m.Hedging({"enabled": True, "models": ["m"], "min_delay": 0.2, "max_delay": 2})
+    assert hedging.delay_for(chat(model="other")) is None
+    # max_delay until there are enough samples for a p90
+    assert hedging.delay_for(chat()) == 2
+    for i in range(1, 11):
+        hedging.observe("m", i / 10)
+    assert hedging.delay_for(chat()) == 1.0
+    # clamped to min_delay..max_delay
+    for _ in range(100):
+        hedging.observe("m", 0.01)
+    assert hedging.delay_for(chat()) == 0.2
+
+    assert hedging.delay_for(chat(metadata={"hedge": False})) is None
+    assert hedging.delay_for(chat(metadata={"hedge": "0.5"})) == 0.5
+    assert m.Hedging({"delay": 0.3}).delay_for(chat(metadata={"hedge": True})) == 0.3
+    assert m.Hedging().delay_for(chat()) is None
+
+
+def test_invalid_hedge_delay_uses_configured_delay(chat):
+    hedging = m.Hedging({"delay": 0.3})
+    assert hedging.delay_for(chat(metadata={"hedge": "yes"})) == 0.3
+    assert hedging.delay_for(chat(metadata={"hedge": [1]})) == 0.3
+
+
+def test_budget():
+    hedging = m.Hedging({"enabled": True, "budget": 0.1})
+    hedged = 0
+    for _ in range(100):
+        hedging.request()
+        hedged += hedging.allow_hedge()
+    assert hedged == 10
+    assert hedging.status()["hedge_rate"] == 0.1
+    assert hedging.status()["budget_denied"] == 90
+
+
+async def test_slow_provider_is_hedged(upstream, provider, init_llms, chat):
+    async with upstream(reply="slow", delay=2) as slow, upstream(reply="fast") as fast:
+        init_llms({"slow": provider(slow), "fast": provider(fast)}, hedging={"enabled": True, "delay": 0.1, "budget": 1})
+        started_at = time.monotonic()
+        response = await m.chat_completion(chat())
+        assert response['choices'][0]['message']['content'] == "fast"
+        assert time.monotonic() - started_at < 1
+        assert (slow.calls, fast.calls) == (1, 1)
+        assert m.g_hedging.status() == {"requests": 1, "hedged": 1, "wins": 1, "budget_denied": 0, "hedge_rate": 1.0, "win_rate": 1.0}
+        # the losing request was cancelled, not counted as a failure
+        assert m.g_breakers.open_circuits() == []
+        assert m.g_breakers.providers["slow"].probes == 0
+
+
+async def test_fast_provider_isnt_hedged(upstream, provider, init_llms, chat):
+    async with upstream(reply="first") as first, upstream(reply="second") as second:
+        init_llms({"first": provider(first), "second": provider(second)}, hedging={"enabled": True, "delay": 0.5, "budget": 1})
+        response = await m.chat_completion(chat())
+        assert response['choices'][0]['message']['content'] == "first"
+        assert second.calls == 0
+        assert m.g_hedging.stats["hedged"] == 0
+
+
+async def test_hedged_stream_waits_for_first_chunk(upstream, provider, init_llms, chat):
+    async with upstream(reply="slow stream", delay=2) as slow, upstream(reply="fast stream") as fast:
+        init_llms({"slow": provider(slow), "fast": provider(fast)}, hedging={"enabled": True, "delay": 0.1, "budget": 1})
+        response = await m.chat_completion(chat(stream=True), stream=True)
+        assert ''.join([chunk['choices'][0]['delta']['content'] async for chunk in response]) == "fast stream"
+        assert m.g_hedging.stats["wins"] == 1
+
+
+async def test_budget_exhausted_waits_for_first_provider(upstream, provider, init_llms, chat):
+    async with upstream(reply="slow", delay=0.3) as slow, upstream(reply="fast") as fast:
+        init_llms({"slow": provider(slow), "fast": provider(fast)}, hedging={"enabled": True, "delay": 0.05, "budget": 0})
+        response = await m.chat_completion(chat())
+        assert response['choices'][0]['message']['content'] == "slow"
+        assert fast.calls == 0
+        assert m.g_hedging.stats["budget_denied"] == 1
+        # the skipped candidate's probe slot was given back
+        assert m.g_breakers.allow("fast", "m")
+
+
+async def test_invalid_hedge_delay_isnt_an_error(upstream, provider, init_llms, chat):
+    async with upstream(reply="first") as first, upstream(reply="second") as second:
+        init_llms({"first": provider(first), "second": provider(second)}, hedging={"delay": 0.5, "budget": 1})
+        response = await m.chat_completion(chat(metadata={"hedge": "yes"}))
+        assert response['choices'][0]['message']['content'] == "first"
+        assert m.g_hedging.stats["requests"] == 1
+
+
+async def test_failed_hedge_falls_back(upstream, provider, init_llms, chat):
+    async with upstream(reply="slow", delay=0.3) as slow, upstream(reply="broken") as broken:
+        broken.failures = [(500, None)]
+        init_llms({"slow": provider(slow), "broken": provider(broken)},
+            hedging={"enabled": True, "delay": 0.05, "budget": 1}, retry={"max_retries": 0})
+        response = await m.chat_completion(chat())
+        assert response['choices'][0]['message']['content'] == "slow"
+        assert m.g_hedging.stats["wins"] == 0
@@ -0,0 +1,120 @@
+import asyncio
+import importlib
+
+m = importlib.import_module('llms.main')
+
+
+def peer_upstream(upstream):
+    class PeerUpstream(upstream):
+        """Upstream recording the client port of every request and counting HEAD requests"""
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.peers = []
+            self.heads = 0
+
+        async def handler(self, request):
+            self.peers.append(request.transport.get_extra_info('peername')[1])
+            return await super().handler(request)
+
+        async def head(self, request):
+            self.heads += 1
+            return m.web.Response()
+
+        def add_routes(self, router):
+            super().add_routes(router)
+            router.add_route('HEAD', '/', self.head)
+    return PeerUpstream
+
+
+async def test_session_is_created_lazily_and_reused():
+    pool = m.HttpPool({"limit": 10, "limit_per_host": 4, "timeout": 5})
+    assert pool._session is None
+    session = pool.session()
+    assert pool.session() is session
+    assert (session.connector.limit, session.connector.limit_per_host) == (10, 4)
+    assert session.timeout.total == 5
+    await pool.close()
+    assert session.closed
+    # re-created once closed
+    assert pool.session() is not session
+    await pool.close()
+
+
+def test_session_is_bound_to_its_event_loop():
+    pool = m.HttpPool()
+
+    async def session():
+        return pool.session()
+    first = asyncio.run(session())
+
+    async def in_another_loop():
+        assert pool.session() is not first
+        # without connections the session isn't using its loop
+        await first.close()
+        await pool.close()
+    asyncio.run(in_another_loop())
+
+
+async def test_connections_are_reused(upstream, provider, init_llms, chat):
+    async with peer_upstream(upstream)() as up:
+        init_llms({"a": provider(up)})
+        for _ in range(3):
+            await m.chat_completion(chat())
+        response = await m.chat_completion(chat(stream=True), stream=True)
+        async for _ in response:
+            pass
+        assert len(up.peers) == 4
+        assert len(set(up.peers)) == 1
+
+
+async def test_limit_per_host(upstream, provider, init_llms, chat):
+    async with peer_upstream(upstream)(delay=0.05) as up:
+        init_llms({"a": provider(up, http={"limit_per_host": 2})})
+        await asyncio.gather(*[m.chat_completion(chat()) for _ in range(6)])
+        assert len(set(up.peers)) == 2
+
+
+async def test_warmup(upstream, provider, init_llms, chat):
+    async with peer_upstream(upstream)() as up:
+        init_llms({"a": provider(up, http={"warmup": 2}), "b": provider(up, models=("n",))})
+        await m.warmup_llms()
+        # b isn't warmed up
+        assert up.heads == 2
+        await asyncio.gather(*[m.chat_completion(chat()) for _ in range(2)])
+        assert up.heads == 2
+
+
+async def test_replaced_pools_are_closed_after_their_timeout(upstream, provider, init_llms, chat):
+    async with upstream(reply="in flight", delay=0.2) as up:
+        init_llms({"a": provider(up, http={"timeout": 0.5})})
+        old_pool = m.g_handlers["a"].pool
+        in_flight = asyncio.ensure_future(m.chat_completion(chat()))
+        await asyncio.sleep(0.05)
+        # reload
+        init_llms({"a": provider(up)})
+        assert old_pool in m.g_retired_pools
+        session = old_pool._session
+        # the request started before the reload completes on the old pool
+        assert (await in_flight)["choices"][0]["message"]["content"] == "in flight"
+        assert not session.closed
+        await asyncio.sleep(0.5)
+        assert session.closed
+        assert old_pool not in m.g_retired_pools
+
+
+async def test_unused_pools_arent_retired(upstream, provider, init_llms):
+    async with upstream() as up:
+        init_llms({"a": provider(up)})
+        init_llms({"a": provider(up)})
+        assert m.g_retired_pools == {}
+
+
+async def test_close_llms_closes_retired_pools(upstream, provider, init_llms, chat):
+    async with upstream() as up:
+        init_llms({"a": provider(up)})
+        await m.chat_completion(chat())
+        session = m.g_handlers["a"].pool._session
+        init_llms({"a": provider(up)})
+        await m.close_llms()
+        assert session.closed
+        assert m.g_retired_pools == {}
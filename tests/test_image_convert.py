@@ -0,0 +1,77 @@
+import base64
+import importlib
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+m = importlib.import_module('llms.main')
+
+
+def image_bytes(size, format='PNG', mode='RGB'):
+    output = BytesIO()
+    Image.new(mode, size).save(output, format=format)
+    return output.getvalue()
+
+
+def test_image_preset():
+    assert m.image_preset({}) == m.IMAGE_PRESETS["balanced"]
+    assert m.image_preset({"preset": "missing"}) == m.IMAGE_PRESETS["balanced"]
+    assert m.image_preset({"preset": "fast", "quality": 60}) == {**m.IMAGE_PRESETS["fast"], "quality": 60}
+
+
+@pytest.mark.parametrize("format", ["PNG", "JPEG", "WEBP", "GIF"])
+def test_probe_reads_only_the_header(format):
+    data = image_bytes((640, 480), format)
+    assert m.probe_image(data[:1024]) == (format, (640, 480))
+    assert m.probe_image(b"not an image") is None
+
+
+def test_image_within_limits():
+    config = {"max_size": "100x100"}
+    small = m.MediaPayload("image/png", data=image_bytes((50, 50)))
+    large = m.MediaPayload("image/png", data=image_bytes((200, 50)))
+    assert m.image_within_limits(small, config)
+    assert not m.image_within_limits(large, config)
+    assert not m.image_within_limits(m.MediaPayload("image/png", data=b"not an image"), config)
+    assert not m.image_within_limits(small, {"max_size": "100x100", "max_length": 0.01})
+    # without limits there's nothing to convert
+    assert m.image_within_limits(large, {})
+
+
+def test_images_within_limits_arent_decoded():
+    data = image_bytes((50, 50))
+    converted, mimetype = m.convert_image_if_needed(data, 'image/png', {"max_size": "100x100"})
+    assert converted is data
+    assert mimetype == 'image/png'
+
+
+@pytest.mark.parametrize("preset", list(m.IMAGE_PRESETS))
+@pytest.mark.parametrize("format, mode", [("JPEG", "RGB"), ("PNG", "RGBA"), ("PNG", "P"), ("PNG", "L")])
+def test_oversized_images_are_resized(preset, format, mode):
+    data = image_bytes((1600, 800), format, mode)
+    converted, mimetype = m.convert_image_if_needed(data, 'image/png', {"max_size": "400x400", "preset": preset})
+    assert mimetype == 'image/webp'
+    with Image.open(BytesIO(converted)) as image:
+        assert (image.format, image.size, image.mode) == ("WEBP", (400, 200), "RGB")
+
+
+async def test_data_uri_within_limits_is_sent_as_is(init_llms, chat):
+    init_llms({}, convert={"image": {"max_size": "100x100"}})
+    data_uri = "data:image/png;base64," + base64.b64encode(image_bytes((50, 50))).decode('ascii')
+    request = chat([{"type": "image_url", "image_url": {"url": data_uri}}])
+    await m.process_chat(request)
+    payload = request["messages"][0]["content"][0]["image_url"]["url"]
+    assert payload.base64_data is data_uri
+    assert str(payload) == data_uri
+    assert m.g_convert_pool.completed == 0
+
+
+async def test_oversized_data_uri_is_converted(init_llms, chat):
+    init_llms({}, convert={"image": {"max_size": "100x100"}})
+    data_uri = "data:image/png;base64," + base64.b64encode(image_bytes((400, 100))).decode('ascii')
+    request = chat([{"type": "image_url", "image_url": {"url": data_uri}}])
+    await m.process_chat(request)
+    url = str(request["messages"][0]["content"][0]["image_url"]["url"])
+    assert url.startswith("data:image/webp;base64,")
+    assert m.g_convert_pool.completed == 1
@@ -0,0 +1,67 @@
+import importlib
+import json
+
+import pytest
+
+m = importlib.import_module('llms.main')
+
+CODECS = ["orjson", "msgspec", "stdlib"]
+
+
+def test_auto_uses_the_fastest_installed_codec(monkeypatch):
+    assert m.JsonCodec().name == "orjson"
+    monkeypatch.setattr(m, 'HAS_ORJSON', False)
+    assert m.JsonCodec().name == "msgspec"
+    monkeypatch.setattr(m, 'HAS_MSGSPEC', False)
+    assert m.JsonCodec().name == "stdlib"
+
+
+def test_missing_codec_falls_back_to_stdlib(monkeypatch):
+    monkeypatch.setattr(m, 'HAS_MSGSPEC', False)
+    codec = m.JsonCodec("msgspec")
+    assert (codec.config, codec.name) == ("msgspec", "stdlib")
+
+
+@pytest.mark.parametrize("name", CODECS)
+def test_round_trip(name):
+    codec = m.JsonCodec(name)
+    obj = {"model": "m", "messages": [{"role": "user", "content": "héllo ✓"}], "temperature": 0.5, "n": 1, "stop": None, "stream": True}
+    data = codec.dumps(obj)
+    assert isinstance(data, bytes)
+    assert json.loads(data) == obj
+    assert codec.loads(data) == obj
+    assert codec.loads(data.decode('utf-8')) == obj
+
+
+@pytest.mark.parametrize("name", CODECS)
+def test_default(name):
+    class Payload:
+        pass
+    assert json.loads(m.JsonCodec(name).dumps({"a": Payload()}, default=lambda obj: "payload")) == {"a": "payload"}
+
+
+@pytest.mark.parametrize("name", CODECS)
+def test_decode_errors_are_json_decode_errors(name):
+    codec = m.JsonCodec(name)
+    for data in (b'{"a": ', 'not json', b''):
+        with pytest.raises(json.JSONDecodeError):
+            codec.loads(data)
+
+
+@pytest.mark.parametrize("name", CODECS)
+async def test_chat_completions(name, upstream, provider, init_llms, chat):
+    async with upstream(reply="hello json") as up:
+        init_llms({"a": provider(up)}, json={"codec": name})
+        assert m.g_json.name == name
+        response = await m.chat_completion(chat())
+        assert response["choices"][0]["message"]["content"] == "hello json"
+        stream = await m.chat_completion(chat(stream=True), stream=True)
+        assert ''.join([chunk['choices'][0]['delta']['content'] async for chunk in stream]) == "hello json"
+        assert up.requests[0] == chat(stream=False)
+
+
+async def test_json_response():
+    response = m.json_response({"ok": "✓"}, status=201, headers={"X-Test": "1"})
+    assert (response.status, response.content_type, response.charset) == (201, "application/json", "utf-8")
+    assert response.headers["X-Test"] == "1"
+    assert json.loads(response.body) == {"ok": "✓"}
@@ -0,0 +1,90 @@
+import importlib
+import io
+import threading
+
+m = importlib.import_module('llms.main')
+
+
+def test_disabled_messages_arent_built(monkeypatch, capsys):
+    monkeypatch.setattr(m, 'g_log_level', m.LOG_LEVELS["warning"])
+    built = []
+
+    class Arg:
+        def __str__(self):
+            built.append("arg")
+            return "arg"
+    m._log("debug %s", Arg())
+    m._log(lambda: built.append("callable"))
+    m._log("info %s", Arg(), level=m.LOG_LEVELS["info"])
+    assert built == []
+    assert capsys.readouterr().out == ""
+
+
+def test_enabled_messages(monkeypatch, capsys):
+    monkeypatch.setattr(m, 'g_log_level', m.LOG_LEVELS["debug"])
+    monkeypatch.setattr(m, 'g_logprefix', "[llms] ")
+    m._log("plain")
+    m._log("%s of %d", "one", 2)
+    m._log(lambda a, b: f"{a}+{b}", 1, 2)
+    m._log("100% literal")
+    assert capsys.readouterr().out.splitlines() == ["[llms] plain", "[llms] one of 2", "[llms] 1+2", "[llms] 100% literal"]
+
+
+def test_messages_go_to_the_sink(monkeypatch, capsys):
+    stream = io.StringIO()
+    sink = m.LogSink(stream)
+    monkeypatch.setattr(m, 'g_log_sink', sink)
+    monkeypatch.setattr(m, 'g_log_level', m.LOG_LEVELS["info"])
+    m._log("skipped")
+    m._log("warning %d", 1, level=m.LOG_LEVELS["warning"])
+    m._log("info %d", 2, level=m.LOG_LEVELS["info"])
+    sink.close()
+    assert not sink.thread.is_alive()
+    assert stream.getvalue() == "warning 1\ninfo 2\n"
+    assert capsys.readouterr().out == ""
+
+
+def test_sink_keeps_the_order_of_each_writer():
+    stream = io.StringIO()
+    sink = m.LogSink(stream)
+
+    def write(name):
+        for i in range(500):
+            sink.write(f"{name} {i}")
+    threads = [threading.Thread(target=write, args=(name,)) for name in "abcd"]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sink.close()
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 2000
+    for name in "abcd":
+        assert [line for line in lines if line[0] == name] == [f"{name} {i}" for i in range(500)]
+
+
+def test_sink_survives_a_closed_stream():
+    stream = io.StringIO()
+    stream.close()
+    sink = m.LogSink(stream)
+    sink.write("lost")
+    sink.close()
+    assert not sink.thread.is_alive()
+
+
+def test_chat_summary_replaces_media_with_its_size(chat):
+    image = "data:image/png;base64," + "A" * 1000
+    request = chat([
+        {"type": "text", "text": "describe"},
+        {"type": "image_url", "image_url": {"url": image}},
+        {"type": "input_audio", "input_audio": {"data": "B" * 200, "format": "mp3"}},
+        {"type": "file", "file": {"file_data": "data:application/pdf;base64," + "C" * 300}},
+    ])
+    summary = m.chat_summary(request)
+    assert "AAAA" not in summary and "BBBB" not in summary and "CCCC" not in summary
+    assert '"url": "data:image/png;base64,(' in summary
+    assert '"data": "(200)"' in summary
+    assert '"file_data": "data:application/pdf;base64,(' in summary
+    assert "describe" in summary
+    # the request itself is unchanged
+    assert request["messages"][0]["content"][1]["image_url"]["url"] == image
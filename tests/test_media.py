@@ -0,0 +1,118 @@
+import base64
+import hashlib
+import importlib
+import json
+
+import pytest
+
+m = importlib.import_module('llms.main')
+
+CODECS = [
+    "stdlib",
+    pytest.param("orjson", marks=pytest.mark.skipif(not m.HAS_ORJSON, reason="orjson is not installed")),
+    pytest.param("msgspec", marks=pytest.mark.skipif(not m.HAS_MSGSPEC, reason="msgspec is not installed")),
+]
+
+# sizes around the base64 padding and chunk boundaries
+SIZES = [0, 1, 2, 3, 4, m.MediaPayload.CHUNK_SIZE - 1, m.MediaPayload.CHUNK_SIZE, m.MediaPayload.CHUNK_SIZE + 1]
+
+
+@pytest.fixture(params=CODECS)
+def codec(request, monkeypatch):
+    monkeypatch.setattr(m, 'g_json', m.JsonCodec(request.param))
+    return request.param
+
+
+def content(size):
+    return bytes(i % 251 for i in range(size))
+
+
+def payloads(tmp_path, size):
+    data = content(size)
+    path = tmp_path / f"media-{size}.bin"
+    path.write_bytes(data)
+    uri = "data:application/pdf;base64," + base64.b64encode(data).decode('ascii')
+    return {
+        "raw": m.MediaPayload("application/pdf", data=data),
+        "raw_bare": m.MediaPayload("audio/wav", data=data, data_uri=False),
+        "data_uri": m.MediaPayload.from_data_uri(uri),
+        "file": m.MediaPayload.from_file(str(path), "application/pdf"),
+    }
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_json_body_length_matches_bytes(codec, tmp_path, size):
+    for kind, payload in payloads(tmp_path, size).items():
+        body = m.JsonBody({"model": "m", "text": "héllo ✓", "media": [payload, {"nested": payload}]})
+        data = b''.join(body.chunks())
+        assert len(data) == body.length, kind
+        assert body.headers({})['Content-Length'] == str(len(data))
+        expected = str(payload)
+        assert json.loads(data) == {"model": "m", "text": "héllo ✓", "media": [expected, {"nested": expected}]}
+
+
+def test_json_body_without_media_is_plain_bytes(codec):
+    body = m.JsonBody({"model": "m", "text": "héllo"})
+    assert body.data() == m.g_json.dumps({"model": "m", "text": "héllo"})
+    assert body.headers({'Content-Type': 'application/json'}) == {'Content-Type': 'application/json'}
+
+
+def test_json_body_rejects_other_objects(codec):
+    with pytest.raises(TypeError):
+        m.JsonBody({"value": object()})
+
+
+def test_media_payload_data_uri_values(tmp_path):
+    data = content(1000)
+    encoded = base64.b64encode(data).decode('ascii')
+    media = payloads(tmp_path, 1000)
+    assert str(media['raw']) == "data:application/pdf;base64," + encoded
+    assert str(media['raw_bare']) == encoded
+    assert str(media['data_uri']) == "data:application/pdf;base64," + encoded
+    assert str(media['file']) == "data:application/pdf;base64," + encoded
+    assert str(media['data_uri'].with_data_uri(False)) == encoded
+    for payload in media.values():
+        assert payload.raw_length() == 1000
+        assert payload.base64_head(8) == encoded[:8]
+
+
+def test_media_payload_digest_is_cached(tmp_path):
+    data = content(5000)
+    media = payloads(tmp_path, 5000)
+    raw, file, data_uri = media['raw'], media['file'], media['data_uri']
+    assert raw.digest_cost() == 5000
+    assert raw.digest() == file.digest() == hashlib.sha256(data).hexdigest()
+    assert data_uri.digest() == hashlib.sha256(base64.b64encode(data)).hexdigest()
+    assert raw.digest_cost() == 0
+    # copies share the computed digest
+    assert raw.with_data_uri(False).digest_cost() == 0
+    # the file isn't read again
+    (tmp_path / "media-5000.bin").unlink()
+    assert file.digest() == hashlib.sha256(data).hexdigest()
+
+
+@pytest.mark.parametrize("stream", [False, True])
+async def test_streamed_request_body_has_content_length(codec, tmp_path, upstream, provider, init_llms, chat, stream):
+    data = content(m.MediaPayload.CHUNK_SIZE * 2 + 5)
+    encoded = base64.b64encode(data).decode('ascii')
+    (tmp_path / "doc.pdf").write_bytes(data)
+    (tmp_path / "clip.wav").write_bytes(data)
+    async with upstream() as up:
+        init_llms({"mock": provider(up)})
+        request = chat(content=[
+            {"type": "text", "text": "summarize ✓"},
+            {"type": "file", "file": {"file_data": str(tmp_path / "doc.pdf")}},
+            {"type": "file", "file": {"file_data": "data:application/pdf;base64," + encoded}},
+            {"type": "input_audio", "input_audio": {"data": str(tmp_path / "clip.wav")}},
+        ])
+        response = await m.chat_completion(request, stream=stream)
+        if stream:
+            assert ''.join([chunk['choices'][0]['delta']['content'] async for chunk in response]) == "hello world"
+        else:
+            assert response['choices'][0]['message']['content'] == "hello world"
+    assert up.content_lengths == [len(up.bodies[0])]
+    parts = up.requests[0]['messages'][0]['content']
+    assert parts[0]['text'] == "summarize ✓"
+    assert parts[1]['file'] == {"file_data": "data:application/pdf;base64," + encoded, "filename": "doc.pdf"}
+    assert parts[2]['file'] == {"file_data": "data:application/pdf;base64," + encoded, "filename": "file"}
+    assert parts[3]['input_audio']['data'] == encoded
@@ -0,0 +1,116 @@
+import importlib
+import os
+
+m = importlib.import_module('llms.main')
+
+
+async def test_lru_bounded_by_bytes():
+    cache = m.MediaCache({"max_bytes": 10})
+    await cache.put("a", ("text/plain", b"aaaa"))
+    await cache.put("b", ("text/plain", b"bbbb"))
+    assert await cache.get("a") == ("text/plain", b"aaaa")
+    await cache.put("c", ("text/plain", b"cccc"))
+    # b was the least recently used
+    assert await cache.get("b") is None
+    assert await cache.get("c") == ("text/plain", b"cccc")
+    # larger than the whole cache
+    await cache.put("d", ("text/plain", b"d" * 11))
+    assert await cache.get("d") is None
+    assert cache.status() == {"hits": 2, "disk_hits": 0, "misses": 2, "evictions": 1, "revalidated": 0,
+        "entries": 2, "bytes": 8, "max_bytes": 10, "urls": 0, "disk": False}
+
+
+async def test_disabled():
+    cache = m.MediaCache({"enabled": False})
+    await cache.put("a", ("text/plain", b"a"))
+    assert await cache.get("a") is None
+    cache.put_url("http://host/a", {"ETag": '"a"'}, "a")
+    assert cache.url_validators("http://host/a") is None
+
+
+async def test_disk_tier(tmp_path):
+    path = tmp_path / "media"
+    cache = m.MediaCache({"disk": str(path)})
+    await cache.put("raw", ("audio/wav", b"\x00\x01raw"))
+    await cache.put("base64", ("image/webp", "UklGRg=="))
+    restarted = m.MediaCache({"disk": str(path)})
+    assert await restarted.get("raw") == ("audio/wav", b"\x00\x01raw")
+    assert await restarted.get("base64") == ("image/webp", "UklGRg==")
+    assert restarted.stats["disk_hits"] == 2
+    # promoted to the memory tier
+    assert await restarted.get("raw") == ("audio/wav", b"\x00\x01raw")
+    assert restarted.stats["hits"] == 1
+
+
+async def test_disk_entries_without_an_encoding(tmp_path):
+    cache = m.MediaCache({"disk": str(tmp_path)})
+    with open(cache.disk_file("old"), "wb") as f:
+        f.write(b"image/png\niVBORw0KGgo=")
+    assert await cache.get("old") == ("image/png", "iVBORw0KGgo=")
+
+
+async def test_default_disk_path(tmp_path):
+    cache = m.MediaCache({"disk": True})
+    await cache.put("a", ("text/plain", b"a"))
+    assert len(os.listdir(tmp_path / ".llms" / "cache" / "media")) == 1
+
+
+async def test_disk_is_pruned_least_recently_used_first(tmp_path):
+    cache = m.MediaCache({"disk": str(tmp_path), "disk_max_bytes": 300})
+    for i, key in enumerate("abcd"):
+        await cache.put(key, ("text/plain", key.encode() * 90))
+        os.utime(cache.disk_file(key), (1000 + i, 1000 + i))
+    # d pushed the disk tier over 300 bytes, the oldest entries were removed until it's within 270
+    assert not os.path.exists(cache.disk_file("a"))
+    assert not os.path.exists(cache.disk_file("b"))
+    assert os.path.exists(cache.disk_file("c")) and os.path.exists(cache.disk_file("d"))
+    assert cache.stats["evictions"] == 2
+
+
+async def test_unchanged_urls_are_revalidated(media_server, init_llms):
+    async with media_server({"doc.pdf": ("application/pdf", b"%PDF-1")}) as server:
+        init_llms({})
+        url = server.url("doc.pdf")
+        first = await m.fetch_media('file', url, 10, raw=True)
+        assert await m.fetch_media('file', url, 10, raw=True) == first
+        assert (server.not_modified, m.g_media_cache.stats["revalidated"]) == (1, 1)
+
+        # changed content is downloaded again
+        server.files["doc.pdf"] = ("application/pdf", b"%PDF-2")
+        assert await m.fetch_media('file', url, 10, raw=True) == ("application/pdf", b"%PDF-2")
+
+        # not modified, but evicted from the cache since
+        m.g_media_cache.entries.clear()
+        assert await m.fetch_media('file', url, 10, raw=True) == ("application/pdf", b"%PDF-2")
+        assert server.requests == ["doc.pdf"] * 5
+
+
+async def test_same_content_is_encoded_once(media_server, init_llms):
+    data = b"\x89PNG same"
+    async with media_server({"a.png": ("image/png", data), "b.png": ("image/png", data)}) as server:
+        init_llms({})
+        first = await m.fetch_media('image', server.url("a.png"), 10)
+        assert await m.fetch_media('image', server.url("b.png"), 10) == first
+        assert m.g_convert_pool.completed == 1
+
+
+async def test_local_files_are_cached_until_modified(tmp_path, init_llms):
+    path = tmp_path / "image.png"
+    path.write_bytes(b"one")
+    init_llms({})
+    assert await m.read_media('image', str(path)) == ("image/png", "b25l")
+    assert await m.read_media('image', str(path)) == ("image/png", "b25l")
+    assert m.g_convert_pool.completed == 1
+    path.write_bytes(b"three")
+    assert await m.read_media('image', str(path)) == ("image/png", "dGhyZWU=")
+
+
+def test_image_keys_depend_on_the_conversion_settings(init_llms):
+    init_llms({}, convert={"image": {"max_size": "512x512", "workers": 2}})
+    key = m.media_key('image', "hash", "image/png")
+    assert m.media_key('file', "hash", "image/png") == "file:image/png:hash"
+    init_llms({}, convert={"image": {"max_size": "512x512", "workers": 4}})
+    # the worker pool doesn't change the output
+    assert m.media_key('image', "hash", "image/png") == key
+    init_llms({}, convert={"image": {"max_size": "1024x1024"}})
+    assert m.media_key('image', "hash", "image/png") != key
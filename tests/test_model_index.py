@@ -0,0 +1,96 @@
+import importlib
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+m = importlib.import_module('llms.main')
+
+
+def provider(models, **kwargs):
+    return {"type": "OpenAiProvider", "base_url": "http://127.0.0.1:9", "api_key": "test", "models": models, **kwargs}
+
+
+@pytest.fixture
+def catalog_client():
+    """aiohttp test client for /models/list and /models served from the current g_model_index"""
+    async def models_handler(request):
+        index = m.g_model_index
+        return m.catalog_response(request, index.models_json, index.models_etag)
+
+    async def active_models_handler(request):
+        index = m.g_model_index
+        return m.catalog_response(request, index.active_models_json, index.active_models_etag)
+
+    def create():
+        app = web.Application()
+        app.router.add_get('/models/list', models_handler)
+        app.router.add_get('/models', active_models_handler)
+        return TestClient(TestServer(app))
+    return create
+
+
+def test_routes_follow_provider_order(init_llms):
+    init_llms({
+        "a": provider({"m1": "a-m1", "m2": "a-m2"}),
+        "b": provider({"m2": "b-m2", "m3": "b-m3"}),
+    })
+    index = m.g_model_index
+    assert index.models == ["m1", "m2", "m3"]
+    assert [name for name, _ in index.providers("m2")] == ["a", "b"]
+    assert index.providers("missing") == ()
+    assert [(model["id"], model["provider"], model["provider_model"]) for model in index.active_models] == \
+        [("m1", "a", "a-m1"), ("m2", "a", "a-m2"), ("m3", "b", "b-m3")]
+    assert json.loads(index.models_json) == index.models
+
+
+def test_etags_only_change_with_the_catalog(init_llms):
+    init_llms({"a": provider({"m1": "m1"})})
+    before = m.g_model_index
+    init_llms({"a": provider({"m1": "m1"})})
+    same = m.g_model_index
+    assert same is not before
+    assert (same.models_etag, same.active_models_etag) == (before.models_etag, before.active_models_etag)
+
+    # pricing is only part of the active models catalog
+    init_llms({"a": provider({"m1": "m1"}, default_pricing={"input": 1, "output": 2})})
+    priced = m.g_model_index
+    assert priced.models_etag == before.models_etag
+    assert priced.active_models_etag != before.active_models_etag
+
+    init_llms({"a": provider({"m1": "m1", "m2": "m2"}, default_pricing={"input": 1, "output": 2})})
+    added = m.g_model_index
+    assert added.models_etag != priced.models_etag
+    assert added.active_models_etag != priced.active_models_etag
+
+
+async def test_unchanged_catalogs_are_not_modified(init_llms, catalog_client):
+    init_llms({"a": provider({"m1": "m1"})})
+    async with catalog_client() as client:
+        for path in ('/models/list', '/models'):
+            response = await client.get(path)
+            assert response.status == 200
+            etag = response.headers['ETag']
+            assert response.headers['Cache-Control'] == 'no-cache'
+            body = await response.read()
+
+            response = await client.get(path, headers={'If-None-Match': etag})
+            assert response.status == 304
+            assert response.headers['ETag'] == etag
+            assert await response.read() == b''
+
+            response = await client.get(path, headers={'If-None-Match': f'"other", {etag}'})
+            assert response.status == 304
+            response = await client.get(path, headers={'If-None-Match': '*'})
+            assert response.status == 304
+            response = await client.get(path, headers={'If-None-Match': '"other"'})
+            assert response.status == 200
+            assert await response.read() == body
+
+        etag = (await client.get('/models/list')).headers['ETag']
+        init_llms({"a": provider({"m1": "m1", "m2": "m2"})})
+        response = await client.get('/models/list', headers={'If-None-Match': etag})
+        assert response.status == 200
+        assert response.headers['ETag'] != etag
+        assert await response.json() == ["m1", "m2"]
@@ -0,0 +1,103 @@
+import asyncio
+import base64
+import importlib
+import time
+from io import BytesIO
+
+import aiohttp
+import pytest
+from PIL import Image
+
+m = importlib.import_module('llms.main')
+
+
+def png(color):
+    output = BytesIO()
+    Image.new('RGB', (8, 8), color).save(output, format='PNG')
+    return output.getvalue()
+
+
+IMAGES = {f"{color}.png": ("image/png", png(color)) for color in ("red", "green", "blue", "white")}
+
+
+def image_item(url):
+    return {"type": "image_url", "image_url": {"url": url}}
+
+
+def decoded(payload):
+    return base64.b64decode(str(payload).split(',', 1)[1])
+
+
+async def test_media_is_downloaded_concurrently(media_server, init_llms, chat):
+    async with media_server(IMAGES, delay=0.2) as server:
+        init_llms({})
+        request = chat([{"type": "text", "text": "compare"}] + [image_item(server.url(name)) for name in IMAGES])
+        started_at = time.monotonic()
+        assert await m.process_chat(request) is request
+        assert time.monotonic() - started_at < 0.6
+        assert server.max_in_flight == len(IMAGES)
+    content = request["messages"][0]["content"]
+    assert content[0] == {"type": "text", "text": "compare"}
+    # every item was resolved in place
+    for item, (_, data) in zip(content[1:], IMAGES.values()):
+        assert isinstance(item["image_url"]["url"], m.MediaPayload)
+        assert decoded(item["image_url"]["url"]) == data
+
+
+async def test_concurrency_limit(media_server, init_llms, chat):
+    async with media_server(IMAGES, delay=0.05) as server:
+        init_llms({}, media={"concurrency": 2})
+        await m.process_chat(chat([image_item(server.url(name)) for name in IMAGES]))
+        assert server.max_in_flight == 2
+        assert len(server.requests) == len(IMAGES)
+
+
+async def test_failed_download_cancels_the_others(media_server, init_llms, chat):
+    async with media_server(IMAGES, delay=5) as server:
+        server.missing.add("red.png")
+        init_llms({})
+        started_at = time.monotonic()
+        with pytest.raises(aiohttp.ClientResponseError):
+            await m.process_chat(chat([image_item(server.url(name)) for name in IMAGES]))
+        assert time.monotonic() - started_at < 1
+        await asyncio.sleep(0.05)
+        assert server.in_flight == 0
+
+
+async def test_timeout(media_server, init_llms, chat):
+    async with media_server(IMAGES, delay=5) as server:
+        init_llms({}, media={"timeout": 0.1})
+        with pytest.raises(asyncio.TimeoutError):
+            await m.process_chat(chat([image_item(server.url("red.png"))]))
+
+
+async def test_every_kind_of_media(tmp_path, media_server, init_llms, chat):
+    (tmp_path / "notes.txt").write_bytes(b"notes")
+    files = {**IMAGES, "clip.wav": ("audio/wav", b"RIFF audio"), "doc.pdf": ("application/octet-stream", b"%PDF")}
+    async with media_server(files) as server:
+        init_llms({})
+        data_uri = "data:image/png;base64," + base64.b64encode(IMAGES["blue.png"][1]).decode('ascii')
+        request = chat([
+            image_item(server.url("red.png")),
+            image_item(data_uri),
+            {"type": "input_audio", "input_audio": {"data": server.url("clip.wav")}},
+            {"type": "file", "file": {"file_data": server.url("doc.pdf")}},
+            {"type": "file", "file": {"file_data": str(tmp_path / "notes.txt")}},
+        ])
+        await m.process_chat(request)
+    image, inline, audio, file, local = request["messages"][0]["content"]
+    assert decoded(image["image_url"]["url"]) == IMAGES["red.png"][1]
+    assert str(inline["image_url"]["url"]) == data_uri
+    assert audio["input_audio"]["format"] == "wav"
+    assert base64.b64decode(str(audio["input_audio"]["data"])) == b"RIFF audio"
+    assert (file["file"]["filename"], decoded(file["file"]["file_data"])) == ("doc.pdf", b"%PDF")
+    assert str(file["file"]["file_data"]).startswith("data:application/pdf;base64,")
+    assert (local["file"]["filename"], decoded(local["file"]["file_data"])) == ("notes.txt", b"notes")
+
+
+async def test_chat_without_media(init_llms, chat):
+    init_llms({})
+    request = chat()
+    assert await m.process_chat(request) == {**chat(), "stream": False}
+    with pytest.raises(Exception, match="Invalid image"):
+        await m.process_chat(chat([image_item("not an image")]))
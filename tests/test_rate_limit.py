@@ -0,0 +1,120 @@
+import asyncio
+import importlib
+import time
+
+import pytest
+
+m = importlib.import_module('llms.main')
+
+
+def test_token_bucket_refills_continuously(clock):
+    bucket = m.TokenBucket(60)
+    assert bucket.wait_time(60) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1) == pytest.approx(1)
+    clock.now += 0.5
+    assert bucket.wait_time(1) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.wait_time(1) == 0
+    # never refilled past its capacity
+    clock.now += 3600
+    bucket.refill()
+    assert bucket.tokens == 60
+
+
+def test_token_bucket_caps_oversized_requests(clock):
+    bucket = m.TokenBucket(100)
+    # a request larger than the whole budget waits for a full bucket instead of forever
+    assert bucket.wait_time(1000) == 0
+    bucket.take(1000)
+    assert bucket.tokens == 0
+    assert bucket.wait_time(1000) == pytest.approx(60)
+
+
+def test_token_bucket_sync(clock):
+    bucket = m.TokenBucket(0)
+    bucket.sync(limit=100, remaining=10, reset=9)
+    assert (bucket.capacity, bucket.tokens) == (100, 10)
+    # the remaining 90 are back after reset seconds
+    assert bucket.rate == pytest.approx(10)
+    assert bucket.wait_time(20) == pytest.approx(1)
+    # a configured limit is never exceeded
+    configured = m.TokenBucket(50)
+    configured.sync(limit=100, remaining=80, reset=None)
+    assert (configured.capacity, configured.tokens) == (50, 50)
+
+
+def test_rate_limiter_status_and_settle(clock):
+    limiter = m.RateLimiter({"rpm": 10, "tpm": 1000, "models": {"m": {"tpm": 100}}})
+    assert limiter.tracks_tokens("other")
+    asyncio.run(limiter.acquire("m", 80))
+    assert limiter.status() == {
+        "*": {"requests": {"limit": 10, "remaining": 9}, "tokens": {"limit": 1000, "remaining": 920}},
+        "m": {"tokens": {"limit": 100, "remaining": 20}},
+    }
+    # the request used fewer tokens than estimated
+    limiter.settle("m", 80, {"total_tokens": 30})
+    assert limiter.status()["m"]["tokens"]["remaining"] == 70
+    assert limiter.status()["*"]["tokens"]["remaining"] == 970
+
+
+def test_rate_limiter_adapts_to_headers(clock):
+    limiter = m.RateLimiter()
+    assert not limiter.tracks_tokens("m")
+    limiter.update("m", {
+        "x-ratelimit-limit-requests": "500", "x-ratelimit-remaining-requests": "499", "x-ratelimit-reset-requests": "120ms",
+        "x-ratelimit-limit-tokens": "30000", "x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "6s",
+    })
+    assert limiter.status()["m"] == {"requests": {"limit": 500, "remaining": 499}, "tokens": {"limit": 30000, "remaining": 0}}
+    assert limiter.tracks_tokens("m")
+    assert m.RateLimiter({"adaptive": False}).update("m", {"x-ratelimit-limit-tokens": "1", "x-ratelimit-remaining-tokens": "0"}) is None
+
+
+async def test_acquire_waits_for_budget():
+    limiter = m.RateLimiter({"rpm": 600})
+    limiter.buckets[None]['requests'].tokens = 0
+    started_at = time.monotonic()
+    await limiter.acquire("m", 0)
+    assert 0.05 < time.monotonic() - started_at < 1
+
+
+async def test_acquire_fails_past_max_wait():
+    limiter = m.RateLimiter({"rpm": 1, "max_wait": 0.5})
+    await limiter.acquire("m", 0)
+    with pytest.raises(m.RateLimitExceeded):
+        await limiter.acquire("m", 0)
+
+
+async def test_requests_are_admitted_in_order():
+    limiter = m.RateLimiter({"rpm": 1200})
+    limiter.buckets[None]['requests'].tokens = 0
+    admitted = []
+
+    async def request(i):
+        await limiter.acquire("m", 0)
+        admitted.append(i)
+    await asyncio.gather(*[request(i) for i in range(5)])
+    assert admitted == [0, 1, 2, 3, 4]
+
+
+async def test_provider_rate_limit(upstream, provider, init_llms, chat):
+    async with upstream() as up:
+        init_llms({"a": provider(up, rate_limit={"rpm": 2})}, rate_limit={"max_wait": 0.1})
+        await m.chat_completion(chat())
+        await m.chat_completion(chat())
+        with pytest.raises(m.RateLimitExceeded):
+            await m.chat_completion(chat())
+        assert up.calls == 2
+
+
+async def test_provider_headers_update_limits(upstream, provider, init_llms, chat):
+    headers = {"x-ratelimit-limit-tokens": "1000", "x-ratelimit-remaining-tokens": "995", "x-ratelimit-reset-tokens": "1s"}
+    async with upstream(headers=headers) as up:
+        init_llms({"a": provider(up)})
+        await m.chat_completion(chat())
+        limiter = m.g_handlers["a"].limiter
+        # 995 remaining less the response's 5 tokens of usage
+        assert limiter.status()["m"]["tokens"] == {"limit": 1000, "remaining": 990}
+        response = await m.chat_completion(chat(stream=True), stream=True)
+        assert ''.join([chunk['choices'][0]['delta']['content'] async for chunk in response]) == "hello world"
+        assert limiter.status()["m"]["tokens"] == {"limit": 1000, "remaining": 995}
@@ -0,0 +1,131 @@
+import importlib
+import time
+from email.utils import formatdate
+
+import aiohttp
+import pytest
+
+m = importlib.import_module('llms.main')
+
+
+@pytest.mark.parametrize("value, seconds", [
+    ("1s", 1),
+    ("6m0s", 360),
+    ("1h2m3.5s", 3723.5),
+    ("20ms", 0.02),
+    ("2.5", 2.5),
+    ("soon", None),
+])
+def test_parse_duration(value, seconds):
+    if seconds is None:
+        assert m.parse_duration(value) is None
+    else:
+        assert m.parse_duration(value) == pytest.approx(seconds)
+
+
+def test_parse_duration_epoch():
+    assert m.parse_duration(str(int(time.time()) + 30)) == pytest.approx(30, abs=1)
+    # epoch milliseconds
+    assert m.parse_duration(str(int(time.time() * 1000) + 30000)) == pytest.approx(30, abs=1)
+    # already past
+    assert m.parse_duration(str(int(time.time()) - 30)) == 0
+    assert m.parse_duration(str(int(time.time() * 1000) - 30000)) == 0
+
+
+@pytest.mark.parametrize("headers, seconds", [
+    (None, None),
+    ({}, None),
+    ({"Retry-After": "7"}, 7),
+    ({"retry-after-ms": "1500", "Retry-After": "7"}, 1.5),
+    ({"x-ratelimit-reset-requests": "1s", "x-ratelimit-reset-tokens": "6m0s"}, 360),
+    # the reset of the exhausted limit wins
+    ({"x-ratelimit-reset-requests": "2s", "x-ratelimit-remaining-requests": "0",
+      "x-ratelimit-reset-tokens": "6m0s", "x-ratelimit-remaining-tokens": "100"}, 2),
+    ({"Retry-After": "soon"}, None),
+])
+def test_retry_after(headers, seconds):
+    assert m.retry_after(headers) == seconds
+
+
+def test_retry_after_http_date():
+    headers = {"Retry-After": formatdate(time.time() + 60, usegmt=True)}
+    assert m.retry_after(headers) == pytest.approx(60, abs=2)
+    assert m.retry_after({"Retry-After": formatdate(time.time() - 60, usegmt=True)}) == 0
+
+
+def test_retry_after_epoch_ms_reset(monkeypatch):
+    # OpenRouter's reset is an epoch timestamp in milliseconds
+    now = time.time()
+    headers = {"X-RateLimit-Limit": "20", "X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(int(now * 1000) + 2000)}
+    assert m.retry_after(headers) == pytest.approx(2, abs=1)
+    monkeypatch.setattr(m.random, 'uniform', lambda low, high: high)
+    delay = m.RetryPolicy().retry_delay(m.HTTPError(429, "", "", headers), 0, time.monotonic() + 300)
+    assert delay == pytest.approx(2, abs=1)
+    assert m.retry_after({**headers, "X-RateLimit-Reset": str(int(now * 1000) - 2000)}) == 0
+
+
+def test_classify():
+    policy = m.RetryPolicy()
+    for status in (408, 429, 502, 503, 504, 529):
+        assert policy.classify(m.HTTPError(status, "", "")) == "retryable"
+    for status in (400, 422):
+        assert policy.classify(m.HTTPError(status, "", "")) == "terminal"
+    for status in (401, 403, 404, 500):
+        assert policy.classify(m.HTTPError(status, "", "")) == "failover"
+    assert policy.classify(aiohttp.ServerDisconnectedError()) == "retryable"
+    assert policy.classify(aiohttp.ClientConnectorError(None, OSError(111, "refused"))) == "failover"
+    assert policy.classify(Exception("other")) == "failover"
+    assert m.RetryPolicy({"terminal_status": [404]}).classify(m.HTTPError(400, "", "")) == "failover"
+
+
+def test_retry_delay(monkeypatch):
+    monkeypatch.setattr(m.random, 'uniform', lambda low, high: high)
+    policy = m.RetryPolicy({"max_retries": 3, "backoff": 0.5, "max_backoff": 1.5, "max_retry_after": 30})
+    deadline = time.monotonic() + 300
+    e = m.HTTPError(503, "", "")
+    assert [policy.retry_delay(e, attempt, deadline) for attempt in range(4)] == [0.5, 1.0, 1.5, None]
+    assert policy.retry_delay(m.HTTPError(500, "", ""), 0, deadline) is None
+    # Retry-After extends the backoff, but too long a wait fails over instead
+    assert policy.retry_delay(m.HTTPError(429, "", "", {"Retry-After": "5"}), 0, deadline) == 5
+    assert policy.retry_delay(m.HTTPError(429, "", "", {"Retry-After": "60"}), 0, deadline) is None
+    # not past the deadline
+    assert policy.retry_delay(e, 0, time.monotonic() + 0.1) is None
+
+
+async def test_rate_limited_request_is_retried(upstream, provider, init_llms, chat):
+    async with upstream(reply="ok") as up:
+        up.failures = [(429, {"Retry-After": "0.2"}), (503, None)]
+        init_llms({"a": provider(up)}, retry={"max_retries": 2, "backoff": 0.01})
+        started_at = time.monotonic()
+        response = await m.chat_completion(chat())
+        assert response['choices'][0]['message']['content'] == "ok"
+        assert up.calls == 3
+        assert time.monotonic() - started_at >= 0.2
+
+
+async def test_retries_exhausted_fail_over(upstream, provider, init_llms, chat):
+    async with upstream(reply="a") as a, upstream(reply="b") as b:
+        a.failures = [(503, None)] * 3
+        init_llms({"a": provider(a), "b": provider(b)}, retry={"max_retries": 1, "backoff": 0.01})
+        response = await m.chat_completion(chat())
+        assert response['choices'][0]['message']['content'] == "b"
+        assert (a.calls, b.calls) == (2, 1)
+
+
+async def test_terminal_error_doesnt_fail_over(upstream, provider, init_llms, chat):
+    async with upstream(reply="a") as a, upstream(reply="b") as b:
+        a.failures = [(400, None)]
+        init_llms({"a": provider(a), "b": provider(b)})
+        with pytest.raises(m.HTTPError) as e:
+            await m.chat_completion(chat())
+        assert e.value.status == 400
+        assert (a.calls, b.calls) == (1, 0)
+
+
+async def test_failover_error_tries_next_provider(upstream, provider, init_llms, chat):
+    async with upstream(reply="a") as a, upstream(reply="b") as b:
+        a.failures = [(401, None)]
+        init_llms({"a": provider(a), "b": provider(b)})
+        response = await m.chat_completion(chat())
+        assert response['choices'][0]['message']['content'] == "b"
+        assert (a.calls, b.calls) == (1, 1)
@@ -0,0 +1,109 @@
+import asyncio
+import importlib
+import json
+from types import SimpleNamespace
+
+m = importlib.import_module('llms.main')
+
+
+def candidate(name, pricing=None):
+    return (name, SimpleNamespace(model_pricing=lambda model: pricing))
+
+
+def test_ordered_policy_records_nothing():
+    routing = m.RoutingStats()
+    routing.record("a", "m", 1.0)
+    routing.record_error("a", "m")
+    assert routing.stats == {}
+    candidates = (candidate("a"), candidate("b"))
+    assert routing.rank("m", candidates) == candidates
+
+
+def test_ewma():
+    routing = m.RoutingStats({"policy": "latency", "alpha": 0.5, "persist": False})
+    routing.record("a", "m", 1.0, ttft=0.2)
+    routing.record("a", "m", 2.0)
+    routing.record_error("a", "m")
+    stats = routing.stats[("a", "m")]
+    assert (stats["latency"], stats["ttft"], stats["error_rate"]) == (1.5, 1.1, 0.5)
+    assert (stats["requests"], stats["errors"]) == (3, 1)
+
+
+def test_rank():
+    routing = m.RoutingStats({"policy": "latency", "alpha": 1, "error_penalty": 4, "persist": False})
+    candidates = tuple(candidate(name) for name in "abcd")
+    # ties keep config order
+    assert routing.rank("m", candidates) == candidates
+    routing.record("a", "m", 2.0, ttft=0.1)
+    routing.record("b", "m", 1.0, ttft=0.5)
+    routing.record("c", "m", 0.5)
+    routing.record_error("c", "m")
+    # unmeasured providers first, then by latency inflated by the error rate
+    assert [name for name, _ in routing.rank("m", candidates)] == ["d", "b", "a", "c"]
+    # streams are ranked by time to first token
+    assert [name for name, _ in routing.rank("m", candidates, stream=True)] == ["d", "a", "b", "c"]
+
+
+def test_price_weight():
+    routing = m.RoutingStats({"policy": "latency", "alpha": 1, "price_weight": 2, "persist": False})
+    candidates = (candidate("pricey", {"input": "3", "output": "7"}), candidate("cheap", {"input": "1", "output": "1"}))
+    routing.record("pricey", "m", 1.0)
+    routing.record("cheap", "m", 2.0)
+    assert routing.scores("m", candidates) == [3.0, 2.8]
+    assert [name for name, _ in routing.rank("m", candidates)] == ["cheap", "pricey"]
+
+
+def test_stats_are_persisted(tmp_path):
+    path = tmp_path / "routing.json"
+    routing = m.RoutingStats({"policy": "latency", "persist": str(path)})
+    routing.record("a", "m", 1.0)
+    # saved in the background at most every save_interval seconds
+    assert not path.exists()
+    routing.flush()
+    assert json.loads(path.read_text())[0]["provider"] == "a"
+    loaded = m.RoutingStats({"policy": "latency", "persist": str(path)})
+    assert loaded.stats == routing.stats
+
+
+async def test_default_path_and_save_interval(tmp_path):
+    routing = m.RoutingStats({"policy": "latency", "save_interval": 0})
+    routing.record("a", "m", 1.0)
+    await routing._save_task
+    assert (tmp_path / ".llms" / "cache" / "routing.json").exists()
+
+
+async def test_requests_go_to_the_fastest_provider(upstream, provider, init_llms, chat):
+    async with upstream(reply="slow", delay=0.2) as slow, upstream(reply="fast") as fast:
+        init_llms({"slow": provider(slow), "fast": provider(fast)}, routing={"policy": "latency", "persist": False})
+        replies = [(await m.chat_completion(chat()))["choices"][0]["message"]["content"] for _ in range(5)]
+        # both are measured, then the fastest is preferred
+        assert replies == ["slow", "fast", "fast", "fast", "fast"]
+        assert m.g_routing.stats[("slow", "m")]["latency"] > m.g_routing.stats[("fast", "m")]["latency"]
+
+        rankings = m.g_routing.rankings(m.g_model_index)
+        assert rankings["policy"] == "latency"
+        assert [entry["provider"] for entry in rankings["models"]["m"]] == ["fast", "slow"]
+
+
+async def test_streams_record_time_to_first_token(upstream, provider, init_llms, chat):
+    async with upstream(reply="one two three four five") as up:
+        init_llms({"a": provider(up)}, routing={"policy": "latency", "persist": False})
+        response = await m.chat_completion(chat(stream=True), stream=True)
+        async for _ in response:
+            await asyncio.sleep(0.02)
+        stats = m.g_routing.stats[("a", "m")]
+        assert stats["requests"] == 1
+        assert stats["ttft"] < stats["latency"]
+
+
+async def test_failures_raise_the_error_rate(upstream, provider, init_llms, chat):
+    async with upstream(reply="broken") as broken, upstream(reply="working") as working:
+        broken.failures = [(500, None)]
+        init_llms({"broken": provider(broken), "working": provider(working)},
+            routing={"policy": "latency", "persist": False}, retry={"max_retries": 0})
+        assert (await m.chat_completion(chat()))["choices"][0]["message"]["content"] == "working"
+        assert m.g_routing.stats[("broken", "m")]["errors"] == 1
+        assert m.g_routing.stats[("broken", "m")]["error_rate"] == 0.2
+        # measured providers without errors are preferred
+        assert (await m.chat_completion(chat()))["choices"][0]["message"]["content"] == "working"
+        assert broken.calls == 1
@@ -0,0 +1,94 @@
+import asyncio
+import base64
+import importlib
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image
+
+m = importlib.import_module('llms.main')
+
+
+def blocking(seconds):
+    time.sleep(seconds)
+    return threading.current_thread().name
+
+
+async def test_jobs_dont_block_the_event_loop():
+    pool = m.WorkerPool({"workers": 2})
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+    task = asyncio.ensure_future(ticker())
+    try:
+        names = await asyncio.gather(pool.run(blocking, 0.2), pool.run(blocking, 0.2))
+    finally:
+        task.cancel()
+        pool.shutdown()
+    assert ticks >= 10
+    assert all(name.startswith('llms-convert') for name in names)
+
+
+async def test_max_concurrent():
+    pool = m.WorkerPool({"workers": 4, "max_concurrent": 2})
+    try:
+        jobs = [asyncio.ensure_future(pool.run(blocking, 0.1)) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        status = pool.status()
+        assert (status["running"], status["queued"], status["completed"]) == (2, 3, 0)
+        await asyncio.gather(*jobs)
+        assert pool.status() == {"executor": "thread", "workers": 4, "max_concurrent": 2, "running": 0, "queued": 0, "completed": 5}
+    finally:
+        pool.shutdown()
+
+
+async def test_cancelled_jobs_give_back_their_slot():
+    pool = m.WorkerPool({"workers": 1})
+    try:
+        running = asyncio.ensure_future(pool.run(blocking, 0.1))
+        queued = asyncio.ensure_future(pool.run(blocking, 0))
+        await asyncio.sleep(0.01)
+        queued.cancel()
+        await running
+        assert pool.queued == 0
+        assert await asyncio.wait_for(pool.run(blocking, 0), 1)
+    finally:
+        pool.shutdown()
+
+
+def test_pool_is_usable_from_another_event_loop():
+    pool = m.WorkerPool({"workers": 1})
+    try:
+        assert asyncio.run(pool.run(blocking, 0))
+        assert asyncio.run(pool.run(blocking, 0))
+        assert pool.completed == 2
+    finally:
+        pool.shutdown()
+    assert pool.executor is None
+
+
+async def test_process_executor():
+    pool = m.WorkerPool({"workers": 1, "executor": "process"})
+    try:
+        assert await pool.run(m.encode_media, b"data", "text/plain") == ("text/plain", "ZGF0YQ==")
+        assert pool.status()["executor"] == "process"
+    finally:
+        pool.shutdown()
+
+
+async def test_images_are_converted_in_the_pool(tmp_path, init_llms, chat):
+    Image.new('RGB', (400, 200), 'red').save(tmp_path / "large.png")
+    init_llms({}, convert={"image": {"max_size": "100x100", "workers": 2}})
+    assert m.g_convert_pool.workers == 2
+    request = chat([{"type": "image_url", "image_url": {"url": str(tmp_path / "large.png")}}])
+    await m.process_chat(request)
+    url = str(request["messages"][0]["content"][0]["image_url"]["url"])
+    assert url.startswith("data:image/webp;base64,")
+    with Image.open(BytesIO(base64.b64decode(url.split(',', 1)[1]))) as image:
+        assert image.size == (100, 50)
+    assert m.g_convert_pool.completed == 1